@@ -0,0 +1,411 @@
+import io
+import os
+import re
+import sys
+import json
+import struct
+import subprocess
+from hashlib import blake2b
+from exceptions import Exceptions
+from stats import Stats
+
+"""
+Query agent.
+``python agent.py`` runs next to the database files (started over
+SSH by `remote.Connector.open_agent`) and answers requests on its
+stdin / stdout. The elements are selected on the server, only the
+matching ones cross the wire. Sealed elements are sent as they
+are stored, the key never leaves the client.
+Every message is a frame: its length (4 bytes, big-endian),
+a JSON object, a newline and a payload (blocks, as in the file).
+"""
+
+FRAME = struct.Struct(">I")
+AGENT = os.path.abspath(__file__)
+# Uploaded to the server by `install`, agent.py last (it marks a complete upload)
+MODULES = ("exceptions.py", "stats.py", "records.py", "concurrency.py", "handles.py", "storage.py", "secure.py",
+           "delta.py", "structures.py", "tools.py", "agent.py")
+
+
+def write_frame(file, message, payload=b""):
+    data = json.dumps(message).encode() + b"\n"
+    file.write(FRAME.pack(len(data) + len(payload)) + data + payload)
+    return FRAME.size + len(data) + len(payload)
+
+
+def read_exact(file, size):
+    chunks = []
+    while size > 0:
+        chunk = file.read(size)
+        if not chunk:
+            raise Exceptions.BufferError("The agent connection was closed in the middle of a frame", "read_frame")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(file):
+    """
+    :return:
+    The message and the payload, None if the other side closed the connection
+    """
+    head = file.read(FRAME.size)
+    if not head:
+        return None
+    head += read_exact(file, FRAME.size - len(head))
+    (size,) = FRAME.unpack(head)
+    data = read_exact(file, size)
+    message, payload = data.split(b"\n", 1)
+    return json.loads(message), payload
+
+
+def block(head, name, content, digest=None):
+    """
+    An element as it is stored in the file (sub-header, content, newline)
+    """
+    sub_header = f"{head}{name}:{len(content)}" + (f":{digest}" if digest is not None else "")
+    return f"{sub_header}\n".encode() + content + b"\n"
+
+
+def select(database, want):
+    """
+    Generator of the blocks of the elements `want` selects, the
+    content is only read for those (on a local level N database)
+    :param want:
+    Callable (type, name), returns False to skip the element, True
+    to take it or a callable, which decides on the content
+    """
+    from tools import iter_elements
+    header = database._loaded_header
+    local = database.storage.local and header.level == "N"
+    file = database._get_ready_file()
+    try:
+        for head, name, content, digest in iter_elements(file, header.size, header.idx,
+                                                         database.location if local else None, b"=?"):
+            selected = head != b"+" and want(head.decode(), name)
+            if not selected:
+                continue
+            if type(content) is tuple:
+                content = database._read_range(content[1], content[2])
+            if selected is True or selected(content):
+                yield block(head.decode(), name, content, digest)
+    finally:
+        file.close()
+
+
+def _search_values(pattern, version, values=None):
+    from tools import decode_cluster
+
+    def want(head, name):
+        if head != "=":
+            return False
+        return lambda content: any(not borrow and pattern.search(value if type(value) is bytes else value.encode())
+                                   for borrow, _, value, _ in decode_cluster(content, version, values))
+    return want
+
+
+def _delta(request, payload):
+    from delta import checksums, patch
+    if request["op"] == "checksums":
+        with open(request["file"], 'rb') as file:
+            return {"size": os.fstat(file.fileno()).st_size}, checksums(file, request["block"])
+    target = request["target"]
+    with open(request["file"], 'rb') as basis, open(target, 'wb') as file:
+        digest = patch(basis, payload, request["block"], file)
+    if digest != request["digest"]:  # The old file is not the one of the checksums
+        os.remove(target)
+        raise Exceptions.CorruptionError(f"The patched '{target}' does not match the new file", "patch")
+    return {}, b""
+
+
+def handle(request, payload):
+    """
+    Answer a single request
+    :return:
+    The message and the payload of the reply
+    """
+    from structures import DataBase
+    op = request["op"]
+    if op in ("checksums", "patch"):  # Of any file (see `delta`)
+        return _delta(request, payload)
+    database = DataBase(request["file"], request["file"])
+    if database._loaded_header is None:
+        raise Exceptions.HeaderError(f"There is no database '{request['file']}'", op)
+    with database:
+        header = database._loaded_header
+        match op:
+            case "header":
+                return {"level": header.level, "params": header.params}, b""
+            case "load":
+                blocks = select(database, lambda head, name: name == request["name"])
+                found = next(blocks, None)
+                blocks.close()
+                blocks = [] if found is None else [found]
+            case "find":
+                blocks = select(database, lambda head, name: name == request["name"])
+            case "search":
+                pattern = re.compile(request["pattern"].encode())
+                if request.get("names"):
+                    blocks = select(database, lambda head, name: pattern.search(name.encode()) is not None)
+                elif header.params.get("enc"):
+                    raise Exceptions.UnsupportedError("The values of a secured database can not be searched "
+                                                      "by the agent (it has no key)", op)
+                else:
+                    blocks = select(database, _search_values(pattern, database.version, database._get_values()))
+            case "values":  # As it is stored (sealed)
+                name, content = database._read_value_segment()
+                return {"name": name}, content
+            case "update":
+                written = database._replace_block(request["name"], lambda: payload, request.get("check", False))
+                return {"written": written}, b""
+            case _:
+                raise Exceptions.UnsupportedError(f"Unknown request '{op}'", "agent")
+        blocks = list(blocks)
+        return {"count": len(blocks)}, b"".join(blocks)
+
+
+def serve(reader, writer):
+    """
+    Answer requests until `reader` is closed
+    """
+    while True:
+        frame = read_frame(reader)
+        if frame is None:
+            return
+        request, payload = frame
+        try:
+            message, payload = handle(request, payload)
+        except Exceptions.BaseException as ex:
+            message, payload = {"error": ex.__class__.__name__, "msg": ex.msg, "level": ex.level}, b""
+        except Exception as ex:
+            message, payload = {"error": ex.__class__.__name__, "msg": str(ex), "level": request.get("op")}, b""
+        write_frame(writer, message, payload)
+        writer.flush()
+
+
+def install(sftp, root=".poki-agent"):
+    """
+    Upload the modules of the agent to the server,
+    once for every version of them
+    :param sftp:
+    `paramiko.SFTPClient`
+    :return:
+    Folder of the modules on the server
+    """
+    here = os.path.dirname(AGENT)
+    digest = blake2b(digest_size=8)
+    for module in MODULES:
+        with open(os.path.join(here, module), 'rb') as file:
+            digest.update(file.read())
+    folder = f'{root}/{digest.hexdigest()}'
+    try:
+        sftp.stat(f'{folder}/agent.py')
+        return folder
+    except IOError:
+        pass
+    for path in (root, folder):
+        try:
+            sftp.mkdir(path)
+        except IOError:  # Exists
+            pass
+    for module in MODULES:
+        sftp.put(os.path.join(here, module), f'{folder}/{module}')
+    return folder
+
+
+class SubprocessTransport:
+    """
+    Runs the agent in a local process,
+    stand-in for the SSH channel (for tests)
+    """
+    def __init__(self, cwd=None, python=sys.executable):
+        self.process = subprocess.Popen([python, AGENT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd)
+        self.stdin = self.process.stdin
+        self.stdout = self.process.stdout
+
+    def close(self):
+        self.stdin.close()  # The agent stops at the end of its input
+        self.process.wait()
+        self.stdout.close()
+
+
+class SSHTransport:
+    """
+    The agent, started on an SSH-server (``exec_command``)
+    """
+    def __init__(self, client, command):
+        """
+        :param client:
+        Connected `paramiko.SSHClient`
+        :param command:
+        Shell command which starts the agent
+        """
+        self.stdin, self.stdout, self.stderr = client.exec_command(command)
+
+    def close(self):
+        self.stdin.close()
+        self.stdout.channel.close()
+
+
+class Agent:
+    """
+    Client of an agent, queries a database (file) on the server,
+    only the matching elements are sent back and decoded here
+    """
+    def __init__(self, transport, filename, key=None, stats: Stats = None):
+        """
+        :param transport:
+        `SSHTransport` or `SubprocessTransport`
+        :param filename:
+        Filename of the database (on the server)
+        :param key:
+        Key of a secured database, the elements are decrypted by the client
+        :param stats:
+        Optional `Stats`, every request is a round-trip
+        """
+        from tools import make_sealer
+        self.transport = transport
+        self.filename = filename
+        self.stats = stats
+        info, _ = self._request("header")
+        self.level = info["level"]
+        self.params = info["params"]
+        self.version = self.params.get("v", 1)
+        self._sealer = make_sealer(self.level, self.params, key)
+        self._values = None
+
+    def _request(self, op, payload=b"", **args):
+        request = {"op": op, "file": self.filename, **args}
+        sent = write_frame(self.transport.stdin, request, payload)
+        self.transport.stdin.flush()
+        frame = read_frame(self.transport.stdout)
+        if frame is None:
+            raise Exceptions.BufferError("The agent has stopped", op)
+        message, payload = frame
+        if self.stats is not None:
+            self.stats.count("round_trips")
+            self.stats.count("bytes_written", sent)
+            self.stats.count("bytes_read", len(payload))
+        if "error" in message:
+            error = getattr(Exceptions, message["error"], None)
+            if not isinstance(error, type) or not issubclass(error, Exceptions.BaseException) \
+                    or error is Exceptions.BaseException:
+                raise Exceptions.UnsupportedError(f"{message['error']} in the agent : {message['msg']}",
+                                                  message["level"])
+            raise error(message["msg"], message["level"])
+        return message, payload
+
+    def _get_values(self):
+        """
+        Content of the value segment (see `DataBase._get_values`),
+        fetched with the first element that needs it
+        """
+        if self._values is None and self.params.get("vs"):
+            message, content = self._request("values")
+            if self._sealer is not None:
+                content = self._sealer.open(content, "+", message["name"])
+            self._values = content
+        return self._values
+
+    def _elements(self, payload, maintain_borrows):
+        from tools import get_sub_header, open_content
+        values = self._get_values() if payload else None
+        file = io.BytesIO(payload)
+        size = len(payload)
+        elements = []
+        while True:
+            head = file.read(1).decode()
+            if not head:
+                break
+            _, _size, name, _ = get_sub_header(file, file.tell(), size)
+            content = file.read(_size)
+            file.read(1)
+            if self._sealer is not None:
+                content = self._sealer.open(content, head, name)
+            elements.append(open_content(head, name, content, maintain_borrows, self.version, values))
+        return elements
+
+    def load(self, name, maintain_borrows=False):
+        """
+        Load an element
+        :return:
+        `Cluster` or `Jar`
+        """
+        _, payload = self._request("load", name=name)
+        elements = self._elements(payload, maintain_borrows)
+        if not elements:
+            raise Exceptions.SubHeadError(f"There is no element '{name}'", "load")
+        return elements[0]
+
+    def find(self, name, maintain_borrows=True):
+        """
+        All elements named `name` (see `DataBase.find`)
+        :return:
+        List of `Cluster`s and `Jar`s
+        """
+        _, payload = self._request("find", name=name)
+        return self._elements(payload, maintain_borrows)
+
+    def search(self, pattern, names=False, maintain_borrows=False):
+        """
+        Search the database on the server
+        :param pattern:
+        Regular expression, matched against the values of the
+        particles of every Cluster (not for secured databases)
+        :param names:
+        Match `pattern` against the names of the elements instead
+        :return:
+        List of the matching `Cluster`s (and `Jar`s)
+        """
+        _, payload = self._request("search", pattern=pattern, names=names)
+        return self._elements(payload, maintain_borrows)
+
+    def update(self, name, element, check=False):
+        """
+        Replace an element, it is assembled (and sealed) by the client
+        :param check:
+        See `DataBase.update`
+        :return:
+        Whether the block was written
+        """
+        from structures import assemble_block
+        asm = assemble_block(element, self._sealer, self.version)
+        message, _ = self._request("update", asm, name=name, check=check)
+        if message["written"]:
+            element.dirty = False
+        return message["written"]
+
+    def checksums(self, block):
+        """
+        Checksums of the blocks of the file (see `delta.checksums`)
+        :return:
+        Size of the file and the checksums
+        """
+        message, sums = self._request("checksums", block=block)
+        return message["size"], sums
+
+    def patch(self, target, block, delta, digest):
+        """
+        Write `target` on the server, from the file and a delta (see `delta.patch`)
+        :param digest:
+        `delta.file_digest` of the new file, a mismatch raises a `CorruptionError`
+        """
+        self._request("patch", delta, target=target, block=block, digest=digest)
+
+    def close(self):
+        """
+        Stop the agent
+        """
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    out = sys.stdout.buffer
+    sys.stdout = sys.stderr  # Nothing else may write to the channel
+    serve(sys.stdin.buffer, out)
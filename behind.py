@@ -0,0 +1,158 @@
+import time
+import atexit
+import threading
+from exceptions import Exceptions
+
+"""
+Write-behind of updates (see `DataBase.write_behind`).
+`update` assembles the block of the element and queues it, repeated
+updates of an element are coalesced, a background thread writes the
+queue in a single pass over the file (like `update_all`) when it is
+big or old enough. The thread only sees the blocks, never the elements.
+An error of the thread is raised by the next `update` / `flush`.
+"""
+
+_open = set()  # Flushed when the interpreter exits (the thread is a daemon)
+
+
+@atexit.register
+def _flush_open():
+    for behind in list(_open):
+        try:
+            behind.close()
+        except Exceptions.BaseException:
+            pass
+
+
+class _Queued:
+    """
+    Assembled block of a queued update, stands in for
+    the element in `DataBase._update_elements`
+    """
+    def __init__(self, block, check):
+        self.block = block
+        self.check = check
+        self.dirty = True
+
+
+class WriteBehind:
+    """
+    Queue of the updates of a `DataBase`
+    ````python
+    with database.write_behind(max_pending=128, delay=0.5):
+        for change in changes:
+            apply(database["cluster"], change)
+            database.update("cluster")  # Returns at once
+    # All updates are written
+    ````
+    """
+    def __init__(self, database, max_pending=64, delay=1.0):
+        """
+        :param max_pending:
+        Amount of queued elements which starts a write
+        :param delay:
+        Maximum age (seconds) of a queued update
+        """
+        self.database = database
+        self.max_pending = max_pending
+        self.delay = delay
+        self.pending: dict[str, _Queued] = {}
+        self.coalesced = 0  # Updates which were merged into a queued one
+        self.error = None
+        self._since = None  # Time of the oldest queued update
+        self._closed = False
+        self._queue = threading.Condition()
+        self._writing = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        _open.add(self)
+
+    def put(self, name, element, check=False):
+        """
+        Queue an update (see `DataBase.update`), the element is
+        assembled now, later changes need another update
+        """
+        self._raise()
+        if self._closed:
+            raise Exceptions.UnsupportedError("Write-behind has been closed", "update")
+        block = self.database._indiv_asm(element, self.database._get_sealer())
+        element.dirty = False  # Changed again by later changes
+        with self._queue:
+            if name in self.pending:
+                check = check and self.pending[name].check  # Written if any of the updates wants it
+                self.coalesced += 1
+            self.pending[name] = _Queued(block, check)
+            if self._since is None:  # The thread waits for the first update, then for `delay`
+                self._since = time.monotonic()
+                self._queue.notify()
+            elif len(self.pending) >= self.max_pending:
+                self._queue.notify()
+
+    def _due(self):
+        return self.pending and (len(self.pending) >= self.max_pending
+                                 or time.monotonic() - self._since >= self.delay)
+
+    def _run(self):
+        while True:
+            with self._queue:
+                while not self._closed and not self._due():
+                    self._queue.wait(self.delay - (time.monotonic() - self._since) if self.pending else None)
+                if self._closed:
+                    return
+            self._write()
+
+    def _write(self):
+        """
+        Write the queued updates, an error is kept for the caller
+        """
+        with self._writing:
+            with self._queue:
+                batch, self.pending, self._since = self.pending, {}, None
+            if not batch:
+                return
+            try:
+                self.database._update_elements(batch, lambda name, queued: queued.block,
+                                               {name for name, queued in batch.items() if queued.check},
+                                               append=False)
+            except BaseException as ex:
+                self._keep(ex)
+
+    def _keep(self, error):
+        """
+        Keep an error for the caller (the first one)
+        """
+        if self.error is None:
+            self.error = error
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        """
+        Write the queued updates now
+        """
+        self._write()
+        self._raise()
+
+    def close(self):
+        """
+        Write the queued updates and stop the thread,
+        the database writes its updates directly again
+        """
+        if not self._closed:
+            with self._queue:
+                self._closed = True
+                self._queue.notify()
+            self._thread.join()
+            _open.discard(self)
+            if self.database._behind is self:
+                self.database._behind = None
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tools
+from secure import Sealer
+from structures import DataBase, Cluster, Atom
+
+"""
+Load throughput of secured databases (S, X) against
+level N, for growing amounts of elements
+
+    python benchmarks/decrypt.py --elements 1000 10000 50000
+"""
+
+LEVELS = (("N", False, False), ("S", True, False), ("X", True, True))
+
+
+def run(location, key, elements, secure, compression, lookups=50):
+    database = DataBase("bench", location, key=key)
+    for i in range(elements):
+        database.add(Cluster(f"c{i}", [Atom(f"a{j}", "x" * 40) for j in range(20)]))
+    database.export(secure=secure, compression=compression)
+    tools.clean()
+    start = time.perf_counter()
+    loaded = tools.load(location, key=key)
+    assert len(loaded.elements) == elements
+    full = time.perf_counter() - start
+    tools.clean()
+    database = DataBase("bench", location, key=key)
+    name = f"c{elements * 9 // 10}"
+    start = time.perf_counter()
+    for _ in range(lookups):
+        database.load(name=name)
+        del database.elements[name]
+    one = (time.perf_counter() - start) / lookups
+    tools.clean()
+    return os.path.getsize(location), full, one
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load throughput of secured databases against level N")
+    parser.add_argument("--elements", type=int, nargs="+", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+    key = Sealer.generate_key()
+    print(f'{"elements":>9} {"level":>6} {"size":>11} {"load MB/s":>10} {"time vs N":>9} {"load(name) ms":>14}')
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, "bench.db")
+        for elements in args.elements:
+            plain = baseline = None
+            for level, secure, compression in LEVELS:
+                size, full, one = run(location, key, elements, secure, compression)
+                plain, baseline = plain or size, baseline or full
+                # Throughput of the plain data (the size of the N database)
+                print(f'{elements:>9} {level:>6} {size:>11} {plain / full / 1e6:>10.1f} '
+                      f'{full / baseline:>9.2f} {one * 1000:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
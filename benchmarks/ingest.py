@@ -0,0 +1,66 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tools
+from structures import DataBase, Cluster, Atom
+from writer import DataBaseWriter
+
+"""
+Time and peak memory of writing a database with `DataBaseWriter`,
+against building the Clusters and exporting them
+
+    python benchmarks/ingest.py --elements 20000 --particles 20
+"""
+
+
+def rows(i, particles):
+    return ((f"a{i}_{j}", "x" * 40) for j in range(particles))
+
+
+def measure(func):
+    tools.clean()
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    tools.clean()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DataBaseWriter against Cluster + export")
+    parser.add_argument("--elements", type=int, default=20000)
+    parser.add_argument("--particles", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, "bench.db")
+        for compression in (False, True):
+            def write():
+                with DataBaseWriter("bench", location, compression=compression) as writer:
+                    for i in range(args.elements):
+                        writer.write_cluster(f"c{i}", rows(i, args.particles))
+
+            def export():
+                database = DataBase("bench", location)
+                for i in range(args.elements):
+                    database.add(Cluster(f"c{i}", [Atom(name, value) for name, value in rows(i, args.particles)]))
+                database.export(compression=compression)
+
+            for label, func in (("writer", write), ("export", export)):
+                elapsed, peak = measure(func)
+                size = os.path.getsize(location)
+                print(f'{"C" if compression else "N"} {label:>6}: {size / 1e6:>7.1f} MB in {elapsed:>6.2f}s, '
+                      f'peak {peak / 1e6:>7.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from structures import DataBase, Cluster, Atom, Compression
+from tools import load, clean
+
+"""
+Compression ratio and throughput of every ZSTD level
+(export and load of a database, against level N)
+
+    python benchmarks/levels.py --elements 20000 --levels 1 3 9 19
+"""
+
+
+def fill(database, elements, seed=0):
+    rand = random.Random(seed)
+    words = ["".join(rand.choices(string.ascii_lowercase, k=rand.randint(3, 10))) for _ in range(500)]
+    for i in range(elements):
+        database.add(Cluster(f"element{i}", [Atom(f"atom{j}", " ".join(rand.choices(words, k=8)))
+                                             for j in range(4)]))
+
+
+def run(location, elements, compression):
+    database = DataBase("bench", location)
+    fill(database, elements)
+    start = time.perf_counter()
+    database.export(compression=compression)
+    exported = time.perf_counter() - start
+    clean()
+    start = time.perf_counter()
+    loaded = load(location)
+    assert len(loaded.elements) == elements
+    loaded = time.perf_counter() - start
+    clean()
+    return os.path.getsize(location), exported, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression ratio and throughput of every ZSTD level")
+    parser.add_argument("--elements", type=int, default=20000)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 3, 9, 19])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, "bench.db")
+        size, exported, loaded = run(location, args.elements, False)
+        print(f'{"level":>6} {"size":>12} {"ratio":>7} {"export MB/s":>12} {"load MB/s":>10}')
+        print(f'{"N":>6} {size:>12} {1:>7.2f} {size / exported / 1e6:>12.1f} {size / loaded / 1e6:>10.1f}')
+        for level in args.levels:
+            compressed, exported, loaded = run(location, args.elements, Compression(level))
+            # Throughput of the uncompressed data
+            print(f'{"C" + str(level):>6} {compressed:>12} {size / compressed:>7.2f} '
+                  f'{size / exported / 1e6:>12.1f} {size / loaded / 1e6:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
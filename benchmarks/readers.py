@@ -0,0 +1,86 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tools
+from structures import DataBase, Cluster, Atom, Jar
+
+"""
+Throughput of readers in concurrent mode, alone and while
+a writer replaces the file (see `concurrency`)
+
+    python benchmarks/readers.py --readers 4 --seconds 3
+"""
+
+
+def setup(location, elements):
+    database = DataBase("bench", location, concurrent=True)
+    for i in range(elements):
+        database.add(Cluster(f"c{i}", [Atom(f"a{j}", "v" * 50) for j in range(20)]))
+    database.add(Jar("counter", 0))
+    database.export()
+
+
+def reader(location, name, seconds, results):
+    database = DataBase("bench", location, concurrent=True)
+    operations = errors = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        try:
+            cluster = database.load(name=name)
+            found = list(database.find(name))
+            if len(cluster.particles) != 20 or len(found) != 1:
+                errors += 1
+            database.load(name="counter")
+        except Exception:
+            errors += 1
+        operations += 1
+        tools.clean()
+    results.put((operations, errors))
+
+
+def writer(location, seconds, results):
+    database = DataBase("bench", location, concurrent=True)
+    writes = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        writes += 1
+        database.update("counter", Jar("counter", list(range(writes % 50))))
+    results.put(writes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of concurrent readers under a writer")
+    parser.add_argument("--elements", type=int, default=200)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, "bench.db")
+        setup(location, args.elements)
+        name = f"c{args.elements * 3 // 4}"
+        for with_writer in (False, True):
+            results, writes = context.Queue(), context.Queue()
+            processes = [context.Process(target=reader, args=(location, name, args.seconds, results))
+                         for _ in range(args.readers)]
+            if with_writer:
+                processes.append(context.Process(target=writer, args=(location, args.seconds, writes)))
+            for process in processes:
+                process.start()
+            done = [results.get() for _ in range(args.readers)]
+            for process in processes:
+                process.join()
+            operations = sum(operations for operations, _ in done)
+            errors = sum(errors for _, errors in done)
+            label = f'{writes.get()} writes' if with_writer else "no writer"
+            print(f'{label:>12}: {operations / args.seconds:>8.1f} reads/s, {errors} errors')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+from contextlib import contextmanager
+from exceptions import Exceptions
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+"""
+Coordination between processes sharing a database file.
+Writers serialize on an advisory lock and never modify the
+file in place, they write a copy and atomically replace the
+original. Readers keep reading the (unlinked) file they opened,
+which is a consistent snapshot.
+"""
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """
+    Hold an advisory lock (flock) on `path`
+    :param shared:
+    Shared (read) lock, otherwise exclusive (write) lock
+    """
+    if fcntl is None:
+        raise Exceptions.UnsupportedError("Advisory file locks are not supported on this platform", "file_lock")
+    with open(path, 'a+b') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def copy_on_write(location, copy=True):
+    """
+    Exclusive write access to a new generation of `location`.
+    Yields the path of a temporary file, which replaces `location`
+    when the block succeeds (and is removed otherwise)
+    :param copy:
+    Whether to start from a copy of the current generation
+    (not needed when the file is rewritten entirely)
+    """
+    with file_lock(f'{location}.lock'):
+        tmp = f'{location}.{os.getpid()}.tmp'
+        if copy and os.path.exists(location):
+            shutil.copyfile(location, tmp)
+        try:
+            yield tmp
+            with open(tmp, 'rb') as file:
+                os.fsync(file.fileno())
+            os.replace(tmp, location)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+def snapshot_id(file):
+    """
+    Identity of the file generation behind an open file
+    """
+    info = os.fstat(file.fileno())
+    return info.st_ino, info.st_size, info.st_mtime_ns
@@ -0,0 +1,170 @@
+import mmap
+import zlib
+import struct
+from hashlib import blake2b
+from exceptions import Exceptions
+from records import encode_varint, decode_varint
+
+"""
+Block deltas (like rsync), for uploading a new version of a remote file.
+The old file is described by checksums of its blocks (a weak
+rolling Adler-32 and a BLAKE2 digest), the new one is matched against
+them at every offset, the delta copies the matching blocks and
+sends the rest of the file literally.
+A delta is a list of operations:
+    COPY, first block, amount of blocks
+    LITERAL, size, data
+"""
+
+COPY = 0x01
+LITERAL = 0x02
+MOD = 65521  # Of Adler-32
+SUM = struct.Struct(">I8s")  # Weak, strong checksum of a block
+
+
+def block_size(size):
+    """
+    Block size for a file of `size` bytes, about its square root
+    (the checksums and the delta of a small change are then both small)
+    """
+    return min(max(1 << int(size ** 0.5).bit_length(), 1 << 11), 1 << 17)
+
+
+def strong(data):
+    return blake2b(data, digest_size=8).digest()
+
+
+def file_digest(data):
+    """
+    Checksum of a whole file, the result of a patch is checked against it
+    """
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def checksums(file, block):
+    """
+    Checksums of the blocks of a file
+    :param file:
+    File (read from its position), bytes or a mapped file
+    :return:
+    Weak and strong checksum of every block (see `SUM`), as bytes
+    """
+    if isinstance(file, (bytes, bytearray, memoryview, mmap.mmap)):
+        chunks = (file[i:i + block] for i in range(0, len(file), block))
+    else:
+        chunks = iter(lambda: file.read(block), b"")
+    return b"".join(SUM.pack(zlib.adler32(chunk), strong(chunk)) for chunk in chunks)
+
+
+def diff(data, sums, block, basis_size, limit=None):
+    """
+    Delta of `data` (the new file) against the file of `sums`
+    :param sums:
+    See `checksums`
+    :param basis_size:
+    Size of the old file (its last block may be shorter)
+    :param limit:
+    Maximum amount of literal bytes, None for any
+    :return:
+    The delta, None if it exceeds `limit`
+    """
+    table = {}
+    count = len(sums) // SUM.size
+    for index in range(count):
+        weak, digest = SUM.unpack_from(sums, index * SUM.size)
+        if index < count - 1 or basis_size % block == 0:  # Full blocks (see the tail below)
+            table.setdefault(weak, []).append((digest, index))
+    delta = bytearray()
+    literals = 0
+    run = None  # First block, amount of the current copy
+
+    def flush_run():
+        if run is not None:
+            delta.extend(bytes((COPY,)) + encode_varint(run[0]) + encode_varint(run[1]))
+
+    def literal(start, end):
+        nonlocal run, literals
+        if end > start:
+            flush_run()
+            run = None
+            delta.extend(bytes((LITERAL,)) + encode_varint(end - start))
+            delta.extend(data[start:end])
+            literals += end - start
+
+    size = len(data)
+    start = pos = 0  # Start of the pending literal, position of the window
+    weak = None
+    while pos + block <= size:
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + block])
+        index = None
+        for digest, candidate in table.get(weak, ()):
+            if strong(data[pos:pos + block]) == digest:
+                index = candidate
+                break
+        if index is not None:
+            literal(start, pos)
+            if run is not None and run[0] + run[1] == index:
+                run = (run[0], run[1] + 1)
+            else:
+                flush_run()
+                run = (index, 1)
+            pos += block
+            start = pos
+            weak = None
+            continue
+        if limit is not None and literals + pos - start > limit:
+            return None
+        if pos + block < size:  # Roll the window by one byte
+            out, new = data[pos], data[pos + block]
+            a = ((weak & 0xffff) - out + new) % MOD
+            b = ((weak >> 16) - block * out + a - 1) % MOD
+            weak = (b << 16) | a
+        pos += 1
+    tail = basis_size % block
+    if tail and count and size - tail >= start:  # The last (short) block of the old file
+        digest = SUM.unpack_from(sums, (count - 1) * SUM.size)[1]
+        if strong(data[size - tail:]) == digest:
+            literal(start, size - tail)
+            if run is not None and run[0] + run[1] == count - 1:
+                run = (run[0], run[1] + 1)
+            else:
+                flush_run()
+                run = (count - 1, 1)
+            start = size
+    literal(start, size)
+    if limit is not None and literals > limit:
+        return None
+    flush_run()
+    return bytes(delta)
+
+
+def patch(basis, delta, block, target):
+    """
+    Write the new file, from the old one (`basis`) and a delta
+    :param basis:
+    The old file (opened, seekable)
+    :param target:
+    File the new one is written to
+    :return:
+    `file_digest` of the new file
+    """
+    digest = blake2b(digest_size=16)
+    pos = 0
+    while pos < len(delta):
+        op = delta[pos]
+        match op:
+            case 0x01:  # COPY
+                index, pos = decode_varint(delta, pos + 1)
+                amount, pos = decode_varint(delta, pos)
+                basis.seek(index * block)
+                data = basis.read(amount * block)
+            case 0x02:  # LITERAL
+                size, pos = decode_varint(delta, pos + 1)
+                data = delta[pos:pos + size]
+                pos += size
+            case _:
+                raise Exceptions.CorruptionError(f"Invalid delta operation {op}", "patch")
+        digest.update(data)
+        target.write(data)
+    return digest.hexdigest()
@@ -0,0 +1,258 @@
+import os
+import mmap
+import pickle
+import struct
+import zlib
+from exceptions import Exceptions
+
+"""
+Frozen (read-only) snapshots of a database, for lookups of single values.
+The file is a constant hash table in the style of CDB: 256 tables
+(chosen by the low byte of the hash of the key), every table is probed
+linearly, every slot points to a record (key and the position of its value).
+Keys are ``cluster/atom`` for Atoms and the title for Jars (the pickled object).
+Pins have no name, they are not in the snapshot.
+
+    magic, count, 256 x (table position, slots)
+    values and records: klen, vpos, vlen, key
+    tables: slots x (hash, record position), position 0 is an empty slot
+"""
+
+MAGIC = b"POKIFRZ1"
+HEAD = struct.Struct("<8sQ")
+TABLE = struct.Struct("<QQ")  # Position, slots
+RECORD = struct.Struct("<IQQ")  # Key size, value position, value size
+SLOT = struct.Struct("<QQ")  # Hash, record position
+TABLES = 256
+START = HEAD.size + TABLES * TABLE.size
+
+
+def key_hash(key):
+    return zlib.crc32(key)
+
+
+class FrozenWriter:
+    """
+    Writes a frozen snapshot, record by record
+    """
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+        self._slots = [[] for _ in range(TABLES)]
+        file.write(b"\0" * START)  # The tables are filled in by `close`
+
+    def value(self, value):
+        """
+        Write a value, which is shared by the records given its position
+        :return:
+        Position and size of the value
+        """
+        position = self.file.tell()
+        self.file.write(value)
+        return position, len(value)
+
+    def add(self, key, position, size):
+        """
+        Add a record for the value at `position` (see `value`)
+        """
+        key = key.encode()
+        record = self.file.tell()
+        self.file.write(RECORD.pack(len(key), position, size) + key)
+        h = key_hash(key)
+        self._slots[h & 0xff].append((h, record))
+        self.count += 1
+
+    def close(self):
+        tables = []
+        for entries in self._slots:
+            slots = len(entries) * 2
+            table = [(0, 0)] * slots
+            for h, record in entries:
+                slot = (h >> 8) % slots
+                while table[slot][1]:
+                    slot = (slot + 1) % slots
+                table[slot] = (h, record)
+            tables.append((self.file.tell(), slots))
+            self.file.write(b"".join(SLOT.pack(*entry) for entry in table))
+        self.file.seek(0)
+        self.file.write(HEAD.pack(MAGIC, self.count) + b"".join(TABLE.pack(*table) for table in tables))
+
+
+def freeze(database, path):
+    """
+    Write a frozen snapshot of a database (see `DataBase.freeze`)
+    :return:
+    Amount of keys
+    """
+    from tools import iter_elements, decode_cluster
+    from records import deref
+    from structures import Cluster, Pin, index
+    header = database._loaded_header
+    sealer = database._get_sealer() if header is not None else None
+    version = database.version
+    names = {}  # Particle -> position and size of its value (for the borrows)
+    done = set()
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        writer = FrozenWriter(file)
+
+        def located(name):
+            """
+            The value of a borrowed particle
+            """
+            if name in names:
+                return names[name]
+            particle = index.get(name)  # Not in the file (a loaded element which was not exported)
+            while particle is not None and particle.borrows is not None:
+                particle = index.get(particle.borrows)
+            if particle is None:
+                raise Exceptions.BorrowError(f"Unable to borrow '{name}', as it is not initialized", "freeze")
+            return writer.value(particle.value)
+
+        def particles(title, records):
+            for borrow, name, value, t in records:
+                if t and name is None:  # Pins are not in the snapshot
+                    continue
+                if borrow:
+                    names[name] = located(value)
+                else:
+                    names[name] = writer.value(value if type(value) is bytes else value.encode())
+                if t == 0:
+                    writer.add(f'{title}/{name}', *names[name])
+
+        def element(obj):
+            if isinstance(obj, Cluster):
+                particles(obj.title, ((particle.borrows is not None, name, particle.borrows or particle.value,
+                                       int(isinstance(particle, Pin))) for name, particle in obj.particles.items()))
+            else:
+                writer.add(obj.title, *writer.value(obj.eval()))
+
+        if header is not None:
+            stream = database._get_ready_file()
+            values = None
+            for head, name, content, _ in iter_elements(stream, header.size, header.idx):
+                if sealer is not None:
+                    content = sealer.open(content, head.decode(), name)
+                if head == b"+":
+                    values = content
+                elif name in database._deleted:
+                    continue
+                elif name in database.elements:  # The loaded version
+                    element(database.elements[name])
+                    done.add(name)
+                elif head == b"=":
+                    particles(name, decode_cluster(content, version, values))
+                else:
+                    writer.add(name, *writer.value(deref(content, values)))
+                done.add(name)
+            stream.close()
+        for name, obj in database.elements.items():  # Not in the file yet
+            if name not in done:
+                element(obj)
+        writer.close()
+    os.replace(tmp, path)
+    return writer.count
+
+
+class FrozenDataBase:
+    """
+    Reader of a frozen snapshot, the file is mapped into memory
+    (shared by all processes which read it), a lookup is a single
+    hash probe, the values are slices of the mapping (no copy),
+    they stay valid after the database is closed
+    ````python
+    with FrozenDataBase("my_db.frozen") as frozen:
+        value = frozen["cluster/atom"]  # memoryview
+        obj = frozen.jar("jar")
+    print(bytes(value))
+    ````
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file
+            self._file.close()
+            raise Exceptions.HeaderError(f"'{path}' is not a frozen database", "FrozenDataBase")
+        magic, self.count = HEAD.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise Exceptions.HeaderError(f"'{path}' is not a frozen database", "FrozenDataBase")
+        self._view = memoryview(self._map)
+        self._tables = [TABLE.unpack_from(self._map, HEAD.size + i * TABLE.size) for i in range(TABLES)]
+
+    def get(self, key, default=None):
+        """
+        :param key:
+        ``cluster/atom`` or the title of a Jar (str or bytes)
+        :return:
+        The value (memoryview), `default` if there is no such key
+        """
+        if type(key) is str:
+            key = key.encode()
+        h = key_hash(key)
+        position, slots = self._tables[h & 0xff]
+        if not slots:
+            return default
+        slot = (h >> 8) % slots
+        for _ in range(slots):
+            _h, record = SLOT.unpack_from(self._map, position + slot * SLOT.size)
+            if not record:
+                return default
+            if _h == h:
+                size, value, length = RECORD.unpack_from(self._map, record)
+                start = record + RECORD.size
+                if self._map[start:start + size] == key:
+                    return self._view[value:value + length]
+            slot = (slot + 1) % slots
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def jar(self, title):
+        """
+        Unpickled object of a Jar
+        """
+        return pickle.loads(self[title])
+
+    def keys(self):
+        """
+        Generator of all keys (in the order they were written)
+        """
+        for position, slots in self._tables:
+            for slot in range(slots):
+                _, record = SLOT.unpack_from(self._map, position + slot * SLOT.size)
+                if record:
+                    size = RECORD.unpack_from(self._map, record)[0]
+                    yield bytes(self._map[record + RECORD.size:record + RECORD.size + size]).decode()
+
+    def close(self):
+        """
+        Close the file, the mapping is released when no value
+        (memoryview) of it is referenced anymore, so the values
+        which are kept stay valid
+        """
+        if hasattr(self, "_view"):
+            self._view.release()
+        try:
+            self._map.close()
+        except BufferError:  # Values are still referenced, unmapped when they are collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,191 @@
+import io
+import queue
+import threading
+
+"""
+Shared file handles.
+A `DataBase` keeps one handle open for its whole lifetime,
+every operation reads through its own `PositionedReader`,
+so no seek state is shared between threads.
+Streams which are expensive to produce (decompression) are read
+ahead by a thread, see `PipelinedReader`.
+"""
+
+PIPELINE_CHUNK = 1 << 16  # First chunk of a `PipelinedReader`, they double up to PIPELINE_MAX_CHUNK
+PIPELINE_MAX_CHUNK = 1 << 20
+PIPELINE_DEPTH = 4  # Chunks read ahead
+
+
+class PositionedReader(io.RawIOBase):
+    """
+    Raw view of a shared handle with its own position,
+    every read is a positioned read (pread)
+    """
+    def __init__(self, read_range, position=0, fileno=None):
+        """
+        :param read_range:
+        Callable (offset, size) -> bytes
+        :param fileno:
+        File descriptor of the shared handle (if there is one)
+        """
+        super().__init__()
+        self._read_range = read_range
+        self._fileno = fileno
+        self.position = position
+
+    def readinto(self, buffer):
+        data = self._read_range(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        match whence:
+            case 0:
+                self.position = offset
+            case 1:
+                self.position += offset
+            case _:
+                raise io.UnsupportedOperation("PositionedReader can not seek from the end")
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def fileno(self):
+        if self._fileno is None:
+            raise io.UnsupportedOperation("PositionedReader has no file descriptor")
+        return self._fileno
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+
+def positioned_reader(read_range, position=0, fileno=None, bufsize=65536):
+    """
+    Buffered `PositionedReader`
+    """
+    return io.BufferedReader(PositionedReader(read_range, position, fileno), bufsize)
+
+
+def _produce(stream, chunks, stop):
+    """
+    Thread of a `PipelinedReader`, it only knows the queue (an
+    abandoned reader is collected, which stops the thread)
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    size = PIPELINE_CHUNK
+    try:
+        while True:
+            data = stream.read(size)
+            if not put(data) or not data:
+                break
+            size = min(size * 2, PIPELINE_MAX_CHUNK)  # Small at first, for partial reads
+    except BaseException as ex:
+        put(ex)
+    finally:
+        stream.close()
+
+
+class PipelinedReader(io.RawIOBase):
+    """
+    Raw reader of a stream which is read by a background
+    thread, in chunks, into a bounded queue, so producing the
+    data (e.g. decompressing it, which releases the GIL) and
+    parsing it overlap. Seeks forward only
+    """
+    def __init__(self, stream, depth=PIPELINE_DEPTH):
+        """
+        :param stream:
+        Readable stream, it is closed by the thread (when it is
+        read to the end or the reader is closed)
+        """
+        super().__init__()
+        self._chunks = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b"")
+        self._offset = 0
+        self._eof = False
+        self.position = 0
+        threading.Thread(target=_produce, args=(stream, self._chunks, self._stop), daemon=True).start()
+
+    def _next(self):
+        """
+        Wait for the next chunk
+        :return:
+        False at the end of the stream
+        """
+        if self._eof:
+            return False
+        item = self._chunks.get()
+        if isinstance(item, BaseException):
+            self._eof = True
+            raise item
+        if not item:
+            self._eof = True
+            return False
+        self._chunk = memoryview(item)
+        self._offset = 0
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._chunk):
+            if not self._next():
+                return 0
+        size = min(len(buffer), len(self._chunk) - self._offset)
+        buffer[:size] = self._chunk[self._offset:self._offset + size]
+        self._offset += size
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=0):
+        match whence:
+            case 0:
+                skip = offset - self.position
+            case 1:
+                skip = offset
+            case _:
+                raise io.UnsupportedOperation("PipelinedReader can not seek from the end")
+        if skip < 0:
+            raise io.UnsupportedOperation("PipelinedReader can not seek backwards")
+        while skip > 0:
+            if self._offset >= len(self._chunk) and not self._next():
+                break
+            step = min(skip, len(self._chunk) - self._offset)
+            self._offset += step
+            self.position += step
+            skip -= step
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._chunk = memoryview(b"")
+        super().close()
+
+
+def pipelined_reader(stream, bufsize=65536):
+    """
+    Buffered `PipelinedReader`
+    """
+    return io.BufferedReader(PipelinedReader(stream), bufsize)
@@ -1,45 +1,290 @@
-import io
+import os
+import sys
+import time
+import getpass
+import argparse
+import statistics
+import subprocess
 from exceptions import Exceptions
-from structures import Atom, Cluster, Jar, Pin
-from remote import Connector, SSHCredentials
+from structures import DataBase
+from stats import Stats
 
+"""
+Command-line tool, for the layout of a database
+and where the time of its operations goes
+    python poki.py inspect <database> [--top N]
+    python poki.py profile <database> [element ...] [--ops load,find,update] [--repeat N]
+    python poki.py startup [--repeat N]
+A remote database is given with --remote user@server, the
+password is taken from POKI_PASSWORD (or asked for).
+"""
 
-def create_connector():
-    con = Connector(SSHCredentials("server.addr", "username", "password"))
-    con.connect()
-    return con
+OPS = ("load", "find", "update")
+# Loaded on first use (remote, compressed or secured databases, find), not by `import structures, tools`
+LAZY = ("paramiko", "zstandard", "regex", "cryptography", "asyncio", "multiprocessing")
+STARTUP = ("import sys, time\n"
+           "start = time.perf_counter()\n"
+           "import structures, tools\n"
+           "print(time.perf_counter() - start)\n"
+           "print(' '.join(module for module in {lazy} if module in sys.modules))")
 
 
-con = create_connector()
+def human(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f'{size:.0f} {unit}' if unit == "B" else f'{size:.1f} {unit}'
+        size /= 1024
 
 
-def db_make():
-    _ = Atom("hello", "world")
-    parts = [_, Atom("msg", _.borrow())]
-    cluster = Cluster("words", parts)
-    cluster.add(Pin("hello"))
-    db = con.open_database("database", "database.db")
+def open_database(args, stats=None):
+    """
+    :return:
+    The `DataBase` and the `Connector` (None for a local database)
+    """
+    key = bytes.fromhex(args.key) if args.key else None
+    connector = None
+    if args.remote is None:
+        database = DataBase(args.database, args.database, stats=stats, key=key)
+    else:
+        from remote import Connector, SSHCredentials
+        username, server = args.remote.split("@", 1)
+        password = os.environ.get("POKI_PASSWORD") or getpass.getpass(f'Password of {args.remote}: ')
+        connector = Connector(SSHCredentials(server, username, password), stats=stats)
+        connector.connect()
+        database = connector.open_database(args.database, args.database, key)
+    if database._loaded_header is None:
+        raise Exceptions.HeaderError(f"There is no database '{args.database}'", "open_database")
+    return database, connector
 
-    db.add(cluster)
-    jar = Jar("string", io.StringIO("Hello World, string!!"))  # The size of this is 69, nice
-    db.add(jar)
 
-    db.export()
+def scan(database):
+    """
+    Walk all blocks of a database (also the dead ones)
+    :return:
+    List of dicts (type, name, size (of the block),
+    stored (size of the content), plain (size of the decrypted /
+    decompressed content, None if unknown), particles, borrows)
+    """
+    from tools import get_sub_header, decode_cluster
+    header = database._loaded_header
+    sealer = database._get_sealer() if database.key is not None else None
+    size = header.size
+    idx = header.idx
+    file = database._get_ready_file()
+    blocks = []
+    while size > idx:
+        head = file.read(1)
+        if head not in (b"=", b"?", b"-", b"+"):
+            if head == b"":
+                break
+            raise Exceptions.SubHeadError(f"Invalid sub-header '{head.decode()}'", "scan")
+        start = idx
+        idx, _size, name, _ = get_sub_header(file, idx + 1, size)
+        block = {"type": head.decode(), "name": name, "size": idx - start + _size + 1, "stored": _size,
+                 "plain": _size, "particles": None, "borrows": None}
+        sealed = header.params.get("enc") and head != b"-"
+        readable = not sealed or sealer is not None
+        if readable and (head == b"=" or sealed):
+            content = file.read(_size)
+            if sealed:
+                content = sealer.open(content, head.decode(), name)
+                block["plain"] = len(content)
+            if head == b"=":
+                records = decode_cluster(content, database.version)
+                block["particles"] = len(records)
+                block["borrows"] = sum(1 for record in records if record[0])
+            file.read(1)
+        else:
+            if sealed:  # Unknown without the key
+                block["plain"] = None
+            file.seek(_size + 1, 1)
+        idx += _size + 1
+        blocks.append(block)
+    file.close()
+    return blocks
 
 
-def main():
-    db_make()
-    db = con.open_database("database", "database.db")
-    element = db.load(name="words")
-    element.add(element[1].borrow())
+def inspect(args):
+    database, connector = open_database(args)
+    header = database._loaded_header
+    blocks = scan(database)
+    live = [block for block in blocks if block["type"] in "=?"]
+    dead = [block for block in blocks if block["type"] == "-"]
+    segment = [block for block in blocks if block["type"] == "+"]
+    clusters = [block for block in live if block["type"] == "="]
+    file_size = database.get_size()
 
-    gen = db.find("words")
-    for i in gen:
-        print(i)
+    print(f"{args.database}  (level {header.level}, version {database.version}, name '{header.name}')")
+    print(f"file size      {human(file_size)}")
+    print(f"elements       {len(live)} ({len(clusters)} clusters, {len(live) - len(clusters)} jars)")
+    dead_size = sum(block["size"] for block in dead)
+    print(f"dead blocks    {len(dead)} ({human(dead_size)}, {dead_size / max(file_size, 1):.1%} of the file)")
+    if segment:
+        print(f"value segment  {human(segment[0]['stored'])} (shared values, {segment[0]['stored'] / max(file_size, 1):.1%}"
+              f" of the file)")
 
-    print(db)
+    if header.level == "C" or header.level == "X" and not header.params.get("enc"):
+        ratio = (header.size - header.idx) / max(file_size - header.idx, 1)
+        print(f"compression    {ratio:.2f}x (as a whole, {header.params})")
+    elif header.level == "X":
+        if all(block["plain"] is not None for block in live):
+            ratio = sum(block["plain"] for block in live) / max(sum(block["stored"] for block in live), 1)
+            print(f"compression    {ratio:.2f}x (per element, encrypted)")
+        else:
+            print("compression    unknown (per element, encrypted, --key is required)")
+    else:
+        print("compression    none")
 
-    con.close()
+    counts = [block["particles"] for block in clusters if block["particles"] is not None]
+    if counts:
+        borrows = sum(block["borrows"] for block in clusters if block["borrows"] is not None)
+        print(f"particles      {sum(counts)} (per cluster: min {min(counts)}, median {statistics.median(counts):g}, "
+              f"max {max(counts)}), {borrows} borrowed")
+
+    print("element sizes")
+    buckets = {}
+    for block in live:
+        bucket = 1 << max(block["stored"] - 1, 0).bit_length()
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    width = max(buckets.values(), default=1)
+    for bucket in sorted(buckets):
+        print(f"  <= {human(bucket):>8}  {buckets[bucket]:>7}  {'#' * max(1, 40 * buckets[bucket] // width)}")
+
+    print("largest elements")
+    print(f"  {'name':<30} {'type':<8} {'size':>10} {'particles':>10} {'borrows':>8}")
+    for block in sorted(live, key=lambda b: b["stored"], reverse=True)[:args.top]:
+        kind = "cluster" if block["type"] == "=" else "jar"
+        particles = "" if block["particles"] is None else block["particles"]
+        borrows = "" if block["borrows"] is None else block["borrows"]
+        print(f"  {block['name']:<30} {kind:<8} {human(block['stored']):>10} {particles:>10} {borrows:>8}")
+
+    database.close()
+    if connector is not None:
+        connector.close()
+
+
+def stored_block(database, name):
+    """
+    The block of an element as it is stored (sub-header and content),
+    None if the blocks of the database can not be rewritten in place
+    """
+    if not database._in_place():
+        return None
+    header = database._loaded_header
+    idx = header.idx
+    file = database._get_ready_file()
+    try:
+        while True:
+            _type, _size, idx, _name, _, start = database._get_sub_header_item(file, header.size, idx)
+            if _type is None:
+                raise Exceptions.SubHeadError(f"There is no element '{name}'", "stored_block")
+            if _name == name:
+                return database._read_range(start, idx + _size - start)
+            file.seek(_size + 1, 1)
+            idx += _size + 1
+    finally:
+        file.close()
+
+
+def run(database, op, name, block=None):
+    match op:
+        case "load":
+            database.load(name=name)
+        case "find":
+            list(database.find(name))
+        case "update":  # The block is written back as it is stored (see `stored_block`), the data is not changed
+            database._replace_block(name, lambda: block)
+            database.reload()
+
+
+def profile(args):
+    from tools import clean
+    stats = Stats()
+    database, connector = open_database(args, stats)
+    ops = args.ops.split(",")
+    for op in ops:
+        if op not in OPS:
+            raise Exceptions.UnsupportedError(f"'{op}' is not one of {', '.join(OPS)}", "profile")
+    names = args.elements
+    if not names:  # The largest elements
+        blocks = [block for block in scan(database) if block["type"] in "=?"]
+        names = [block["name"] for block in sorted(blocks, key=lambda b: b["stored"], reverse=True)[:3]]
+
+    print(f"{args.database}  (level {database._loaded_header.level}, {human(database.get_size())}), "
+          f"{args.repeat} runs each")
+    for name in names:
+        for op in ops:
+            times = []
+            try:
+                block = stored_block(database, name) if op == "update" else None
+                stats.reset()
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    run(database, op, name, block)
+                    times.append(time.perf_counter() - start)
+                    clean()
+            except Exceptions.BaseException as ex:  # E.g. a borrow from an element which is not loaded
+                clean()
+                print(f"{op} {name}: {ex.__class__.__name__} : {ex.msg}")
+                continue
+            total = sum(times)
+            snapshot = stats.snapshot()
+            print(f"{op} {name}: avg {total / len(times) * 1000:.3f} ms, min {min(times) * 1000:.3f} ms "
+                  f"| read {human(snapshot['bytes_read'] / args.repeat)} in {snapshot['reads'] / args.repeat:g} reads, "
+                  f"{snapshot['round_trips'] / args.repeat:g} round-trips, "
+                  f"wrote {human(snapshot['bytes_written'] / args.repeat)}")
+            phases = sorted(snapshot["phases"].items(), key=lambda item: item[1][1], reverse=True)
+            for phase, (calls, seconds) in phases:
+                print(f"    {phase:<28} {calls / args.repeat:>8g} calls {seconds / args.repeat * 1000:>10.3f} ms "
+                      f"{seconds / max(total, 1e-12):>7.1%}")
+
+    database.close()
+    if connector is not None:
+        connector.close()
+
+
+def startup(args):
+    """
+    Import time of the modules a local database needs, every
+    run in a new interpreter, fails if a lazy dependency is imported
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    eager = set()
+    for _ in range(args.repeat):
+        out = subprocess.run([sys.executable, "-c", STARTUP.format(lazy=LAZY)], cwd=here, capture_output=True,
+                             text=True, check=True).stdout.split("\n")
+        times.append(float(out[0]))
+        eager.update(out[1].split())
+    print(f"import structures, tools: median {statistics.median(times) * 1000:.1f} ms, "
+          f"min {min(times) * 1000:.1f} ms ({args.repeat} runs)")
+    print(f"lazy dependencies imported: {', '.join(sorted(eager)) or 'none'}")
+    if eager:
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="poki", description="Inspect and profile poki databases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("inspect", "profile"):
+        sub = commands.add_parser(command)
+        sub.add_argument("database", help="Filename of the database")
+        sub.add_argument("--remote", metavar="USER@SERVER", help="The database is on this SSH-server")
+        sub.add_argument("--key", help="Key of a secured database (hex)")
+    commands.choices["inspect"].add_argument("--top", type=int, default=10, help="Amount of largest elements listed")
+    commands.choices["profile"].add_argument("elements", nargs="*", help="Elements (default: the 3 largest)")
+    commands.choices["profile"].add_argument("--ops", default="load,find",
+                                             help="Operations, of load, find, update (rewrites the element)")
+    commands.choices["profile"].add_argument("--repeat", type=int, default=5, help="Runs of every operation")
+    commands.add_parser("startup").add_argument("--repeat", type=int, default=10, help="Amount of interpreters")
+    args = parser.parse_args(argv)
+    match args.command:
+        case "inspect":
+            inspect(args)
+        case "profile":
+            profile(args)
+        case "startup":
+            startup(args)
 
 
 if __name__ == '__main__':
@@ -50,6 +295,7 @@ if __name__ == '__main__':
             print(f'{ex.__class__.__name__} [{ex.head}] : {ex.msg} (in {ex.level})')
         except RecursionError as ex:
             print(f'Internal Error (while formatting error message) : {str(ex)}')
+        sys.exit(1)
     except Exception as ex:
         print(f'Internal Error : {str(ex)}')
         raise ex
@@ -0,0 +1,213 @@
+from hashlib import blake2b
+from exceptions import Exceptions
+
+"""
+Encoding of the particles (Atoms and Pins) of a Cluster.
+Version 1 delimits the fields (``name;value\\0`` and ``!value\\0``,
+``@`` in front of a borrowed name), so it must be scanned byte by byte.
+Version 2 starts every particle with a type tag and prefixes every
+field with its length (varint), so values may contain any byte
+and a field is skipped without reading it.
+A value which occurs more than once may be stored in the value
+segment of the file (see `ValueTable`), the record (or the content
+of a Jar) then only refers to it (offset and size, as varints).
+"""
+
+VERSION = 2  # Version of new databases
+
+ATOM = 0x01  # Tag, name, value
+PIN = 0x02  # Tag, value
+BORROW = 0x10  # Flag, the value is the name of the borrowed particle
+REF = 0x20  # Flag, the value is in the value segment (also the first byte of a Jar, which refers to it)
+MIN_SHARED = 8  # Shorter values are always stored in the record
+
+
+def encode_varint(number):
+    """
+    Unsigned LEB128
+    """
+    res = bytearray()
+    while number > 0x7f:
+        res.append(number & 0x7f | 0x80)
+        number >>= 7
+    res.append(number)
+    return bytes(res)
+
+
+def decode_varint(data, pos):
+    """
+    :return:
+    The number and the position after it
+    """
+    number = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise Exceptions.CorruptionError("Truncated length", "decode_varint")
+        b = data[pos]
+        pos += 1
+        number |= (b & 0x7f) << shift
+        if b < 0x80:
+            return number, pos
+        shift += 7
+
+
+def _bytes(value):
+    return value.encode() if type(value) is str else bytes(value)
+
+
+class ValueTable:
+    """
+    Values (and Jar payloads) which occur more than once in a database,
+    built by a first pass over all of them (`count`), every distinct one
+    is stored once in the value segment (see `DataBase.export(dedup=True)`)
+    """
+    def __init__(self, min_size=MIN_SHARED):
+        self.min_size = min_size
+        self.segment = bytearray()
+        self._refs = {}
+        self._seen = set()
+
+    @staticmethod
+    def _key(value):
+        return blake2b(value, digest_size=16).digest()
+
+    def count(self, value):
+        """
+        Register an occurrence of `value`
+        """
+        value = _bytes(value)
+        if len(value) < self.min_size:
+            return
+        key = self._key(value)
+        if key in self._refs:
+            return
+        if key in self._seen:  # Second occurrence
+            self._refs[key] = (len(self.segment), len(value))
+            self.segment += value
+            self._seen.discard(key)
+        else:
+            self._seen.add(key)
+
+    def ref(self, value):
+        """
+        :return:
+        Offset and size of `value` in the segment,
+        None if it is stored in the record
+        """
+        if len(value) < self.min_size or not self._refs:
+            return None
+        return self._refs.get(self._key(value))
+
+    def __len__(self):
+        return len(self._refs)
+
+
+def encode_ref(offset, size):
+    """
+    Content of a Jar, which refers to the value segment
+    """
+    return bytes((REF,)) + encode_varint(offset) + encode_varint(size)
+
+
+def deref(content, values):
+    """
+    Content of a Jar, looked up in the value segment if it refers to it
+    (a pickle never starts with `REF`)
+    :param values:
+    Content of the value segment, None if the file has none
+    """
+    if values is None or content[:1] != bytes((REF,)):
+        return content
+    offset, pos = decode_varint(content, 1)
+    size, pos = decode_varint(content, pos)
+    return bytes(values[offset:offset + size])
+
+
+def encode_record(borrow, name, value, t, version=VERSION, values: ValueTable = None):
+    """
+    Encode a single particle
+    :param borrow:
+    Whether `value` is the name of the borrowed particle
+    :param name:
+    Name of the Atom (Pins are not named in the file)
+    :param t:
+    0 for an Atom, 1 for a Pin
+    :param values:
+    `ValueTable` of the export, None to store the value in the record
+    """
+    value = _bytes(value)
+    if version < 2:
+        if borrow:
+            value = b'@' + value
+        if t == 1:
+            return b'!' + value + b'\0'
+        return _bytes(name) + b';' + value + b'\0'
+    tag = (PIN if t == 1 else ATOM) | (BORROW if borrow else 0)
+    ref = None if borrow or values is None else values.ref(value)
+    if ref is not None:
+        tag |= REF
+    res = bytes((tag,))
+    if t == 0:
+        name = _bytes(name)
+        res += encode_varint(len(name)) + name
+    if ref is not None:
+        return res + encode_varint(ref[0]) + encode_varint(ref[1])
+    return res + encode_varint(len(value)) + value
+
+
+def encode_records(records, version=VERSION, values: ValueTable = None):
+    """
+    Encode the content of a Cluster
+    :param records:
+    Iterable of (borrow, name, value, type), see `encode_record`
+    """
+    encoded = (encode_record(*record, version, values) for record in records)
+    if version < 2:
+        return b"\n".join(encoded)
+    return b"".join(encoded)
+
+
+def decode_records(data, values=None):
+    """
+    Decode the content of a (version 2) Cluster
+    :param values:
+    Content of the value segment, None to leave the references
+    to it as (offset, size) (see `tools.make_particles`)
+    :return:
+    List of (borrow, name, value, type), the value of a
+    borrow is the name of the borrowed particle (str),
+    otherwise the raw value (bytes)
+    """
+    records = []
+    pos = 0
+    end = len(data)
+    while end > pos:
+        tag = data[pos]
+        pos += 1
+        borrow = bool(tag & BORROW)
+        match tag & ~(BORROW | REF):
+            case 0x01:  # ATOM
+                size, pos = decode_varint(data, pos)
+                name = bytes(data[pos:pos + size]).decode()
+                pos += size
+                t = 0
+            case 0x02:  # PIN
+                name = None
+                t = 1
+            case _:
+                raise Exceptions.CorruptionError(f"Invalid particle tag {tag}", "decode_records")
+        if tag & REF:
+            offset, pos = decode_varint(data, pos)
+            size, pos = decode_varint(data, pos)
+            value = (offset, size) if values is None else bytes(values[offset:offset + size])
+            records.append((borrow, name, value, t))
+            continue
+        size, pos = decode_varint(data, pos)
+        if pos + size > end:
+            raise Exceptions.CorruptionError("Truncated value", "decode_records")
+        value = bytes(data[pos:pos + size])
+        pos += size
+        records.append((borrow, name, value.decode() if borrow else value, t))
+
+    return records
@@ -1,5 +1,11 @@
-import paramiko
+import mmap
+import queue
+import shlex
+import tempfile
 from exceptions import Exceptions
+from stats import Stats
+from storage import Storage, EXPORT_BUFSIZE
+from delta import block_size, checksums, diff, file_digest
 from dataclasses import dataclass
 
 
@@ -44,33 +50,200 @@ class SSHCredentials:
         return self.server, self.username, self.password
 
 
-class RemoteDataBaseAccessor:
+class RemoteDataBaseAccessor(Storage):
     """
-    The RemoteDataBaseAccessor (RDA) is a wrapper
-    around an SFTP file
+    The RemoteDataBaseAccessor (RDA) is the storage
+    backend of a file on an SSH-server (SFTP)
     """
+    label = "REMOTE"
 
-    def __init__(self, sftp, filename):
-        self.sftp: paramiko.SFTPClient = sftp
-        self.filename = filename
+    def __init__(self, sftp, filename, stats: Stats = None, agent=None, manifests=None):
+        """
+        :param agent:
+        Callable, starts an `agent.Agent` for a filename, exports are
+        then uploaded as a delta against the old file (see `delta`),
+        None to upload them as a whole
+        :param manifests:
+        Dict-like, filename -> checksums of its last upload
+        (they spare the agent reading the old file)
+        """
+        super().__init__(filename, stats)
+        self.sftp = sftp  # paramiko.SFTPClient
+        self.agent = agent
+        self.manifests = {} if manifests is None else manifests
+        self._handles = queue.LifoQueue()
 
-    @property
-    def size(self):
-        info = self.sftp.stat(self.filename)
-        return info.st_size
+    def _round_trip(self):
+        if self.stats is not None:
+            self.stats.count("round_trips")
+
+    def _count_requests(self, file):
+        """
+        Count every request of the SFTP file as a round-trip
+        """
+        def counted(func):
+            def _(*args):
+                self._round_trip()
+                return func(*args)
+            return _
+
+        file._read = counted(file._read)
+        file._write = counted(file._write)
+        return file
+
+    def _trace(self, file):
+        """
+        See `_count_requests`, (buffered) reads and
+        writes are counted by the `TracedFile`
+        """
+        return self.stats.wrap(self._count_requests(file))
+
+    def read_range(self, offset, size):
+        """
+        Read `size` bytes at `offset`, through a pool
+        of handles (threads never share the position of a handle)
+        """
+        try:
+            file = self._handles.get_nowait()
+        except queue.Empty:
+            self._round_trip()
+            file = self.sftp.open(self.filename, 'rb')
+            if self.stats is not None:
+                self._count_requests(file)
+        try:
+            file.seek(offset)
+            return file.read(size)
+        finally:
+            self._handles.put(file)
+
+    def close_handles(self):
+        """
+        Close the handles of `read_range`
+        """
+        while True:
+            try:
+                self._handles.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stat(self, filename=None):
+        self._round_trip()
+        try:
+            return self.sftp.stat(self.filename if filename is None else filename).st_size
+        except FileNotFoundError:
+            return -1
 
     def open(self, filename=None, mode="rb", bufsize=-1):
         if filename is None:
             filename = self.filename
-        return self.sftp.open(filename, mode, bufsize)
+        self._round_trip()
+        file = self.sftp.open(filename, mode, bufsize)
+        if self.stats is not None:
+            return self._trace(file)
+        return file
+
+    def open_stream(self, filename=None):
+        if self.agent is not None and filename not in (None, self.filename) and self.stat() > 0:
+            return DeltaFile(self, filename)  # A new version of the file (see `atomic_write`)
+        # Large buffered writes, which do not wait for the server to acknowledge them
+        file = self.open(filename, 'wb', EXPORT_BUFSIZE)
+        file.set_pipelined(True)
+        return file
+
+    def _manifest(self, attributes):
+        """
+        Block size and checksums of the file from its last
+        upload, None if it has been changed since
+        """
+        manifest = self.manifests.get(self.filename)
+        if manifest is None or (manifest["size"], manifest["mtime"]) != (attributes.st_size, attributes.st_mtime):
+            return None
+        return manifest["block"], manifest["sums"]
 
-    def exists(self, filename=None):
-        if filename is None:
-            filename = self.filename
-        return filename in self.sftp.listdir()
+    def upload(self, data, filename):
+        """
+        Write `data` (the new version of the file) to `filename`, only
+        the blocks which differ from the file are sent, if the agent
+        can be started, else (or if most of the file changed) all of it
+        """
+        import paramiko
+        self._round_trip()
+        attributes = self.sftp.stat(self.filename)
+        sent = False
+        try:
+            agent = self.agent(self.filename)
+        except (Exceptions.BaseException, paramiko.SSHException):  # No agent on the server
+            agent = None
+        if agent is not None:
+            try:
+                block, sums = self._manifest(attributes) or (block_size(attributes.st_size), None)
+                if sums is None:
+                    _, sums = agent.checksums(block)
+                delta = diff(data, sums, block, attributes.st_size, len(data) // 2)
+                if delta is not None:
+                    agent.patch(filename, block, delta, file_digest(data))
+                    sent = True
+            except Exceptions.CorruptionError:  # The file changed since its checksums
+                pass
+            finally:
+                agent.close()
+        if not sent:
+            with self.open(filename, 'wb', EXPORT_BUFSIZE) as file:
+                file.set_pipelined(True)
+                for i in range(0, len(data), EXPORT_BUFSIZE):
+                    file.write(data[i:i + EXPORT_BUFSIZE])
+        self._round_trip()
+        block = block_size(len(data))
+        self.manifests[self.filename] = {"size": len(data), "mtime": self.sftp.stat(filename).st_mtime,
+                                         "block": block, "sums": checksums(data, block)}
+
+    def rename(self, src, dst):
+        self._round_trip()
+        try:
+            self.sftp.posix_rename(src, dst)
+        except IOError:  # Server without the posix-rename extension
+            if self.exists(dst):
+                self.remove(dst)
+            self._round_trip()
+            self.sftp.rename(src, dst)
+
+    def remove(self, filename):
+        self._round_trip()
+        self.sftp.remove(filename)
+
+
+class DeltaFile:
+    """
+    Export of a remote file with delta uploads, it is written
+    to a local temporary file and uploaded when it is closed
+    (see `RemoteDataBaseAccessor.upload`)
+    """
+    def __init__(self, storage: RemoteDataBaseAccessor, filename):
+        self.storage = storage
+        self.filename = filename
+        self.file = tempfile.TemporaryFile()
 
-    def __repr__(self):
-        return f'{self.filename} [{self.size}]'
+    def __getattr__(self, item):
+        return getattr(self.file, item)
+
+    def close(self):
+        if self.file.closed:
+            return
+        with self.file:
+            self.file.flush()
+            if self.file.seek(0, 2) == 0:
+                self.storage.upload(b"", self.filename)
+                return
+            with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.storage.upload(data, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:  # Nothing is uploaded
+            self.file.close()
+        self.close()
 
 
 class Connector:
@@ -78,18 +251,33 @@ class Connector:
     The connector allows to connect to an SSH-server an open databases on it
     """
 
-    def __init__(self, credentials: SSHCredentials, join=None):
+    def __init__(self, credentials: SSHCredentials, join=None, stats: Stats = None, delta=False, manifests=None):
+        """
+        :param stats:
+        Optional `Stats`, shared by all databases opened through this connector
+        :param delta:
+        Upload exports as a delta against the old file (see `delta`),
+        the agent is started on the server for it (see `open_agent`)
+        :param manifests:
+        Dict-like, keeps the checksums of the uploaded files
+        (e.g. a `shelve`, to keep them between sessions)
+        """
+        import paramiko  # Loaded with the first connector
         self.server, self.username, self.password = credentials()
+        self.stats = stats
+        self.delta = delta
+        self.manifests = {} if manifests is None else manifests
+        self._agent_folder = None
 
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self._join = join
 
         self._connected = False
-        self.sftp: paramiko.SFTPClient = None
+        self.sftp = None  # paramiko.SFTPClient (see `connect`)
 
     def _get_sftp(self):
-        self.sftp: paramiko.SFTPClient = self.client.open_sftp()
+        self.sftp = self.client.open_sftp()
 
     def connect(self):
         if self.connected:
@@ -117,9 +305,10 @@ class Connector:
         self.sftp.chdir(folder)
 
     def create_RDA(self, filename):
-        return RemoteDataBaseAccessor(self.sftp, filename)
+        return RemoteDataBaseAccessor(self.sftp, filename, self.stats, self.open_agent if self.delta else None,
+                                      self.manifests)
 
-    def get_database(self, filename, maintain_borrows=False, _clean=True):
+    def get_database(self, filename, maintain_borrows=False, _clean=True, key=None):
         """
         Get the database as fully loaded by ``tools.load()``
         :param filename:
@@ -128,26 +317,69 @@ class Connector:
         See ``tools.load()``
         :param maintain_borrows:
         See ``tools.load()``
+        :param key:
+        See ``tools.load()``
         :return:
         Loaded DataBase
         """
         from tools import load
         RDA = self.create_RDA(filename)
-        return load(filename, maintain_borrows, _clean, RDA)
+        return load(filename, maintain_borrows, _clean, RDA, self.stats, key=key)
 
-    def open_database(self, name, filename):
+    def open_database(self, name, filename, key=None):
         """
         Get the database ``tools.load()``
         :param name:
         Name of the database (may be the filename)
         :param filename:
         Filename of the database
+        :param key:
+        Key of a secured database
         :return:
         Loaded DataBase
         """
         from structures import DataBase
         RDA = self.create_RDA(filename)
-        return DataBase(name, filename, RDA)
+        return DataBase(name, filename, RDA, self.stats, key=key)
+
+    def open_agent(self, filename, key=None, python="python3", folder=None):
+        """
+        Start a query agent next to the database (see ``agent.Agent``),
+        the elements are selected on the server, only the matching
+        ones are sent back
+        :param filename:
+        Filename of the database
+        :param key:
+        Key of a secured database (it stays on the client)
+        :param python:
+        Python interpreter on the server
+        :param folder:
+        Folder of the poki modules on the server,
+        None to upload them (see ``agent.install``)
+        :return:
+        `Agent`
+        """
+        from agent import Agent, SSHTransport, install
+        if folder is None:
+            if self._agent_folder is None:
+                self._agent_folder = install(self.sftp)
+            folder = self._agent_folder
+        cwd = self.sftp.getcwd() or "."  # Relative paths are the same as over SFTP
+        command = f'cd {shlex.quote(cwd)} && {python} {shlex.quote(f"{folder}/agent.py")}'
+        return Agent(SSHTransport(self.client, command), filename, key, self.stats)
+
+    def open_sharded_database(self, name, filename, segments=8, strategy="hash"):
+        """
+        Open a sharded database, see ``shards.ShardedDataBase``
+        :param name:
+        Name of the database
+        :param filename:
+        Filename of the manifest
+        :return:
+        `ShardedDataBase`
+        """
+        from shards import ShardedDataBase
+        return ShardedDataBase(name, filename, segments, strategy, self, self.stats)
 
     @property
     def connected(self):
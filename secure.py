@@ -0,0 +1,67 @@
+import os
+from exceptions import Exceptions
+
+"""
+Secured databases (levels S and X).
+The content of every element is sealed on its own (AES-GCM),
+the sub-headers stay readable, so a single element can
+be found and decrypted without touching the rest of the file.
+"""
+
+NONCE_SIZE = 12
+
+
+class Sealer:
+    """
+    Authenticated encryption of the content of single elements,
+    the type and name of the element are authenticated as well
+    """
+    def __init__(self, key, compression=None):
+        """
+        :param key:
+        AES key, 16, 24 or 32 bytes
+        :param compression:
+        `structures.Compression`, compress the content before
+        encrypting it (level X), None for level S
+        """
+        try:
+            from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        except ImportError:
+            raise Exceptions.UnsupportedError("Secured databases require the 'cryptography' package", "Sealer")
+        if type(key) is not bytes or len(key) not in (16, 24, 32):
+            raise Exceptions.UnsupportedError("The key must be 16, 24 or 32 bytes", "Sealer")
+        self._aead = AESGCM(key)
+        self.compression = compression
+
+    @staticmethod
+    def generate_key():
+        """
+        A new random (256 bit) key
+        """
+        return os.urandom(32)
+
+    def seal(self, data, head, name):
+        """
+        Encrypt the content of an element
+        :param head:
+        Type of the element ("=" or "?")
+        """
+        if self.compression is not None:
+            import zstandard as zst
+            data = zst.ZstdCompressor(compression_params=self.compression.params()).compress(data)
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, f'{head}{name}'.encode())
+
+    def open(self, data, head, name):
+        """
+        Decrypt the content of an element
+        """
+        from cryptography.exceptions import InvalidTag
+        try:
+            data = self._aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], f'{head}{name}'.encode())
+        except InvalidTag:
+            raise Exceptions.CorruptionError(f"Unable to decrypt '{name}' (wrong key or corrupted)", "Sealer.open")
+        if self.compression is not None:
+            import zstandard as zst
+            data = zst.ZstdDecompressor().decompress(data)
+        return data
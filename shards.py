@@ -0,0 +1,274 @@
+import zlib
+from exceptions import Exceptions
+from structures import DataBase, Compression
+from records import deref
+from stats import Stats
+from storage import LocalStorage
+
+"""
+A sharded database is a manifest file, which lists N
+segment files. Every segment is an ordinary database,
+every element lives in exactly one segment.
+"""
+
+MANIFEST = "POKI-MANIFEST"
+
+
+class ShardedDataBase:
+    """
+    Database spread over several segment files,
+    elements are assigned by the hash of their name ("hash")
+    or to the smallest segment ("size")
+    """
+    def __init__(self, name, location, segments=8, strategy="hash", connector=None, stats: Stats = None,
+                 concurrent=False):
+        """
+        :param location:
+        Location of the manifest, the segments are
+        stored next to it (``<location>.<n>``)
+        :param segments:
+        Amount of segments (only used when creating the manifest)
+        :param strategy:
+        "hash" or "size" (only used when creating the manifest)
+        :param connector:
+        `remote.Connector` for a remote database, None for a local one
+        :param concurrent:
+        See `DataBase`
+        """
+        if strategy not in ("hash", "size"):
+            raise Exceptions.UnsupportedError(f"'{strategy}' is not a sharding strategy", "ShardedDataBase")
+        self.name = name
+        self.location = location
+        self.connector = connector
+        self.stats = stats
+        self.concurrent = concurrent
+        self.strategy = strategy
+        self.routes: dict[str, int] = {}
+        self.locations = [f'{location}.{i}' for i in range(segments)]
+        if self._manifest_exists():
+            self._load_manifest()
+        self.segments = [self._open_segment(i) for i in range(len(self.locations))]
+        self._weights = [max(segment._size, 0) for segment in self.segments]  # Bytes, for "size"
+        self._changed = set()
+
+    def _storage(self, filename):
+        if self.connector is None:
+            return LocalStorage(filename)
+        return self.connector.create_RDA(filename)
+
+    def _open(self, filename, mode):
+        return self._storage(filename).open(filename, mode)
+
+    def _manifest_exists(self):
+        return self._storage(self.location).exists()
+
+    def _open_segment(self, i):
+        location = self.locations[i]
+        RDA = None if self.connector is None else self.connector.create_RDA(location)
+        return DataBase(f'{self.name}.{i}', location, RDA, self.stats, self.concurrent)
+
+    def _load_manifest(self):
+        with self._open(self.location, 'rb') as file:
+            lines = file.read().decode().split("\n")
+        head = lines[0].split(";")
+        if head[0] != MANIFEST or len(head) != 4:
+            raise Exceptions.HeaderError(f"'{self.location}' is not a manifest", "_load_manifest")
+        self.strategy = head[2]
+        self.locations = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            if line.startswith("@"):  # Route (name;segment)
+                name, segment = line[1:].rsplit(";", 1)
+                self.routes[name] = int(segment)
+            else:
+                self.locations.append(line)
+        if len(self.locations) != int(head[3]):
+            raise Exceptions.CorruptionError(f"Manifest '{self.location}' lists {len(self.locations)} "
+                                             f"of {head[3]} segments", "_load_manifest")
+
+    def _write_manifest(self):
+        lines = [f'{MANIFEST};{self.name};{self.strategy};{len(self.locations)}']
+        lines += self.locations
+        lines += [f'@{name};{segment}' for name, segment in self.routes.items()]
+        with self._open(self.location, 'wb') as file:
+            file.write(("\n".join(lines) + "\n").encode())
+
+    def segment_of(self, name):
+        """
+        Index of the segment `name` is (or would be) stored in
+        """
+        if name in self.routes:
+            return self.routes[name]
+        if self.strategy == "hash":
+            return zlib.crc32(name.encode()) % len(self.locations)
+        return None
+
+    def _assign(self, element):
+        i = self.segment_of(element.title)
+        if i is None:  # Smallest segment, counting what has not been exported yet
+            i = min(range(len(self.segments)), key=self._weights.__getitem__)
+            self.routes[element.title] = i
+            self._weights[i] += len(element.eval())
+        return i
+
+    @property
+    def elements(self):
+        """
+        All loaded elements (of all segments)
+        """
+        res = {}
+        for segment in self.segments:
+            res.update(segment.elements)
+        return res
+
+    def add(self, element):
+        """
+        Add an element to the segment it belongs to
+        """
+        i = self._assign(element)
+        self.segments[i].add(element)
+        self._changed.add(i)
+
+    def delete(self, name):
+        """
+        Delete an element (loaded or not), it is
+        removed from its segment at the next export
+        """
+        i = self._require(name)
+        self.segments[i].delete(name)
+        self.routes.pop(name, None)
+        self._changed.add(i)
+
+    def load(self, name=None, amount=None, maintain_borrows=False):
+        """
+        See `DataBase.load`, with `amount`, the
+        segments are read one after another
+        """
+        if name == amount is None or name and amount:
+            raise Exception
+        if name:
+            return self.segments[self._require(name)].load(name=name, maintain_borrows=maintain_borrows)
+        return self.__gen_load(amount, maintain_borrows)
+
+    def __gen_load(self, amount, maintain_borrows):
+        for segment in self.segments:
+            if amount <= 0:
+                break
+            if segment._loaded_header is None:
+                continue
+            for element in segment.load(amount=amount, maintain_borrows=maintain_borrows):
+                amount -= 1
+                yield element
+
+    def _require(self, name):
+        i = self.segment_of(name)
+        if i is None:
+            raise Exceptions.SubHeadError(f"There is no element '{name}'", "ShardedDataBase")
+        return i
+
+    def find(self, name, maintain_borrows=True):
+        """
+        See `DataBase.find`, only the segment of `name` is searched
+        """
+        segment = self.segments[self._require(name)]
+        if segment._loaded_header is None:
+            return iter(())
+        return segment.find(name, maintain_borrows)
+
+    def update(self, name, element=None, check=False):
+        """
+        See `DataBase.update`
+        """
+        i = self._require(name)
+        if element is None:
+            element = self.segments[i].elements[name]
+        self.segments[i].update(name, element, check)
+
+    def load_all(self, maintain_borrows=False, workers=None):
+        """
+        Fully load all segments, one after another
+        (the index of loaded elements is global, see `tools.clean`)
+        NOTE : Borrows are only resolved within a segment
+        :param workers:
+        Decode the Clusters of a segment in this amount of processes
+        (see `tools.load`), leave None to load in this thread
+        """
+        from tools import load
+        for segment in self.segments:
+            if segment._loaded_header is None:
+                continue
+            loaded = load(segment.location, maintain_borrows, True, segment.RDA, self.stats, workers, segment.key)
+            segment.elements.update(loaded.elements)
+        return self.elements
+
+    def export(self, secure=False, compression=False):
+        """
+        Export only the segments which changed,
+        elements of a changed segment that were never
+        loaded are kept as they are stored.
+        A segment whose level stays the same (and is not compressed
+        as a whole) is exported incrementally (see `DataBase.export`)
+        """
+        if compression is True:
+            compression = Compression()
+        for i in sorted(self._changed):
+            segment = self.segments[i]
+            header = segment._loaded_header
+            if header is not None and segment._in_place() \
+                    and segment._get_header(secure, compression, 0)[:1].decode() == header.level:
+                segment.export(secure, compression, incremental=True)
+            else:
+                raw = self._raw_elements(segment) if header is not None else []
+                for element in raw:
+                    segment.elements[element.title] = element
+                try:
+                    segment.export(secure, compression)
+                finally:
+                    for element in raw:
+                        del segment.elements[element.title]
+            self._weights[i] = max(segment._size, 0)
+        self._changed = set()
+        self._write_manifest()
+
+    @staticmethod
+    def _raw_elements(segment):
+        """
+        The elements of a segment which are not loaded (nor deleted),
+        as their records / pickled objects (see `tools.RawCluster`),
+        so they are written back as they are (borrows included)
+        """
+        from tools import iter_elements, decode_cluster, RawCluster, RawJar
+        header = segment._loaded_header
+        sealer = segment._get_sealer()
+        version = segment.version
+        raw = []
+        values = None
+        file = segment._get_ready_file()
+        for head, name, content, _ in iter_elements(file, header.size, header.idx):
+            if sealer is not None:
+                content = sealer.open(content, head.decode(), name)
+            if head == b"+":  # Value segment, the values are written into the records
+                values = content
+            elif name in segment.elements or name in segment._deleted:
+                continue
+            elif head == b"=":
+                raw.append(RawCluster(name, decode_cluster(content, version, values)))
+            else:
+                raw.append(RawJar(name, deref(content, values)))
+        file.close()
+        return raw
+
+    def __getitem__(self, item):
+        return self.elements[item]
+
+    def __contains__(self, item):
+        return item in self.elements
+
+    def __repr__(self):
+        res = f"Sharded database {self.name} ({len(self.segments)} segments) at {self.location}"
+        if self.connector:
+            res += " [REMOTE]"
+        res += "\n"
+        res += f"ELEMENTS (LOADED) : {len(self.elements)}\n"
+        return res
@@ -0,0 +1,153 @@
+import time
+import functools
+import threading
+
+"""
+Opt-in I/O and phase instrumentation.
+A `Stats` object is attached to a `DataBase` (or `Connector`),
+every file opened by it is wrapped in a `TracedFile`, which
+carries the `Stats` into the parsers (see `traced`)
+"""
+
+
+class Stats:
+    """
+    Counters and cumulative phase timings
+    of database operations
+    """
+    counters = ("bytes_read", "bytes_written", "reads", "writes", "seeks", "round_trips", "elements",
+                "decompressed_bytes")
+
+    def __init__(self, hook=None):
+        """
+        :param hook:
+        Callable, called as ``hook(event, value)`` for every
+        counter increment (event = counter name) and every finished
+        phase (event = ``phase.<name>``, value = seconds)
+        """
+        self.hook = hook
+        self._lock = threading.Lock()
+        self.phases: dict[str, list] = {}
+        for counter in self.counters:
+            setattr(self, counter, 0)
+
+    def reset(self):
+        """
+        Reset all counters and timings
+        """
+        with self._lock:
+            self.phases = {}
+            for counter in self.counters:
+                setattr(self, counter, 0)
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+        if self.hook is not None:
+            self.hook(counter, amount)
+
+    def timing(self, phase, seconds):
+        with self._lock:
+            entry = self.phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        if self.hook is not None:
+            self.hook(f'phase.{phase}', seconds)
+
+    def wrap(self, file, raw=True):
+        """
+        Wrap a file, so that its I/O is counted
+        :param raw:
+        Whether the file is the actual file, otherwise it is
+        a (decompressed) stream on top of it, of which only the
+        amount of bytes is counted
+        """
+        if file is None or isinstance(file, TracedFile) and file.stats is self and file.raw == raw:
+            return file
+        return TracedFile(file, self, raw)
+
+    def snapshot(self):
+        """
+        :return:
+        A dict of all counters and ``phases`` as {name: (calls, seconds)}
+        """
+        with self._lock:
+            res = {counter: getattr(self, counter) for counter in self.counters}
+            res["phases"] = {name: tuple(entry) for name, entry in self.phases.items()}
+        return res
+
+    def __repr__(self):
+        res = ", ".join(f'{counter}={getattr(self, counter)}' for counter in self.counters)
+        for name, (calls, seconds) in self.phases.items():
+            res += f'\n  {name}: {calls} calls, {seconds:.6f}s'
+        return f'Stats ({res})'
+
+
+class TracedFile:
+    """
+    Counting proxy around a file (or stream)
+    """
+    def __init__(self, file, stats: Stats, raw=True):
+        self.file = file
+        self.stats = stats
+        self.raw = raw
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        if self.raw:
+            self.stats.count("reads")
+            self.stats.count("bytes_read", len(data))
+        else:
+            self.stats.count("decompressed_bytes", len(data))
+        return data
+
+    def write(self, data):
+        res = self.file.write(data)
+        if self.raw:
+            self.stats.count("writes")
+            self.stats.count("bytes_written", len(data))
+        return res
+
+    def seek(self, *args):
+        if self.raw:
+            self.stats.count("seeks")
+        return self.file.seek(*args)
+
+    def __getattr__(self, item):
+        return getattr(self.file, item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.file.close()
+
+
+def stats_of(args):
+    for arg in args:
+        if isinstance(arg, TracedFile):
+            return arg.stats
+    return None
+
+
+def traced(phase, decodes=False):
+    """
+    Time a function as `phase`, if one of its arguments is a `TracedFile`
+    :param decodes:
+    Whether the function decodes an element (counted as `elements`)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = stats_of(args)
+            if stats is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.timing(phase, time.perf_counter() - start)
+                if decodes:
+                    stats.count("elements")
+        return wrapper
+    return decorator
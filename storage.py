@@ -0,0 +1,278 @@
+import io
+import os
+import functools
+import threading
+from contextlib import contextmanager
+from handles import positioned_reader
+from stats import Stats
+
+"""
+Storage backends.
+A `DataBase` does all of its I/O through the `Storage` of its
+file, a backend implements open, read_range, stat, rename and remove,
+everything else (atomic writes, readers, ...) is built on top of them.
+`LocalStorage` is a file on this machine, `MemoryStorage` keeps
+the files in RAM, `remote.RemoteDataBaseAccessor` is a file on an
+SSH-server (SFTP).
+"""
+
+EXPORT_BUFSIZE = 1 << 20  # Write buffer of remote exports
+
+
+class Storage:
+    """
+    Base of the storage backends
+    """
+    local = False  # The filename is a path on this machine (see `tools.read_range`)
+    label = None  # Shown in the repr of a `DataBase`
+
+    def __init__(self, filename, stats: Stats = None):
+        """
+        :param filename:
+        The file of the database, the default of every method
+        :param stats:
+        Optional `Stats`, records the I/O
+        """
+        self.filename = filename
+        self.stats = stats
+
+    def open(self, filename=None, mode="rb", bufsize=-1):
+        raise NotImplementedError
+
+    def read_range(self, offset, size):
+        """
+        Read `size` bytes at `offset` of the file
+        (safe to use from several threads)
+        """
+        raise NotImplementedError
+
+    def stat(self, filename=None):
+        """
+        :return:
+        Size of the file, -1 if it does not exist
+        """
+        raise NotImplementedError
+
+    def rename(self, src, dst):
+        """
+        Rename `src` to `dst`, replacing it
+        """
+        raise NotImplementedError
+
+    def remove(self, filename):
+        raise NotImplementedError
+
+    @property
+    def size(self):
+        return self.stat()
+
+    def exists(self, filename=None):
+        return self.stat(filename) != -1
+
+    def open_stream(self, filename=None):
+        """
+        Open a file for a long sequential write (an export)
+        """
+        return self.open(filename, 'wb')
+
+    def snapshot(self):
+        """
+        Version of the file to make readers of (see `reader`),
+        readers of the same snapshot see the same file
+        """
+        return None
+
+    def reader(self, position=0, snapshot=None):
+        """
+        File-like reader of the file, with its own position
+        :param snapshot:
+        Made by `snapshot`, None for the current version
+        """
+        return positioned_reader(self.read_range, position)
+
+    @contextmanager
+    def atomic_write(self, filename=None):
+        """
+        Write a new version of a file, yields the name of a temporary
+        file, which replaces `filename` when the block succeeds and
+        is removed otherwise.
+        Readers never see a partially written file.
+        """
+        if filename is None:
+            filename = self.filename
+        tmp = f'{filename}.{os.getpid()}.tmp'
+        try:
+            yield tmp
+        except BaseException:
+            try:
+                self.remove(tmp)
+            except IOError:
+                pass
+            raise
+        self.rename(tmp, filename)
+
+    def reopen(self):
+        """
+        The file may have been replaced, drop what refers to the old one
+        """
+        self.close_handles()
+
+    def close_handles(self):
+        pass
+
+    def __repr__(self):
+        return f'{self.filename} [{self.size}]'
+
+
+class LocalStorage(Storage):
+    """
+    A file on this machine, read through one long-lived handle
+    """
+    local = True
+
+    def __init__(self, filename, stats: Stats = None, concurrent=False):
+        """
+        :param concurrent:
+        The file is replaced by other processes (see `concurrency`),
+        check for it before every read
+        """
+        super().__init__(filename, stats)
+        self.concurrent = concurrent
+        self._handle = None
+        self._lock = threading.Lock()
+
+    def handle(self, check=False):
+        """
+        The long-lived (read) handle of the file,
+        reopened when the file has been replaced
+        :param check:
+        Check whether the file has been replaced (also when not concurrent)
+        """
+        with self._lock:
+            if self._handle is not None and (self.concurrent or check):
+                try:
+                    if os.stat(self.filename).st_ino != os.fstat(self._handle.fileno()).st_ino:
+                        self._handle = None  # Readers of the old snapshot keep their reference
+                except FileNotFoundError:
+                    pass
+            if self._handle is None:
+                self._handle = open(self.filename, 'rb', buffering=0)
+            return self._handle
+
+    def _pread(self, handle, offset, size):
+        if hasattr(os, "pread"):
+            return os.pread(handle.fileno(), size, offset)
+        with self._lock:  # No positioned reads (Windows)
+            handle.seek(offset)
+            return handle.read(size)
+
+    def open(self, filename=None, mode="rb", bufsize=-1):
+        file = open(self.filename if filename is None else filename, mode, bufsize)
+        return self.stats.wrap(file) if self.stats else file
+
+    def read_range(self, offset, size):
+        return self._pread(self.handle(), offset, size)
+
+    def snapshot(self):
+        return self.handle()
+
+    def reader(self, position=0, snapshot=None):
+        handle = snapshot or self.handle()  # All reads of the reader see the same snapshot
+        return positioned_reader(functools.partial(self._pread, handle), position, handle.fileno())
+
+    def stat(self, filename=None):
+        try:
+            return os.stat(self.filename if filename is None else filename).st_size
+        except FileNotFoundError:
+            return -1
+
+    def rename(self, src, dst):
+        os.replace(src, dst)
+
+    def remove(self, filename):
+        os.remove(filename)
+
+    def reopen(self):
+        self.handle(check=True)
+
+    def close_handles(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+class MemoryFile(io.BytesIO):
+    """
+    Writable file of a `MemoryStorage`, its content
+    replaces the stored one when it is closed
+    """
+    def __init__(self, files, filename, data=b""):
+        super().__init__(data)
+        self._files = files
+        self._filename = filename
+
+    def close(self):
+        if not self.closed:
+            self._files[self._filename] = self.getvalue()
+        super().close()
+
+
+class MemoryStorage(Storage):
+    """
+    Files in RAM, for ephemeral databases and tests.
+    Readers keep the version of the file they started with,
+    a write is visible when its file is closed
+    """
+    label = "MEMORY"
+
+    def __init__(self, filename, stats: Stats = None, files=None):
+        """
+        :param files:
+        Dict of filename -> content (bytes), shared by
+        several storages, None for a new one
+        """
+        super().__init__(filename, stats)
+        self.files = {} if files is None else files
+
+    def _content(self, filename):
+        try:
+            return self.files[filename]
+        except KeyError:
+            raise FileNotFoundError(filename)
+
+    def open(self, filename=None, mode="rb", bufsize=-1):
+        if filename is None:
+            filename = self.filename
+        if "w" in mode:
+            file = MemoryFile(self.files, filename)
+        elif "+" in mode or "a" in mode:
+            file = MemoryFile(self.files, filename, self._content(filename))
+            if "a" in mode:
+                file.seek(0, 2)
+        else:
+            file = io.BytesIO(self._content(filename))
+        return self.stats.wrap(file) if self.stats else file
+
+    def read_range(self, offset, size):
+        return self._content(self.filename)[offset:offset + size]
+
+    def snapshot(self):
+        return self._content(self.filename)
+
+    def reader(self, position=0, snapshot=None):
+        # The version of the file when the reader is made
+        content = self._content(self.filename) if snapshot is None else snapshot
+        return positioned_reader(lambda offset, size: content[offset:offset + size], position)
+
+    def stat(self, filename=None):
+        content = self.files.get(self.filename if filename is None else filename)
+        return -1 if content is None else len(content)
+
+    def rename(self, src, dst):
+        self.files[dst] = self._content(src)
+        del self.files[src]
+
+    def remove(self, filename):
+        self._content(filename)
+        del self.files[filename]
@@ -1,14 +1,27 @@
+import os
 import copy
+import contextlib
+import collections
 import threading
 from dataclasses import dataclass
-import os
-import asyncio
-import zstandard as zst
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from exceptions import Exceptions
-from remote import RemoteDataBaseAccessor
-from hashlib import sha1
+from stats import Stats, traced
+from concurrency import copy_on_write, snapshot_id
+from storage import Storage, LocalStorage, EXPORT_BUFSIZE
+from records import VERSION, ValueTable, encode_record, encode_ref
+from hashlib import sha1, blake2b
 import pickle
 
+SIZE_WIDTH = 20  # Width of the size of a Jar, which is written before its size is known
+DIGEST_WIDTH = 16  # Width of a checksum (see `block_digest`)
+MARK_SIZE = 16  # Bytes before the end of the file, compared by `DataBase.refresh`
+GENERATION_WIDTH = 8  # Width of the generation in the header (see `DataBase._bump_generation`)
+VALUE_SEGMENT = "values"  # Name of the value segment (see `DataBase.export(dedup=True)`)
+
 """
 The index is a table of all registered value,
 it is [for example] used to address PINs
@@ -16,6 +29,61 @@ it is [for example] used to address PINs
 index = {}
 
 
+def block_digest(data):
+    """
+    Checksum of the content of an element,
+    stored in its sub-header
+    """
+    return blake2b(data, digest_size=8).hexdigest()
+
+
+def jar_sub_header(title, size, digest, width=0):
+    """
+    Sub-header of a Jar, the size is padded to `width`,
+    so it can be filled in after the content is written
+    """
+    return f"?{title}:{size:0{width}d}:{digest}\n".encode()
+
+
+def assemble_block(element, sealer=None, version=1, values: ValueTable = None):
+    """
+    Sub-header and content of an element, as it is stored in the file
+    :param sealer:
+    `Sealer` to encrypt the content with
+    :param values:
+    `ValueTable` of the export
+    """
+    if isinstance(element, Cluster):
+        _header = "="
+    else:
+        _header = "?"
+    fmt = element.eval(version, values)
+    if sealer is not None:
+        fmt = sealer.seal(fmt, _header, element.title)
+    _header += f"{element.title}:{len(fmt)}:{block_digest(fmt)}\n"
+    return _header.encode() + fmt
+
+
+class DigestWriter:
+    """
+    Writes through to a file, counts and
+    checksums (see `block_digest`) what is written
+    """
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+        self._hash = blake2b(digest_size=8)
+
+    def write(self, data):
+        self.file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
 class Borrow:
     """
     A borrowed value is an exact copy of an
@@ -43,6 +111,7 @@ class Atom:
     """
     def __init__(self, name, value):
         _t = type(value)
+        self.borrows = value.name if _t == Borrow else None  # Name of the borrowed particle
         if _t == str:
             self.value = value.encode()
         elif _t == Borrow:
@@ -53,7 +122,9 @@ class Atom:
 
         index[name] = self
 
-    def eval(self):
+    def eval(self, version=1, values: ValueTable = None):
+        if version >= 2:
+            return encode_record(self.borrows is not None, self.name, self.borrows or self.value, 0, version, values)
         return self.name.encode() + b";" + self.value + chr(0).encode()
 
     def borrow(self):
@@ -70,10 +141,11 @@ class Pin:
     """
     def __init__(self, value, name=None):
         _t = type(value)
+        self.borrows = value.name if _t == Borrow else None  # Name of the borrowed particle
         if _t == str:
             self.value = value.encode()
         elif _t == Borrow:
-            self.value = value.eval().encode()
+            self.value = value.eval()
         else:
             self.value = bytes(value)
 
@@ -84,7 +156,9 @@ class Pin:
 
         index[self.name] = self
 
-    def eval(self):
+    def eval(self, version=1, values: ValueTable = None):
+        if version >= 2:
+            return encode_record(self.borrows is not None, None, self.borrows or self.value, 1, version, values)
         return b'!' + self.value + chr(0).encode()
 
     def borrow(self):
@@ -100,15 +174,33 @@ class Cluster:
         self.particles: dict[str, Atom | Pin] = {}
         for p in particles:
             self.particles[p.name] = p
+        self.dirty = True
 
     def add(self, particle: Atom | Pin):
         self.particles[particle.name] = particle
+        self.dirty = True
 
     def delete(self, name):
         del self.particles[name]
+        self.dirty = True
 
-    def eval(self):
-        x = [at.eval() for n, at in self.particles.items()]
+    def touch(self):
+        """
+        Mark the Cluster as changed (e.g. after changing a particle in place),
+        so it is written by `DataBase.update_all`
+        """
+        self.dirty = True
+
+    def eval(self, version=1, values: ValueTable = None):
+        """
+        :param version:
+        Format of the particles (see `records`)
+        :param values:
+        `ValueTable` of the export (version 2)
+        """
+        x = [at.eval(version, values) for n, at in self.particles.items()]
+        if version >= 2:
+            return b"".join(x)
         return b"\n".join(x)
 
     def __attr_get(self, item):
@@ -130,6 +222,7 @@ class Cluster:
     def __setitem__(self, key, value):
         key = self.__attr_get(key)
         self.particles[key] = value
+        self.dirty = True
 
     def __repr__(self):
         return f"Cluster ('{self.title}') of {len(self.particles)} elements"
@@ -140,8 +233,32 @@ class Jar:
         self.title = title
         self.obj = obj
 
-    def eval(self):
-        return pickle.dumps(self.obj)
+    @property
+    def obj(self):
+        return self._obj
+
+    @obj.setter
+    def obj(self, obj):
+        self._obj = obj
+        self.dirty = True
+
+    def touch(self):
+        """
+        Mark the Jar as changed (e.g. after changing the object in place),
+        so it is written by `DataBase.update_all`
+        """
+        self.dirty = True
+
+    def eval(self, version=1, values: ValueTable = None):
+        payload = pickle.dumps(self.obj)
+        ref = None if values is None else values.ref(payload)
+        return payload if ref is None else encode_ref(*ref)
+
+    def dump(self, file):
+        """
+        Pickle the object straight into `file`
+        """
+        pickle.Pickler(file).dump(self.obj)
 
     def __repr__(self):
         return repr(self.obj)
@@ -154,23 +271,206 @@ class DataBaseHeader:
     name: str
     idx: int
     size: int
+    params: dict = None
+
+
+@dataclass(frozen=True)
+class Compression:
+    """
+    ZSTD parameters of an export
+    """
+    level: int = 3
+    threads: int = 0  # Native multithreading, -1 for one per core
+    long_distance: bool = False  # Long-distance matching
+    window_log: int = 0  # Window size (2 ** window_log), 0 for the default of the level
+    size_hint: int = 0  # Expected (uncompressed) size, used to pick the parameters
+
+    def params(self):
+        import zstandard as zst
+        return zst.ZstdCompressionParameters.from_level(self.level, source_size=self.size_hint,
+                                                        window_log=self.window_log,
+                                                        enable_ldm=self.long_distance, threads=self.threads)
+
+    def header(self):
+        """
+        The parameters the decompressor must know about,
+        stored in the header of the database
+        """
+        params = {"level": self.level}
+        if self.window_log:
+            params["window_log"] = self.window_log
+        if self.long_distance:
+            params["ldm"] = 1
+        return ",".join(f'{key}={value}' for key, value in params.items())
+
+    @classmethod
+    def from_header(cls, params):
+        """
+        `Compression` of a database, from the parameters in its header
+        """
+        return cls(params.get("level", 3), window_log=params.get("window_log", 0),
+                   long_distance=bool(params.get("ldm")))
 
 
 class DataBase:
-    def __init__(self, name, location, RDA: RemoteDataBaseAccessor = None):
+    def __init__(self, name, location, RDA: Storage = None, stats: Stats = None,
+                 concurrent=False, key=None):
+        """
+        :param RDA:
+        Storage backend of the file (see `storage`), like a
+        RemoteDataBaseAccessor, leave None if it is a local file
+        :param stats:
+        Optional `Stats`, records the I/O and phase timings
+        of every operation on this database
+        :param concurrent:
+        Share the (local) file with other processes,
+        writers lock and replace the file instead of modifying it,
+        so readers always see a consistent snapshot
+        :param key:
+        Key of a secured database (see `secure.Sealer`)
+        """
+        if RDA is None:
+            RDA = LocalStorage(location, stats, concurrent)
+        elif concurrent:
+            raise Exceptions.UnsupportedError("Concurrent mode is only supported for local databases",
+                                              "DataBase")
         self._size = None
         self.__mprocs = {}
         self.name = name
         self.location = location
-        self.RDA = RDA
+        self.storage = RDA
+        self.RDA = None if RDA.local else RDA
+        self.stats = stats
+        if stats is not None and RDA.stats is None:
+            RDA.stats = stats
+        self.concurrent = concurrent
+        self.key = key
+        self._snapshot = None
+        self._values = None
         self._loaded_header = self._load_header()
         self.elements = {}
+        self._deleted = set()
+        self._behind = None  # See `write_behind`
+        self._digests = None  # Name -> checksum of the blocks known to `refresh`
+        self._mark_end()
 
     def reload(self):
         """
         Reload the entire database
         """
         self._loaded_header = self._load_header()
+        self._mark_end()
+
+    def _mark_end(self):
+        """
+        Remember where the file ends, so `refresh` only
+        reads what is appended after it
+        """
+        header = self._loaded_header
+        self._end = self._mark = None
+        if header is None:
+            return
+        self._end = header.size
+        if self._in_place() and self._end > header.idx:
+            self._mark = self._read_range(max(self._end - MARK_SIZE, header.idx), MARK_SIZE)
+
+    def refresh(self, load=False, maintain_borrows=False):
+        """
+        Catch up with the changes of other writers.
+        If they only appended to the file (new elements of `update_all`,
+        incremental `export`, ...) only the bytes after the last known end
+        are read. If blocks were rewritten in place (`update`, changed
+        elements of `update_all`, see `_bump_generation`), the file was
+        replaced or it is compressed as a whole, its sub-headers are read
+        entirely and their checksums are compared with the known ones.
+        Loaded elements (which were not changed here) are replaced
+        by their new version. Removed elements are not detected.
+        :param load:
+        Also load the new elements
+        :param maintain_borrows:
+        See `load`
+        :return:
+        Names of the new (or changed) elements, all of them
+        if the file was rewritten before the checksums were known
+        (the first call after it was opened)
+        """
+        self._settle()
+        self.storage.reopen()  # The file may have been replaced
+        old, end, mark = self._loaded_header, self._end, self._mark
+        header = self._load_header()
+        if header is None:
+            return []
+        appended = mark is not None and header.level == old.level and header.params == old.params \
+            and header.size >= end and self._read_range(end - len(mark), len(mark)) == mark
+        self._loaded_header = header
+        size = header.size
+        known = self._digests
+        if appended and known is not None:
+            idx, digests = end, dict(known)
+        else:  # The checksums of the blocks before `end` are collected on the way
+            idx, digests = header.idx, {}
+
+        names = {}
+        file = self._get_ready_file()
+        if idx != header.idx:  # Positions are the ones in the file (see `_in_place`)
+            file.seek(idx, 0)
+        while True:
+            _type, _size, idx, _name, _digest, _start = self._get_sub_header_item(file, size, idx)
+            if _type is None:
+                break
+            if appended:
+                changed = _start >= end
+            else:
+                changed = known is None or _name not in known or known[_name] != _digest
+            digests[_name] = _digest
+            current = self.elements.get(_name)
+            if changed:
+                names[_name] = None
+            if changed and ((load and current is None) or (current is not None and not current.dirty)):
+                self.elements[_name] = self._construct_sub_header(file, _size, size, idx, idx, maintain_borrows,
+                                                                  _type, _name)
+            else:
+                file.seek(_size + 1, 1)
+            idx += _size + 1
+        file.close()
+        self._digests = digests
+        self._mark_end()
+        return list(names)
+
+    def _polled(self):
+        """
+        Size and generation (see `_bump_generation`) of the file as it is now
+        """
+        from tools import get_db_header
+        self.storage.reopen()
+        size = self.storage.stat()
+        if size == -1:
+            return size, None
+        file = self._reader(0)
+        params = get_db_header(file, size)[5]
+        file.close()
+        return size, params.get("g")
+
+    def follow(self, interval=0.5, timeout=None, maintain_borrows=False):
+        """
+        Generator of the elements other writers append to (or change in) the file,
+        waits for the file to change (its size and generation are polled every
+        `interval` seconds)
+        :param timeout:
+        Stop after the file did not change for this amount of seconds,
+        None to follow forever
+        """
+        while True:
+            for name in self.refresh(True, maintain_borrows):
+                yield self.elements[name]
+            waited = 0
+            header = self._loaded_header
+            known = self._size, None if header is None else header.params.get("g")
+            while self._polled() == known:
+                if timeout is not None and waited >= timeout:
+                    return
+                time.sleep(interval)
+                waited += interval
 
     def file_open(self, filename, mode, *args):
         """
@@ -183,43 +483,203 @@ class DataBase:
         :return:
         Opened file
         """
-        if self.RDA is None:
-            return open(filename, mode, *args)
-        else:
-            return self.RDA.open(filename, mode, *args)
+        return self.storage.open(filename, mode, *args)
 
     def get_size(self):
         """
         Get (file) size of the DB
         """
-        if self.RDA is None:
-            self._size = os.path.getsize(self.location) if os.path.exists(self.location) else -1
-            return self._size
-        else:
-            return self.RDA.size if self.RDA.exists() else -1
+        self._size = self.storage.stat()
+        return self._size
 
-    def _load_header(self):
+    def _read_range(self, offset, size):
+        """
+        Read `size` bytes at `offset` of the database file
+        (safe to use from several threads)
+        """
+        return self.storage.read_range(offset, size)
+
+    def _reader(self, position=0, snapshot=None):
+        """
+        File-like reader of the database file,
+        with its own position on the shared handle
+        :param snapshot:
+        Made by `storage.snapshot`, None for the current file
+        """
+        reader = self.storage.reader(position, snapshot)
+        return self.stats.wrap(reader) if self.stats else reader
+
+    def close(self):
+        """
+        Close the handles of the database file
+        (the queued updates are written first)
+        """
+        if self._behind is not None:
+            self._behind.close()
+        self.storage.close_handles()
+
+    def write_behind(self, max_pending=64, delay=1.0):
+        """
+        Queue the updates (`update`) instead of writing them, every
+        element is written once, as it was at its latest update, by a background
+        thread, when `max_pending` elements are queued, the oldest update
+        is `delay` seconds old, on `flush` or when the database is closed.
+        Operations which read the file write the queued updates first
+        :return:
+        The `behind.WriteBehind`, closing it ends write-behind mode
+        """
+        from behind import WriteBehind
+        if self._behind is None:
+            self._behind = WriteBehind(self, max_pending, delay)
+        return self._behind
+
+    def flush(self):
+        """
+        Write the queued updates (see `write_behind`)
+        """
+        if self._behind is not None:
+            self._behind.flush()
+
+    def _settle(self):
+        """
+        The file is about to be read, write the queued updates
+        """
+        if self._behind is not None:
+            self._behind.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load_header(self, file=None):
         from tools import get_db_header
-        self._size = self.get_size()
-        if self._size == -1:
-            return
-        file = self.file_open(self.location, 'rb')
-        level, realname, _name, idx, size = get_db_header(file, self._size)
+        if file is None:
+            self._size = self.get_size()
+            if self._size == -1:
+                return
+            file = self._reader(0)
+        else:  # Header of the snapshot behind `file`
+            self._snapshot = snapshot_id(file)
+            self._size = self._snapshot[1]
+            file.seek(0)
+        level, realname, _name, idx, size, params = get_db_header(file, self._size)
         idx += 1
-        dbh = DataBaseHeader(level, realname, _name, idx, size)
+        dbh = DataBaseHeader(level, realname, _name, idx, size, params)
+        self._values = None  # Value segment of the file (see `_get_values`)
         return dbh
 
-    def _get_ready_file(self):
+    def _get_ready_file(self, mode='rb', location=None, snapshot=None):
         from tools import level_decompile
-        file = self.file_open(self.location, 'r+b')
+        if location is None:
+            location = self.location
+        if location == self.location and (mode == 'rb' or self.concurrent):
+            file = self._reader(0, snapshot)  # Never write to the shared file (concurrent mode)
+        else:
+            file = self.file_open(location, mode)
+        if self.concurrent and snapshot_id(file) != self._snapshot:
+            self._loaded_header = self._load_header(file)
         level = self._loaded_header.level
         size = self._loaded_header.size
         file.seek(self._loaded_header.idx)
-        file = level_decompile(level, file, size)
+        file = level_decompile(level, file, size, self._loaded_header.params)
         return file
 
-    def _get_header(self, secure, compression, size):
-        _header = f"{self.name};{self.location};{size if size else ''}\n"
+    def _writer(self, copy=True):
+        """
+        Context manager, yields the location to write to
+        (a new generation of the file, in concurrent mode,
+        a temporary file for a complete rewrite of a remote file)
+        """
+        if self.concurrent:
+            return copy_on_write(self.location, copy)
+        if not self.storage.local and not copy:
+            return self.storage.atomic_write(self.location)
+        return contextlib.nullcontext(self.location)
+
+    def _open_export(self, location):
+        return self.storage.open_stream(location)
+
+    def _get_sealer(self):
+        """
+        `Sealer` of the loaded (secured) database, None if it is not secured
+        """
+        from secure import Sealer
+        header = self._loaded_header
+        if header is None or not header.params.get("enc"):
+            return None
+        if self.key is None:
+            raise Exceptions.UnsupportedError(f"'{self.location}' is secured, a key is required", "_get_sealer")
+        compression = Compression.from_header(header.params) if header.level == "X" else None
+        return Sealer(self.key, compression)
+
+    def _read_value_segment(self):
+        """
+        The value segment as it is stored (sealed)
+        :return:
+        Its name and content
+        """
+        from tools import get_sub_header
+        header = self._loaded_header
+        file = self._get_ready_file()
+        head = file.read(1)
+        if head != b"+":
+            file.close()
+            raise Exceptions.CorruptionError(f"'{self.location}' has no value segment", "_read_value_segment")
+        _, _size, name, _ = get_sub_header(file, header.idx + 1, header.size)
+        content = file.read(_size)
+        file.close()
+        return name, content
+
+    def _get_values(self):
+        """
+        Content of the value segment (see `export(dedup=True)`),
+        read once, None if the file has none
+        """
+        if self._loaded_header is None or not self._loaded_header.params.get("vs"):
+            return None
+        if self._values is None:
+            name, content = self._read_value_segment()
+            sealer = self._get_sealer()
+            self._values = content if sealer is None else sealer.open(content, "+", name)
+        return self._values
+
+    def _in_place(self):
+        """
+        Whether the blocks of the file can be rewritten in place
+        (it is not compressed as a whole)
+        """
+        header = self._loaded_header
+        return header.level == "N" or bool(header.params.get("enc"))
+
+    @property
+    def version(self):
+        """
+        Format version of the file (see `records`),
+        new files are written in the latest one
+        """
+        if self._loaded_header is None:
+            return VERSION
+        return self._loaded_header.params.get("v", 1)
+
+    def _get_header(self, secure, compression, size, version=1, dedup=False):
+        params = [compression.header()] if compression else []
+        if secure:
+            params.append("enc=1")
+        if version > 1:
+            params.append(f"v={version}")
+        if dedup:
+            params.append("vs=1")
+        if secure or not compression:  # Blocks can be rewritten in place (see `_bump_generation`)
+            params.append(f"g={0:0{GENERATION_WIDTH}d}")
+        params = f";{','.join(params)}" if params else ""
+        if secure:  # Elements are sealed (and compressed) on their own
+            _header = f"{self.name};{self.location};{params}\n"
+        elif compression:  # Fixed width, so the size can be filled in after the export
+            _header = f"{self.name};{self.location};{size:020d}{params}\n"
+        else:
+            _header = f"{self.name};{self.location};{size if size else ''}{params}\n"
         if secure and compression:
             _header = "X" + _header
         elif secure:
@@ -231,56 +691,202 @@ class DataBase:
 
         return _header.encode()
 
-    def export(self, secure=False, compression=False):
+    def export(self, secure=False, compression=False, incremental=False, version=VERSION, dedup=False):
         """
         Export an entire database to a file
         :param secure:
-        Not implemented
+        Whether to encrypt the elements (AES-GCM), requires the `key`
         :param compression:
-        Whether to compress using ZSTD
-        """
-        size = 0
-        if compression:
-            gen = self.assemble()
-            zstd = zst.ZstdCompressor()
-            with self.file_open(self.location, 'wb') as file:
-                stream = zstd.stream_writer(file)
-                for asm in gen:
-                    stream.write(asm)
-                    stream.write(b'\n')
-                    size += (len(asm) + 1)
-                file.seek(0)
-                file.write(self._get_header(secure, compression, size))
+        Whether to compress using ZSTD, True or
+        `Compression` (level, threads, long-distance matching, ...)
+        :param incremental:
+        Keep the blocks in the file, only append new and changed
+        elements and mark the old (and deleted) blocks as dead.
+        Elements which have not been loaded are kept.
+        (only for the level of the file, if it is not compressed as a whole,
+        in concurrent mode the file is still copied)
+        :param version:
+        Format version (see `records`), an incremental export
+        keeps the version of the file
+        :param dedup:
+        Store every value (and Jar) which occurs more than once only once,
+        in the value segment (see `records.ValueTable`), version 2 only.
+        An incremental export keeps the segment of the file
+        """
+        self._settle()
+        if compression is True:
+            compression = Compression()
+        if dedup and version < 2:
+            raise Exceptions.UnsupportedError("Deduplication requires format version 2", "export")
+        if incremental and self._loaded_header is not None:
+            if self._get_header(secure, compression, 0)[:1].decode() != self._loaded_header.level \
+                    or not self._in_place():
+                raise Exceptions.UnsupportedError("Incremental export is only supported for the level of the file, "
+                                                  "if it is not compressed as a whole", "export")
+            with self._writer() as location:
+                self._incremental_export(location)
+        else:
+            with self._writer(copy=False) as location:
+                self._export(location, secure, compression, version, dedup=dedup)
+        for element in self.elements.values():
+            element.dirty = False
+        self._deleted = set()
+        self.storage.reopen()  # The file may have been replaced
+        self.reload()
+
+    def _incremental_export(self, location):
+        pending = {name: element for name, element in self.elements.items() if element.dirty}
+        dead = []
+        sealer = self._get_sealer()
+        file = self._get_ready_file('r+b', location)
+        size = self._loaded_header.size
+        idx = self._loaded_header.idx
+        while True:
+            _type, _size, idx, _name, _digest, _start = self._get_sub_header_item(file, size, idx)
+            if _type is None:
+                break
+            if _name in self._deleted and _name not in pending:
+                dead.append(_start)
+            elif _name in pending:
+                asm = self._indiv_asm(pending[_name], sealer)
+                if self._hash_compare(file, _size, asm, True, digest=_digest):  # Unchanged
+                    del pending[_name]
+                else:
+                    dead.append(_start)
+            file.seek(_size + 1, 1)
+            idx += _size + 1
+
+        # Append first, so an interruption never loses an element
+        file.seek(size, 0)
+        for element in pending.values():
+            file.write(self._indiv_asm(element, sealer))
+            file.write(b'\n')
+        for start in dead:
+            file.seek(start, 0)
+            file.write(b'-')
+        file.close()
+
+    def _export(self, location, secure, compression, version, elements=None, dedup=False):
+        from secure import Sealer
+        if elements is None:
+            elements = self.elements.values()
+        sealer = None
+        if secure:
+            if self.key is None:
+                raise Exceptions.UnsupportedError("A secured export requires a key", "export")
+            sealer = Sealer(self.key, compression or None)
+        values = self._value_table(elements) if dedup else None
+
+        with self._open_export(location) as file:
+            if compression and not secure:  # Compressed as a whole
+                size = 0
+                file.write(self._get_header(secure, compression, size, version, dedup))
+                import zstandard as zst
+                zstd = zst.ZstdCompressor(compression_params=compression.params())
+                stream = zstd.stream_writer(file, closefd=False)
+                if values is not None:
+                    size += self._write_value_segment(stream, values)
+                for element in elements:
+                    size += self._write_element(stream, element, version=version, seekable=False, values=values)
                 stream.close()
-            return
+                file.seek(0)
+                file.write(self._get_header(secure, compression, size, version, dedup))
+                return
 
-        gen = self.assemble()
-        with self.file_open(self.location, 'wb') as file:
-            file.write(self._get_header(secure, compression, None))
-            for asm in gen:
-                file.write(asm)
-                file.write(b'\n')
-                size += (len(asm) + 1)
+            file.write(self._get_header(secure, compression, None, version, dedup))
+            if values is not None:
+                self._write_value_segment(file, values, sealer)
+            for element in elements:
+                self._write_element(file, element, sealer, version, values=values)
 
-    def _indiv_asm(self, element):
-        _t = type(element)
-        if _t == Cluster:
-            _header = "="
-        else:
-            _header = "?"
-        fmt = element.eval()
-        _header += f"{element.title}:{len(fmt)}\n"
-        return _header.encode() + fmt
+    @staticmethod
+    def _value_table(elements):
+        """
+        First pass of a deduplicated export, collects
+        the values which occur more than once
+        """
+        values = ValueTable()
+        for element in elements:
+            if isinstance(element, Jar):
+                values.count(element.eval())
+                continue
+            for particle in element.particles.values():
+                if particle.borrows is None:
+                    values.count(particle.value)
+        return values
 
-    def assemble(self):
+    @staticmethod
+    def _write_value_segment(file, values, sealer=None):
+        """
+        Write the value segment (the first block of the file)
+        :return:
+        Amount of bytes written
+        """
+        content = bytes(values.segment)
+        if sealer is not None:
+            content = sealer.seal(content, "+", VALUE_SEGMENT)
+        block = f"+{VALUE_SEGMENT}:{len(content)}:{block_digest(content)}\n".encode() + content + b"\n"
+        file.write(block)
+        return len(block)
+
+    def _write_element(self, file, element, sealer=None, version=None, seekable=True, values=None):
+        """
+        Write an element (and the newline after it) to an export.
+        Jars are pickled straight into the file, with a placeholder
+        sub-header which is filled in after, if `file` is not `seekable`
+        they are pickled into a spool (on disk, if it gets big) first
+        :param values:
+        `ValueTable` of a deduplicated export
+        :return:
+        Amount of bytes written
+        """
+        # Sealing needs the whole content, so does the look-up of a Jar in the value segment
+        if sealer is not None or values is not None or not isinstance(element, Jar):
+            asm = self._indiv_asm(element, sealer, version, values) + b'\n'
+            file.write(asm)
+            return len(asm)
+        if not seekable:
+            with tempfile.SpooledTemporaryFile(EXPORT_BUFSIZE) as spool:
+                content = DigestWriter(spool)
+                element.dump(content)
+                header = jar_sub_header(element.title, content.size, content.hexdigest())
+                file.write(header)
+                spool.seek(0)
+                shutil.copyfileobj(spool, file, EXPORT_BUFSIZE)
+                file.write(b'\n')
+            return len(header) + content.size + 1
+
+        start = file.tell()
+        header = jar_sub_header(element.title, 0, "0" * DIGEST_WIDTH, SIZE_WIDTH)
+        file.write(header)
+        content = DigestWriter(file)
+        element.dump(content)
+        file.write(b'\n')
+        end = file.tell()
+        file.seek(start)
+        file.write(jar_sub_header(element.title, content.size, content.hexdigest(), SIZE_WIDTH))
+        file.seek(end)
+        return end - start
+
+    def _indiv_asm(self, element, sealer=None, version=None, values=None):
+        return assemble_block(element, sealer, self.version if version is None else version, values)
+
+    def assemble(self, sealer=None, version=None, elements=None):
         """
         Assemble the database to a bytes representation
+        :param sealer:
+        `Sealer` to encrypt the elements with
+        :param version:
+        Format version, None for the version of the file
+        :param elements:
+        Iterable of the elements, instead of `self.elements`
         :return:
         A generator of the sub-headers and their contents
         """
-        for element_name in self.elements.keys():
-            element = self.elements[element_name]
-            yield self._indiv_asm(element)
+        if elements is None:
+            elements = self.elements.values()
+        for element in elements:
+            yield self._indiv_asm(element, sealer, version)
 
     def add(self, element):
         """
@@ -289,14 +895,18 @@ class DataBase:
         Element
         """
         self.elements[element.title] = element
+        self._deleted.discard(element.title)
 
     def delete(self, name):
         """
-        Delete an element from the database IMR (In-Memory-Representation)
+        Delete an element from the database IMR (In-Memory-Representation),
+        it is also removed from the file by an incremental `export`
+        (even if it has not been loaded)
         :param name:
         Name of the element
         """
-        del self.elements[name]
+        self.elements.pop(name, None)
+        self._deleted.add(name)
 
     def find(self, name, maintain_borrows=True):
         """
@@ -309,18 +919,19 @@ class DataBase:
         Generator of results
         """
         from tools import find_sub_header
+        self._settle()
+        snapshot = self.storage.snapshot()  # Both passes read the same version of the file
+        _reg_stream_file = self._get_ready_file(snapshot=snapshot)
         size = self._loaded_header.size
         idx = self._loaded_header.idx
-        _reg_stream_file = self._get_ready_file()
-        _reg_stream_file.seek(idx)
+        base = _reg_stream_file.tell()  # Start of the elements in the stream (0 when decompressed)
         res = find_sub_header(_reg_stream_file, name)
-        file = self._get_ready_file()
+        file = self._get_ready_file(snapshot=snapshot)
         for (start, end) in res:
-            file.seek(idx + start)
-            _type, _size, idx, _name = self._get_sub_header_item(file, size, start)
-            idx += _size
-            __idx = copy.copy(idx)
-            yield self._construct_sub_header(file, _size, size, __idx, idx, maintain_borrows, _type, _name)
+            file.seek(base + start)
+            _type, _size, _idx, _name, _digest, _start = self._get_sub_header_item(file, size, idx + start)
+            __idx = copy.copy(_idx)
+            yield self._construct_sub_header(file, _size, size, __idx, _idx, maintain_borrows, _type, _name)
 
         _reg_stream_file.close()
         file.close()
@@ -328,39 +939,36 @@ class DataBase:
     def __mproc_getID(self):
         return f'id{len(self.__mprocs)}'
 
-    async def __mproc_asm(self, _id, element) -> bytes:
+    def __mproc_asm(self, _id, element, sealer=None) -> threading.Thread:
         def _(_element):
-            self.__mprocs[_id] = self._indiv_asm(_element)
+            self.__mprocs[_id] = self._indiv_asm(_element, sealer)
 
         thread = threading.Thread(target=_, args=(element,))
         thread.start()
+        return thread
 
-    def _main_update_block(self, file, idx, blocksize, filesize, blockname, asm):
-        _asm_size = len(asm)
-        _header_size = len(str(blocksize)) + len(blockname) + 2
-        file.seek(idx - _header_size, 0)
-        idx = idx - _header_size
-        saved = copy.copy(idx)
-        if _asm_size == blocksize:  # Same size
-            file.write(asm)
-        elif _asm_size > blocksize:  # New one bigger than old one
-            idx += blocksize + _header_size + 1
-            file.seek(idx, 0)
-            mid = file.read(filesize - idx)
-            file.seek(saved)
-            file.write(asm)
-            file.write(mid)
-        else:  # New one smaller than old one
+    @traced("_main_update_block")
+    def _main_update_block(self, file, start, idx, blocksize, filesize, asm):
+        """
+        Replace the block from `start` (its sub-header) to the end of
+        its content (`idx` + `blocksize`) with `asm`
+        :return:
+        The end of the new block and the new filesize
+        """
+        end = idx + blocksize + 1  # Including the trailing newline
+        asm += b'\n'
+        if len(asm) == end - start:  # Same size
+            file.seek(start, 0)
             file.write(asm)
-            ts = (blocksize + _header_size + 1) - _asm_size
-            idx += _asm_size
-            rest_size = filesize - idx
-            file.seek(idx + ts)
-            mid = file.read(rest_size)
-            file.seek(idx)
-            file.write(mid)
-            idx += len(mid)
-            file.truncate(idx)
+            return start + len(asm), filesize
+        # Different size, shift the rest of the file
+        file.seek(end, 0)
+        rest = file.read(filesize - end)
+        file.seek(start, 0)
+        file.write(asm)
+        file.write(rest)
+        file.truncate(start + len(asm) + len(rest))
+        return start + len(asm), start + len(asm) + len(rest)
 
     def update(self, name, element=None, check=False):
         """
@@ -373,33 +981,97 @@ class DataBase:
         can save a lot of time if the time taken
         to write the change is significantly bigger
         than the time it takes to do a hash compare.
+        In write-behind mode (see `write_behind`) the update is
+        queued and the call returns at once.
         """
-        _id = self.__mproc_getID()
         if element is None:
             element = self.elements[name]
+        if self._behind is not None:
+            self._behind.put(name, element, check)
+            return
+        _id = self.__mproc_getID()
 
-        asyncio.run(self.__mproc_asm(_id, element))
-        level = self._loaded_header.level
-        size = self._loaded_header.size
-        idx = self._loaded_header.idx
-        file = self._get_ready_file()
-        while True:
-            _type, _size, idx, _name = self._get_sub_header_item(file, size, idx)
-            if name == _name:
-                break
-            else:
-                file.seek(_size + 1, 1)
+        thread = self.__mproc_asm(_id, element, self._get_sealer())
 
-        asm = self.__mprocs[_id]
-        if check and self._hash_compare(file, _size, asm, level == "N"):
-            return
+        def asm():
+            thread.join()  # Assembled while the sub-header was searched
+            return self.__mprocs[_id]
 
-        if not level == "N":
-            raise Exceptions.UnsupportedError(f"The level '{level}' is not supported (might get changed in the future)",
-                                              "update_all")
-        self._main_update_block(file, idx, _size, size, _name, asm)
+        if not self._replace_block(name, asm, check):
+            return
+        element.dirty = False
+        self.reload()
 
-        file.close()
+    def _replace_block(self, name, asm, check=False):
+        """
+        Replace the block of an element (see `update`)
+        :param asm:
+        Callable, returns the new block (see `assemble_block`),
+        called after the old one has been found
+        :return:
+        Whether the block was written (False if it is the same)
+        """
+        with self._writer() as location:
+            file = self._get_ready_file('r+b', location)
+            level = self._loaded_header.level
+            size = self._loaded_header.size
+            idx = self._loaded_header.idx
+            while True:
+                _type, _size, idx, _name, _digest, _start = self._get_sub_header_item(file, size, idx)
+                if _type is None:
+                    file.close()
+                    raise Exceptions.SubHeadError(f"There is no element '{name}'", "update")
+                if name == _name:
+                    break
+                else:
+                    file.seek(_size + 1, 1)
+                    idx += _size + 1
+
+            asm = asm()
+            if check and self._hash_compare(file, _size, asm, self._in_place(), digest=_digest):
+                file.close()
+                return False
+
+            if not self._in_place():
+                file.close()
+                raise Exceptions.UnsupportedError(f"The level '{level}' is not supported (might get changed in the future)",
+                                                  "update")
+            _, size = self._main_update_block(file, _start, idx, _size, size, asm)
+            self._bump_generation(file, size)
+
+            file.close()
+        return True
+
+    def _bump_generation(self, file, filesize):
+        """
+        Count a rewrite of blocks in place in the header (its parameter ``g``),
+        so readers know the file did not only grow (see `refresh`).
+        The generation has a fixed width, the header of a file which has
+        none yet gets longer once (the rest of the file is shifted)
+        :param file:
+        The file (opened to write, see `_in_place`)
+        :return:
+        The new filesize
+        """
+        header = self._loaded_header
+        file.seek(0, 0)
+        line = file.read(header.idx)
+        name, location, rest = line[:-1].decode().split(";", 2)
+        size, _, params = rest.partition(";")
+        params = dict(param.split("=") for param in params.split(",")) if params else {}
+        params["g"] = f'{(int(params.get("g", 0)) + 1) % 10 ** GENERATION_WIDTH:0{GENERATION_WIDTH}d}'
+        params = ",".join(f'{key}={value}' for key, value in params.items())
+        new = f'{name};{location};{size};{params}\n'.encode()
+        if len(new) == len(line):
+            file.seek(0, 0)
+            file.write(new)
+            return filesize
+        rest = file.read(filesize - len(line))
+        file.seek(0, 0)
+        file.write(new)
+        file.write(rest)
+        file.truncate(len(new) + len(rest))
+        return len(new) + len(rest)
 
     def __attr_get(self, item):
         if type(item) is int:
@@ -422,9 +1094,11 @@ class DataBase:
         self.elements[key] = value
 
     @staticmethod
-    def _hash_compare(file, size, cmp, rewindable, with_header=True):
+    def _hash_compare(file, size, cmp, rewindable, with_header=True, digest=None):
         if with_header:
             header, cmp = cmp.split(b"\n", 1)
+        if digest is not None:  # Stored at export, the old block does not have to be read
+            return block_digest(cmp) == digest
         _cmp = sha1(cmp)
         loaded = file.read(size)
         hashed = sha1(loaded)
@@ -432,9 +1106,64 @@ class DataBase:
             file.seek(-size, 1)  # Normally we could just use file.seek(-size, 1), but we must support compression
         return _cmp.digest() == hashed.digest()
 
+    def freeze(self, path):
+        """
+        Write a read-only snapshot of the database for fast lookups
+        of single values (see `frozen.FrozenDataBase`), the loaded
+        elements are written as they are in memory
+        :param path:
+        Filename of the snapshot (a local file)
+        :return:
+        Amount of keys
+        """
+        from frozen import freeze
+        self._settle()
+        return freeze(self, path)
+
+    def verify(self, workers=None):
+        """
+        Check the content of every element against the
+        checksum stored in its sub-header, in parallel
+        (elements exported without a checksum are not checked).
+        The elements are streamed, only a few per thread are in memory
+        (the blocks of a local file which is not compressed as a whole
+        are read by the threads themselves)
+        :param workers:
+        Amount of threads
+        :return:
+        List of the names of the corrupted elements
+        """
+        from tools import iter_elements
+        self._settle()
+        size = self._loaded_header.size
+        idx = self._loaded_header.idx
+        ranged = self.storage.local and self._in_place()
+
+        def _(element):
+            head, name, content, digest = element
+            if type(content) is tuple:
+                content = self._read_range(content[1], content[2])
+            return name if block_digest(content) != digest else None
+
+        corrupted = []
+        pending = collections.deque()
+        file = self._get_ready_file('rb')
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)  # The default of `ThreadPoolExecutor`
+        with ThreadPoolExecutor(workers) as executor:
+            for element in iter_elements(file, size, idx, self.location if ranged else None, b"=?"):
+                if element[3] is None:
+                    continue
+                pending.append(executor.submit(_, element))
+                if len(pending) >= workers * 4:  # In flight
+                    corrupted.append(pending.popleft().result())
+            corrupted += [future.result() for future in pending]
+        file.close()
+        return [name for name in corrupted if name is not None]
+
     def update_all(self, check=True):
         """
-        Update all elements
+        Update all changed (dirty) elements,
+        new elements are appended
         NOTE : Please only use if you have small changes,
         it is more effective to use `export` for
         big changes.
@@ -444,70 +1173,137 @@ class DataBase:
         to write the change is significantly bigger
         than the time it takes to do a hash compare.
         """
-        level = self._loaded_header.level
-        size = self._loaded_header.size
-        idx = self._loaded_header.idx
-        file = self._get_ready_file()
-        while True:
-            _id = self.__mproc_getID()
-            _type, _size, idx, _name = self._get_sub_header_item(file, size, idx)
-            if _type is None:
-                break
-            asyncio.run(self.__mproc_asm(_id, self.elements[_name]))
-            asm = self.__mprocs[_id]
-            if check and self._hash_compare(file, _size, asm, level == "N"):
-                return
-            if not level == "N":
-                raise Exceptions.UnsupportedError(f"The level '{level}' is not supported", "update_all")
-            self._main_update_block(file, idx, _size, size, _name, asm)
-        file.close()
+        self._settle()
+        dirty = {name: element for name, element in self.elements.items() if element.dirty}
+        if not dirty:
+            return
+        sealer = self._get_sealer()
+        self._update_elements(dirty, lambda name, element: self._indiv_asm(element, sealer),
+                              set(dirty) if check else set())
 
+    def _update_elements(self, elements, assemble, check, append=True):
+        """
+        Replace the blocks of several elements, in one pass over the file
+        (see `update_all`)
+        :param elements:
+        Dict of name -> element
+        :param assemble:
+        Callable (name, element), returns the new block
+        :param check:
+        Set of the names whose block is compared with the new one first
+        :param append:
+        Append the elements which are not in the file,
+        else they raise a `SubHeadError` (after the others are written)
+        """
+        elements = dict(elements)
+        rewritten = False
+        with self._writer() as location:
+            file = self._get_ready_file('r+b', location)
+            level = self._loaded_header.level
+            size = self._loaded_header.size
+            idx = self._loaded_header.idx
+            while elements:
+                _type, _size, idx, _name, _digest, _start = self._get_sub_header_item(file, size, idx)
+                if _type is None:
+                    break
+                if _name not in elements:
+                    file.seek(_size + 1, 1)
+                    idx += _size + 1
+                    continue
+                element = elements.pop(_name)
+                asm = assemble(_name, element)
+                if _name in check and self._hash_compare(file, _size, asm, self._in_place(), digest=_digest):
+                    file.seek(_size + 1, 1)
+                    idx += _size + 1
+                else:
+                    if not self._in_place():
+                        file.close()
+                        raise Exceptions.UnsupportedError(f"The level '{level}' is not supported", "update_all")
+                    idx, size = self._main_update_block(file, _start, idx, _size, size, asm)
+                    file.seek(idx, 0)
+                    rewritten = True
+                element.dirty = False
+            if rewritten:  # Appended elements are found by `refresh` without it
+                size = self._bump_generation(file, size)
+            if elements and append:  # Not in the file yet
+                if not self._in_place():
+                    file.close()
+                    raise Exceptions.UnsupportedError(f"The level '{level}' is not supported", "update_all")
+                file.seek(size, 0)
+                for name, element in elements.items():
+                    file.write(assemble(name, element))
+                    file.write(b'\n')
+                    element.dirty = False
+            file.close()
+        self.reload()
+        if elements and not append:
+            raise Exceptions.SubHeadError(f"There is no element '{next(iter(elements))}'", "update")
+
+    @traced("_get_sub_header_item")
     def _get_sub_header_item(self, file, size, idx):
+        """
+        Read the next sub-header (skipping dead blocks)
+        :return:
+        Type, size, index of the content, name, checksum
+        and the index of the sub-header
+        """
         from tools import get_sub_header
         while size > idx:
+            start = idx
             head = file.read(1).decode()
             idx += 1
             match head:
                 case "=":  # Cluster
-                    idx, _size, _name = get_sub_header(file, idx, size)
+                    idx, _size, _name, digest = get_sub_header(file, idx, size)
                     t = "="
                 case "?":  # Jar (Pickle)
-                    idx, _size, _name = get_sub_header(file, idx, size)
+                    idx, _size, _name, digest = get_sub_header(file, idx, size)
                     t = "?"
+                case "-" | "+":  # Dead block (see `export(incremental=True)`), value segment
+                    idx, _size, _name, digest = get_sub_header(file, idx, size)
+                    file.seek(_size + 1, 1)
+                    idx += _size + 1
+                    continue
                 case "":  # EOF
-                    return None, None, idx, None
+                    return None, None, idx, None, None, idx
                 case _:
                     print(head.encode())
                     raise Exceptions.SubHeadError(f"Invalid sub-header '{head}'", "_get_sub_header_item")
 
-            return t, _size, idx, _name
+            return t, _size, idx, _name, digest, start
+        return None, None, idx, None, None, idx
 
     def _construct_sub_header(self, file, _size, size, __idx, idx, mt_br, _type, name):
-        from tools import load_cluster_B, open_jar_B
+        from tools import load_cluster_B, open_jar_B, open_sealed
+        sealer = self._get_sealer()
+        values = self._get_values()
+        if sealer is not None and _type is not None:  # Sealed element (see `secure.Sealer`)
+            return open_sealed(file, _type, name, _size, idx, mt_br, sealer, self.version, values)[0]
         match _type:
             case "=":  # Cluster
-                return load_cluster_B(name, mt_br, file, _size, idx, size, __idx)[0]
+                return load_cluster_B(name, mt_br, file, _size, idx, size, __idx, self.version, values)[0]
             case "?":  # Jar (Pickle)
-                return open_jar_B(file, name, _size, idx)[0]
+                return open_jar_B(file, name, _size, idx, values)[0]
 
     def _get_sub_header_by_name(self, name, file, size, idx, mt_br):
         while True:
-            _type, _size, idx, _name = self._get_sub_header_item(file, size, idx)
+            _type, _size, idx, _name, _digest, _start = self._get_sub_header_item(file, size, idx)
             if name == _name:
                 break
             else:
                 file.read(_size + 1)
                 idx += _size + 1
-        idx += _size
         __idx = copy.copy(idx)
         return self._construct_sub_header(file, _size, size, __idx, idx, mt_br, _type, _name)
 
     def _get_sub_headers_by_amount(self, amount, file, size, idx, mt_br):
         for i in range(amount):
-            _type, _size, idx, _name = self._get_sub_header_item(file, size, idx)
-            idx += _size
+            _type, _size, idx, _name, _digest, _start = self._get_sub_header_item(file, size, idx)
+            if _type is None:  # Fewer elements than requested
+                return
             __idx = copy.copy(idx)
             yield self._construct_sub_header(file, _size, size, __idx, idx, mt_br, _type, _name)
+            idx += _size + 1
 
     def __gen_load(self, file, amount, size, idx, maintain_borrows):
         for i in self._get_sub_headers_by_amount(amount, file, size, idx, maintain_borrows):
@@ -518,8 +1314,8 @@ class DataBase:
 
     def __repr__(self):
         res = f"Database {self.name} ({self.get_size()}) at {self.location}"
-        if self.RDA:
-            res += " [REMOTE]"
+        if self.storage.label:
+            res += f" [{self.storage.label}]"
         res += "\n"
         res += f"ELEMENTS (LOADED) : {len(self.elements)}\n"
         return res
@@ -544,6 +1340,7 @@ class DataBase:
         When using amount:
             Generator of loaded `Cluster` or `Jar`
         """
+        self._settle()
         if name == amount is None or name and amount:
             raise Exception
         size = self._loaded_header.size
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tools
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    # The index of loaded elements is global (see `tools.clean`)
+    tools.clean()
+    yield
+    tools.clean()
@@ -0,0 +1,112 @@
+import io
+
+import pytest
+
+import tools
+from agent import Agent, SubprocessTransport, write_frame, read_frame
+from exceptions import Exceptions
+from secure import Sealer
+from stats import Stats
+from structures import DataBase, Cluster, Atom, Pin, Jar
+
+KEY = Sealer.generate_key()
+LEVELS = {
+    "N": {},
+    "v1": {"version": 1},
+    "C": {"compression": True},
+    "S": {"secure": True},
+    "X": {"secure": True, "compression": True},
+}
+
+
+def export(location, **kwargs):
+    database = DataBase("a", location, key=KEY)
+    atom = Atom("hello", "world")
+    database.add(Cluster("words", [atom, Atom("msg", atom.borrow()), Pin("pinv")]))
+    database.add(Jar("jar", [1, 2, 3]))
+    for i in range(200):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", f"value{i}" * 20), Pin(f"p{i}")]))
+    database.export(**kwargs)
+
+
+@pytest.fixture
+def agent(tmp_path, request):
+    export(str(tmp_path / "a.db"), **LEVELS[request.param])
+    stats = Stats()
+    with Agent(SubprocessTransport(cwd=str(tmp_path)), "a.db", KEY, stats) as agent:
+        yield agent
+
+
+@pytest.mark.parametrize("agent", LEVELS, indirect=True)
+def test_load_and_find(agent):
+    cluster = agent.load("c7")
+    assert cluster["a7"].value == b"value7" * 20
+    assert sorted(particle.value for particle in cluster.particles.values()) == [b"p7", b"value7" * 20]
+    assert agent.load("jar").obj == [1, 2, 3]
+    assert [element.title for element in agent.find("words", False)] == ["words"]
+    assert list(agent.find("nope")) == []
+    with pytest.raises(Exceptions.SubHeadError):
+        agent.load("nope")
+    # Only the element crossed the wire
+    assert agent.stats.bytes_read < 2000
+
+
+@pytest.mark.parametrize("agent", LEVELS, indirect=True)
+def test_search(agent):
+    assert len(agent.search(r"^c1\d\d$", names=True)) == 100
+    if agent.params.get("enc"):
+        with pytest.raises(Exceptions.UnsupportedError):
+            agent.search("value199")
+    else:
+        assert [element.title for element in agent.search("value199")] == ["c199"]
+
+
+@pytest.mark.parametrize("agent", LEVELS, indirect=True)
+def test_update(tmp_path, agent):
+    jar = Jar("jar", list(range(10)))
+    if agent.level == "C":
+        with pytest.raises(Exceptions.UnsupportedError):
+            agent.update("jar", jar)
+        return
+    assert agent.update("jar", jar)
+    assert agent.load("jar").obj == list(range(10))
+    tools.clean()
+    assert tools.load(str(tmp_path / "a.db"), key=KEY)["jar"].obj == list(range(10))
+
+
+@pytest.mark.parametrize("agent", ["N"], indirect=True)
+def test_error_frames(agent):
+    with pytest.raises(Exceptions.UnsupportedError):
+        agent._request("bogus")
+    with pytest.raises(Exceptions.UnsupportedError) as error:
+        agent.search("(unbalanced")  # Not an error of poki
+    assert "in the agent" in error.value.msg
+    assert agent.load("c1")["a1"].value == b"value1" * 20  # The agent keeps serving
+
+
+def test_missing_database(tmp_path):
+    with pytest.raises(Exceptions.HeaderError):
+        Agent(SubprocessTransport(cwd=str(tmp_path)), "missing.db")
+
+
+def test_stopped(tmp_path):
+    export(str(tmp_path / "a.db"))
+    transport = SubprocessTransport(cwd=str(tmp_path))
+    agent = Agent(transport, "a.db")
+    transport.process.kill()
+    transport.process.wait()
+    with pytest.raises((Exceptions.BufferError, BrokenPipeError)):
+        agent.load("c1")
+
+
+def test_frames():
+    file = io.BytesIO()
+    write_frame(file, {"op": "load"}, b"\x00payload\n")
+    write_frame(file, {"op": "find"})
+    data = file.getvalue()
+    file = io.BytesIO(data)
+    assert read_frame(file) == ({"op": "load"}, b"\x00payload\n")
+    assert read_frame(file) == ({"op": "find"}, b"")
+    assert read_frame(file) is None
+    with pytest.raises(Exceptions.BufferError):
+        read_frame(io.BytesIO(data[:10]))
@@ -0,0 +1,132 @@
+import threading
+
+import pytest
+
+from exceptions import Exceptions
+from structures import DataBase, Cluster, Atom, Jar
+
+
+def export(location):
+    database = DataBase("w", location)
+    database.add(Cluster("c", [Atom("a", "0")]))
+    database.add(Jar("j", [0]))
+    for i in range(50):
+        database.add(Cluster(f"x{i}", [Atom("v", "x" * 20)]))
+    database.export()
+    database = DataBase("w", location)
+    database.load(name="c")
+    database.load(name="j")
+    return database
+
+
+def stored(location, name):
+    return DataBase("w", location).load(name=name)
+
+
+def test_coalesced(tmp_path):
+    location = str(tmp_path / "w.db")
+    database = export(location)
+    with database.write_behind(max_pending=10, delay=60) as behind:
+        for i in range(100):
+            database["c"]["a"] = Atom("a", str(i))
+            database.update("c")
+            database["j"].obj = [i]
+            database.update("j")
+        assert behind.coalesced == 198
+        assert stored(location, "c")["a"].value == b"0"  # Not written yet
+    assert stored(location, "c")["a"].value == b"99"
+    assert stored(location, "j").obj == [99]
+    assert database._behind is None
+
+
+def test_assembled_on_update(tmp_path):
+    location = str(tmp_path / "w.db")
+    database = export(location)
+    behind = database.write_behind(delay=60)
+    database["c"]["a"] = Atom("a", "queued")
+    database.update("c")
+    assert not database["c"].dirty
+    database["c"]["a"] = Atom("a", "later")  # Not part of the queued update
+    assert database["c"].dirty
+    behind.flush()
+    assert stored(location, "c")["a"].value == b"queued"
+    behind.close()
+
+
+def test_changed_while_written(tmp_path):
+    location = str(tmp_path / "w.db")
+    database = export(location)
+    cluster = database["c"]
+    errors = []
+
+    with database.write_behind(max_pending=1, delay=0):
+        for i in range(300):  # The thread writes while the Cluster grows
+            try:
+                cluster.add(Atom(f"n{i}", str(i)))
+                database.update("c")
+            except Exception as ex:
+                errors.append(ex)
+    assert errors == []
+    assert len(stored(location, "c").particles) == 301
+
+
+def test_assembly_error(tmp_path):
+    location = str(tmp_path / "w.db")
+    database = export(location)
+    deep = []
+    for _ in range(100000):
+        deep = [deep]
+    with database.write_behind(delay=60):
+        database["c"]["a"] = Atom("a", "2")
+        database.update("c")
+        database["j"].obj = deep
+        with pytest.raises(RecursionError):  # Raised by update itself
+            database.update("j")
+    assert stored(location, "c")["a"].value == b"2"
+    assert stored(location, "j").obj == [0]
+
+
+def test_write_error(tmp_path):
+    location = str(tmp_path / "w.db")
+    database = export(location)
+    behind = database.write_behind(delay=60)
+    database.update("missing", Jar("missing", 1))
+    database["c"]["a"] = Atom("a", "3")
+    database.update("c")
+    with pytest.raises(Exceptions.SubHeadError):
+        behind.flush()
+    assert stored(location, "c")["a"].value == b"3"  # The others are written
+    behind.flush()  # The error is raised once
+    behind.close()
+    with pytest.raises(Exceptions.UnsupportedError):
+        behind.put("c", database["c"])
+
+
+def test_read_writes_first(tmp_path):
+    location = str(tmp_path / "w.db")
+    database = export(location)
+    database.write_behind(delay=60)
+    database["c"]["a"] = Atom("a", "4")
+    database.update("c")
+    assert [cluster["a"].value for cluster in database.find("c")] == [b"4"]
+    database.close()
+    assert stored(location, "c")["a"].value == b"4"
+
+
+def test_background_write(tmp_path):
+    location = str(tmp_path / "w.db")
+    database = export(location)
+    behind = database.write_behind(delay=0.05)
+    written = threading.Event()
+    original = behind._write
+
+    def write():
+        original()
+        if not behind.pending:
+            written.set()
+    behind._write = write
+    database["c"]["a"] = Atom("a", "5")
+    database.update("c")
+    assert written.wait(5)
+    assert stored(location, "c")["a"].value == b"5"
+    behind.close()
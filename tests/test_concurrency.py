@@ -0,0 +1,59 @@
+import multiprocessing
+
+import tools
+from structures import DataBase, Cluster, Atom, Jar
+
+
+def fill(database, pad=""):
+    for i in range(50):
+        database.add(Cluster(f"c{i}", [Atom("i", str(i)), Atom("pad", pad)]))
+    database.add(Jar("counter", 0))
+
+
+def rewrite(location, pad):
+    writer = DataBase("c", location, concurrent=True)
+    fill(writer, pad)
+    writer.export()
+
+
+def test_find_one_snapshot(tmp_path, monkeypatch):
+    location = str(tmp_path / "c.db")
+    rewrite(location, "")
+    reader = DataBase("c", location, concurrent=True)
+    scan = tools.find_sub_header
+
+    def replaced_after_scan(file, name):
+        found = list(scan(file, name))
+        rewrite(location, "x" * 100)  # Moves every element
+        return iter(found)
+    monkeypatch.setattr(tools, "find_sub_header", replaced_after_scan)
+    found, = reader.find("c25")
+    assert found["i"].value == b"25"
+    assert found["pad"].value == b""
+    monkeypatch.undo()
+    found, = reader.find("c25")  # The next find sees the new file
+    assert found["pad"].value == b"x" * 100
+
+
+def write(location, count):
+    writer = DataBase("c", location, concurrent=True)
+    for i in range(count):
+        writer.update("counter", Jar("counter", list(range(i % 50))))
+
+
+def test_readers_see_whole_snapshots(tmp_path):
+    location = str(tmp_path / "c.db")
+    rewrite(location, "v" * 50)
+    process = multiprocessing.get_context("spawn").Process(target=write, args=(location, 200))
+    process.start()
+    reader = DataBase("c", location, concurrent=True)
+    try:
+        while process.is_alive():
+            cluster, = reader.find("c40")
+            assert cluster["i"].value == b"40"
+            assert isinstance(reader.load(name="counter").obj, (int, list))
+            tools.clean()
+    finally:
+        process.join()
+    assert process.exitcode == 0
+    assert DataBase("c", location).load(name="counter").obj == list(range(199 % 50))
@@ -0,0 +1,102 @@
+import io
+import os
+import random
+
+import pytest
+
+from agent import Agent, SubprocessTransport
+from delta import checksums, diff, patch, file_digest, block_size, LITERAL
+from exceptions import Exceptions
+from structures import DataBase, Cluster, Atom
+
+BLOCK = 64
+
+
+def apply(old, new, block=BLOCK, limit=None):
+    delta = diff(new, checksums(old, block), block, len(old), limit)
+    if delta is None:
+        return None, None
+    target = io.BytesIO()
+    assert patch(io.BytesIO(old), delta, block, target) == file_digest(new)
+    assert target.getvalue() == new
+    return delta, target.getvalue()
+
+
+OLD = random.Random(0).randbytes(BLOCK * 50 + 17)  # With a short last block
+
+
+@pytest.mark.parametrize("new", [
+    OLD,
+    b"",
+    b"head" + OLD,
+    OLD[:BLOCK * 10] + b"inserted" + OLD[BLOCK * 10:],
+    OLD[:BLOCK * 10 + 5] + OLD[BLOCK * 12:],  # Deleted
+    OLD[:BLOCK * 20] + b"x" * 10 + OLD[BLOCK * 20 + 10:],  # Changed
+    OLD + b"tail",
+    OLD[BLOCK * 25:] + OLD[:BLOCK * 25],  # Moved
+    OLD[:-17],
+])
+def test_round_trip(new):
+    delta, _ = apply(OLD, new)
+    assert len(delta) < max(len(new) // 4, 100) or not new  # The blocks are copied
+
+
+def test_empty_old():
+    new = b"new file" * 100
+    delta, _ = apply(b"", new)
+    assert delta[0] == LITERAL and len(delta) > len(new)
+
+
+def test_random_changes():
+    rand = random.Random(1)
+    for _ in range(20):
+        new = bytearray(OLD)
+        for _ in range(rand.randint(1, 5)):
+            pos = rand.randrange(len(new))
+            new[pos:pos + rand.randint(0, 100)] = rand.randbytes(rand.randint(0, 100))
+        apply(OLD, bytes(new))
+
+
+def test_limit():
+    new = random.Random(2).randbytes(len(OLD))
+    assert apply(OLD, new, limit=1000) == (None, None)
+    assert apply(OLD, OLD, limit=0)[0] is not None
+
+
+def test_invalid_delta():
+    with pytest.raises(Exceptions.CorruptionError):
+        patch(io.BytesIO(OLD), b"\x07", BLOCK, io.BytesIO())
+
+
+def test_block_size():
+    assert block_size(0) == 1 << 11
+    assert block_size(10 ** 12) == 1 << 17
+    assert block_size(10 ** 7) ** 2 >= 10 ** 7
+
+
+def test_agent_patch(tmp_path):
+    database = DataBase("d", str(tmp_path / "d.db"))
+    for i in range(2000):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", os.urandom(16).hex())]))
+    database.export()
+    with open(tmp_path / "d.db", "rb") as file:
+        old = file.read()
+    database.load(name="c100")["a100"] = Atom("a100", "changed")
+    database.update_all()
+    with open(tmp_path / "d.db", "rb") as file:
+        new = file.read()
+    with open(tmp_path / "d.db", "wb") as file:
+        file.write(old)
+
+    with Agent(SubprocessTransport(cwd=str(tmp_path)), "d.db") as agent:
+        block = block_size(len(old))
+        size, sums = agent.checksums(block)
+        assert size == len(old)
+        delta = diff(new, sums, block, size)
+        assert len(delta) < len(new) // 10  # The header and the changed block
+        agent.patch("new.db", block, delta, file_digest(new))
+        with pytest.raises(Exceptions.CorruptionError):
+            agent.patch("bad.db", block, delta, file_digest(b"another file"))
+    with open(tmp_path / "new.db", "rb") as file:
+        assert file.read() == new
+    assert not (tmp_path / "bad.db").exists()
@@ -0,0 +1,33 @@
+import pytest
+
+from structures import DataBase, Cluster, Atom, Jar
+from secure import Sealer
+
+
+def fill(database, count=50):
+    for i in range(count):
+        database.add(Cluster(f"c{i}", [Atom("i", str(i)), Atom("pad", "x" * i)]))
+    database.add(Jar("jar", {"a": 1}))
+
+
+@pytest.mark.parametrize("secure,compression", [
+    (False, False),  # N
+    (False, True),  # C
+    (True, False),  # S
+    (True, True),  # X
+])
+def test_find_first_and_last(tmp_path, secure, compression):
+    location = str(tmp_path / "f.db")
+    key = Sealer.generate_key()
+    database = DataBase("f", location, key=key)
+    fill(database)
+    database.export(secure=secure, compression=compression)
+
+    database = DataBase("f", location, key=key)
+    first, = database.find("c0")
+    assert first["i"].value == b"0"
+    last, = database.find("jar")
+    assert last.obj == {"a": 1}
+    middle, = database.find("c25")
+    assert middle["pad"].value == b"x" * 25
+    assert list(database.find("c50")) == []
@@ -0,0 +1,95 @@
+import gc
+import os
+
+import pytest
+
+import tools
+from exceptions import Exceptions
+from frozen import FrozenDataBase, FrozenWriter, TABLES
+from secure import Sealer
+from structures import DataBase, Cluster, Atom, Pin, Jar
+
+KEY = Sealer.generate_key()
+
+
+def export(location, **kwargs):
+    database = DataBase("f", location, key=KEY)
+    expected = {}
+    for c in range(50):
+        particles = [Atom(f"a{c}_{a}", f"value{(c + a) % 7}" * 3) for a in range(5)] + [Pin("pinned")]
+        expected.update((f"c{c}/a{c}_{a}", f"value{(c + a) % 7}".encode() * 3) for a in range(5))
+        cluster = Cluster(f"c{c}", particles)
+        if c:
+            cluster.add(Atom(f"b{c}", database.elements[f"c{c - 1}"][f"a{c - 1}_0"].borrow()))
+            expected[f"c{c}/b{c}"] = expected[f"c{c - 1}/a{c - 1}_0"]
+        database.add(cluster)
+    for j in range(10):
+        database.add(Jar(f"j{j}", [j] * 5))
+        expected[f"j{j}"] = [j] * 5
+    database.export(**kwargs)
+    tools.clean()
+    return expected
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"compression": True}, {"secure": True},
+                                    {"secure": True, "compression": True}, {"dedup": True}, {"version": 1}])
+def test_freeze(tmp_path, kwargs):
+    location, path = str(tmp_path / "f.db"), str(tmp_path / "f.frozen")
+    expected = export(location, **kwargs)
+    database = DataBase("f", location, key=KEY)
+    database.load(name="c0").add(Atom("new", "x"))  # Loaded elements are frozen as they are in memory
+    expected["c0/new"] = b"x"
+    database.delete("j3")
+    del expected["j3"]
+    database.add(Jar("fresh", {"a": 1}))  # Not exported
+    expected["fresh"] = {"a": 1}
+
+    assert database.freeze(path) == len(expected)
+    with FrozenDataBase(path) as frozen:
+        assert len(frozen) == len(expected)
+        for key, value in expected.items():
+            if key == "fresh" or key.startswith("j"):
+                assert frozen.jar(key) == value
+            else:
+                assert bytes(frozen[key]) == value
+        assert sorted(frozen.keys()) == sorted(expected)
+        assert frozen.get("nope") is None and "nope" not in frozen
+        assert frozen.get(b"c1/a1_1") is not None
+        with pytest.raises(KeyError):
+            frozen["c0/pinned"]  # Pins are not in the snapshot
+    assert [name for name in os.listdir(tmp_path) if "tmp" in name] == []
+
+
+def test_values_outlive_close(tmp_path):
+    location, path = str(tmp_path / "f.db"), str(tmp_path / "f.frozen")
+    export(location)
+    DataBase("f", location).freeze(path)
+    with FrozenDataBase(path) as frozen:
+        value = frozen["c1/a1_1"]
+    assert bytes(value) == b"value2" * 3
+    del value
+    gc.collect()
+    frozen = FrozenDataBase(path)
+    frozen.close()  # Nothing referenced
+
+
+def test_collisions(tmp_path):
+    path = str(tmp_path / "f.frozen")
+    with open(path, "wb") as file:
+        writer = FrozenWriter(file)
+        for i in range(TABLES * 4):
+            writer.add(f"k{i}", *writer.value(str(i).encode()))
+        writer.close()
+    with FrozenDataBase(path) as frozen:
+        assert len(frozen) == TABLES * 4
+        assert all(bytes(frozen[f"k{i}"]) == str(i).encode() for i in range(TABLES * 4))
+
+
+def test_not_frozen(tmp_path):
+    location = str(tmp_path / "f.db")
+    export(location)
+    with pytest.raises(Exceptions.HeaderError):
+        FrozenDataBase(location)
+    open(str(tmp_path / "empty"), "wb").close()
+    with pytest.raises(Exceptions.HeaderError):
+        FrozenDataBase(str(tmp_path / "empty"))
@@ -0,0 +1,127 @@
+import gc
+import io
+import threading
+import time
+
+import pytest
+
+import tools
+from exceptions import Exceptions
+from handles import PipelinedReader, pipelined_reader, positioned_reader, PIPELINE_MAX_CHUNK
+from structures import DataBase, Cluster, Atom
+
+DATA = bytes(range(256)) * 20000  # Several chunks
+
+
+class Stream(io.BytesIO):
+    """
+    Stream which records whether (and by which thread) it was closed
+    """
+    def __init__(self, data, fail_at=None):
+        super().__init__(data)
+        self.fail_at = fail_at
+        self.closed_by = None
+
+    def read(self, size=-1):
+        if self.fail_at is not None and self.tell() >= self.fail_at:
+            raise ValueError("broken stream")
+        return super().read(size)
+
+    def close(self):
+        self.closed_by = threading.current_thread()
+        super().close()
+
+
+def wait_closed(stream):
+    for _ in range(100):
+        if stream.closed_by is not None:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_read():
+    reader = pipelined_reader(Stream(DATA))
+    assert reader.read(10) == DATA[:10]
+    assert reader.read(PIPELINE_MAX_CHUNK) == DATA[10:10 + PIPELINE_MAX_CHUNK]
+    assert reader.read() == DATA[10 + PIPELINE_MAX_CHUNK:]
+    assert reader.read() == b""
+    reader.close()
+
+
+def test_readline():
+    lines = b"".join(b"line %d\n" % i for i in range(50000))
+    reader = pipelined_reader(Stream(lines))
+    assert list(reader) == lines.splitlines(keepends=True)
+
+
+def test_seek_forward():
+    stream = Stream(DATA)
+    reader = PipelinedReader(stream)
+    assert reader.seek(1000) == 1000
+    assert reader.read(4) == DATA[1000:1004]
+    assert reader.seek(100, 1) == 1104
+    assert reader.tell() == 1104
+    assert reader.seek(len(DATA) + 10) == len(DATA)  # Stops at the end
+    assert reader.read(10) == b""
+    with pytest.raises(io.UnsupportedOperation):
+        reader.seek(0)
+    with pytest.raises(io.UnsupportedOperation):
+        reader.seek(0, 2)
+    reader.close()
+    assert wait_closed(stream)
+    assert stream.closed_by is not threading.current_thread()  # By the thread
+
+
+def test_error():
+    reader = pipelined_reader(Stream(DATA, fail_at=1))
+    with pytest.raises(ValueError):
+        reader.read()
+
+
+def test_abandoned():
+    stream = Stream(DATA)
+    reader = pipelined_reader(stream)
+    reader.read(1)
+    del reader
+    gc.collect()
+    assert wait_closed(stream)  # The thread stops
+
+
+def test_positioned_reader():
+    reads = []
+
+    def read_range(offset, size):
+        reads.append(offset)
+        return DATA[offset:offset + size]
+
+    first = positioned_reader(read_range, 100, fileno=7)
+    second = positioned_reader(read_range)
+    assert first.read(5) == DATA[100:105]
+    assert second.read(5) == DATA[:5]  # Own positions
+    first.seek(1000)
+    assert first.read(3) == DATA[1000:1003]
+    assert first.tell() == 1003
+    assert first.fileno() == 7
+    with pytest.raises(io.UnsupportedOperation):
+        second.fileno()
+    assert reads[:2] == [100, 0]
+
+
+def test_corrupt_compressed_database(tmp_path):
+    location = str(tmp_path / "c.db")
+    database = DataBase("c", location)
+    for i in range(1000):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", str(i) * 50)]))
+    database.export(compression=True)
+    tools.clean()
+    assert len(tools.load(location).elements) == 1000  # Decompressed by the thread
+    with open(location, "rb") as file:
+        data = bytearray(file.read())
+    start = data.index(b"\n") + 1
+    data[start:start + 8] = b"garbage!"  # The frame header of the zstd stream
+    with open(location, "wb") as file:
+        file.write(data)
+    tools.clean()
+    with pytest.raises(Exceptions.CorruptionError):  # Raised by the thread, in the reader
+        tools.load(location)
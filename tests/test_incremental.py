@@ -0,0 +1,78 @@
+import pytest
+
+import tools
+from exceptions import Exceptions
+from secure import Sealer
+from stats import Stats
+from structures import DataBase, Cluster, Atom, Jar
+
+
+def export(location, secure=False, compression=False, key=None, count=200):
+    database = DataBase("i", location, key=key)
+    for i in range(count):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", "v")]))
+    database.export(secure=secure, compression=compression)
+
+
+@pytest.mark.parametrize("secure", [False, True])
+def test_appends_changes(tmp_path, secure):
+    location = str(tmp_path / "i.db")
+    key = Sealer.generate_key()
+    export(location, secure, key=key)
+    with open(location, "rb") as file:
+        before = file.read()
+    stats = Stats()
+    database = DataBase("i", location, stats=stats, key=key)
+    database.load(name="c10").add(Atom("new", "longer"))
+    database.load(name="c11")  # Loaded, but not changed
+    database.add(Jar("j", [1, 2]))
+    database.delete("c100")
+    stats.reset()
+    database.export(secure=secure, incremental=True)
+    with open(location, "rb") as file:
+        after = file.read()
+
+    assert stats.bytes_written < len(before) // 10  # Not rewritten
+    assert after.split(b"\n", 1)[1][:100] == before.split(b"\n", 1)[1][:100]
+    tools.clean()
+    loaded = tools.load(location, key=key)
+    assert len(loaded.elements) == 200
+    assert "c100" not in loaded.elements
+    assert sorted(loaded["c10"].particles) == ["a10", "new"]
+    assert loaded["c10"]["new"].value == b"longer"
+    assert loaded["c199"]["a199"].value == b"v"  # Never loaded, kept
+    assert loaded["j"].obj == [1, 2]
+    assert DataBase("i", location, key=key).verify() == []
+
+
+def test_keeps_unloaded_version(tmp_path):
+    location = str(tmp_path / "i.db")
+    export(location)
+    first = DataBase("i", location)
+    first.load(name="c1")["a1"] = Atom("a1", "first")
+    first.export(incremental=True)
+    second = DataBase("i", location)
+    second.load(name="c2")["a2"] = Atom("a2", "second")
+    second.export(incremental=True)
+    database = DataBase("i", location)
+    assert database.load(name="c1")["a1"].value == b"first"
+    assert database.load(name="c2")["a2"].value == b"second"
+    assert [cluster.title for cluster in database.find("c1")] == ["c1"]  # The old block is dead
+
+
+def test_other_level(tmp_path):
+    location = str(tmp_path / "i.db")
+    export(location)
+    database = DataBase("i", location)
+    database.load(name="c1")
+    with pytest.raises(Exceptions.UnsupportedError):
+        database.export(compression=True, incremental=True)
+
+
+def test_compressed_whole(tmp_path):
+    location = str(tmp_path / "i.db")
+    export(location, compression=True)
+    database = DataBase("i", location)
+    database.load(name="c1")
+    with pytest.raises(Exceptions.UnsupportedError):
+        database.export(compression=True, incremental=True)
@@ -0,0 +1,127 @@
+import pickle
+
+import pytest
+
+import tools
+from exceptions import Exceptions
+from records import (encode_varint, decode_varint, encode_record, encode_records, decode_records,
+                     ValueTable, encode_ref, deref)
+from secure import Sealer
+from structures import DataBase, Cluster, Atom, Pin, Jar
+
+
+@pytest.mark.parametrize("number", [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63])
+def test_varint(number):
+    data = b"x" + encode_varint(number)
+    assert decode_varint(data, 1) == (number, len(data))
+
+
+def test_truncated_varint():
+    with pytest.raises(Exceptions.CorruptionError):
+        decode_varint(b"\x80\x80", 0)
+
+
+def test_records_round_trip():
+    records = [(False, "a", b"a\0b\n;@", 0), (True, "b", "a", 0), (False, None, b"", 1), (True, None, "a", 1)]
+    assert decode_records(encode_records(records)) == records
+
+
+def test_truncated_records():
+    data = encode_record(False, "name", b"value", 0)
+    with pytest.raises(Exceptions.CorruptionError):
+        decode_records(data[:-1])
+    with pytest.raises(Exceptions.CorruptionError):
+        decode_records(b"\x07" + data)
+
+
+def test_value_table():
+    table = ValueTable()
+    shared, single, short = b"shared value", b"single value", b"short"
+    for value in (shared, single, short, shared, short):
+        table.count(value)
+    assert len(table) == 1
+    assert table.ref(single) is None and table.ref(short) is None
+    records = [(False, "a", shared, 0), (False, "b", single, 0), (False, None, shared, 1)]
+    data = encode_records(records, values=table)
+    assert data.count(shared) == 0
+    assert decode_records(data, table.segment) == records
+    offset, size = table.ref(shared)
+    assert deref(encode_ref(offset, size), table.segment) == shared
+    payload = pickle.dumps([1, 2])
+    assert deref(payload, table.segment) == payload  # Not a reference
+
+
+def dump(location, key=None):
+    tools.clean()
+    loaded = tools.load(location, maintain_borrows=True, key=key)
+    tools.clean()
+    return {name: [(p.name, p.value, p.borrows) for p in element.particles.values()]
+            if isinstance(element, Cluster) else element.obj for name, element in loaded.elements.items()}
+
+
+def export(location, key=None, **kwargs):
+    database = DataBase("m", location, key=key)
+    atom = Atom("hello", "wörld")
+    database.add(Cluster("words", [atom, Atom("msg", atom.borrow()), Pin("pinv"),
+                                   Atom("at", "@notborrow"), Atom("nul", b"a\0b")]))
+    database.add(Jar("jar", {"k": [1, 2]}))
+    database.add(Cluster("empty", []))
+    for i in range(10):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", f"v{i}")]))
+    database.export(**kwargs)
+
+
+def test_any_byte(tmp_path):
+    location = str(tmp_path / "m.db")
+    export(location)
+    words = dump(location)["words"]
+    assert ("at", b"@notborrow", None) in words
+    assert ("nul", b"a\0b", None) in words
+    assert ("msg", b"@hello", "hello") in words
+    database = DataBase("m", location)
+    assert database.version == 2
+    assert database.load(name="words")["nul"].value == b"a\0b"
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"compression": True}, {"secure": True},
+                                    {"secure": True, "compression": True}])
+def test_migrate(tmp_path, kwargs):
+    old, new = str(tmp_path / "m1.db"), str(tmp_path / "m2.db")
+    key = Sealer.generate_key() if kwargs.get("secure") else None
+    database = DataBase("m", old, key=key)
+    atom = Atom("hello", "wörld")
+    database.add(Cluster("words", [atom, Atom("msg", atom.borrow()), Pin("pinv")]))
+    database.add(Jar("jar", {"k": [1, 2]}))
+    for i in range(10):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", f"v{i}")]))
+    database.export(version=1, **kwargs)
+    expected = dump(old, key)
+
+    assert tools.migrate(old, new, key=key).version == 2
+    assert dump(new, key) == expected
+    assert tools.migrate(new, old, version=1, key=key).version == 1
+    assert dump(old, key) == expected
+
+
+def test_version_1_is_kept(tmp_path):
+    location = str(tmp_path / "m.db")
+    database = DataBase("m", location)
+    for i in range(10):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", f"v{i}")]))
+    database.export(version=1)
+    database = DataBase("m", location)
+    assert database.version == 1
+    database.load(name="c3")["a3"] = Atom("a3", "changed")
+    database.update_all()
+    database.add(Cluster("new", [Atom("z", "1")]))
+    database.export(incremental=True)
+    assert DataBase("m", location).version == 1
+    assert dump(location)["c3"] == [("a3", b"changed", None)]
+    tools.clean()
+    assert tools.load(location, workers=2)["new"]["z"].value == b"1"
+
+
+def test_dedup_requires_version_2(tmp_path):
+    database = DataBase("m", str(tmp_path / "m.db"))
+    with pytest.raises(Exceptions.UnsupportedError):
+        database.export(version=1, dedup=True)
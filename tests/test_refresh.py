@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+from secure import Sealer
+from stats import Stats
+from structures import DataBase, Cluster, Atom, Jar
+
+KEY = Sealer.generate_key()
+
+
+def export(location, count=200, **kwargs):
+    database = DataBase("r", location, key=KEY)
+    for i in range(count):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", "x" * 100)]))
+    database.export(**kwargs)
+
+
+def test_appended(tmp_path):
+    location = str(tmp_path / "r.db")
+    export(location)
+    stats = Stats()
+    reader = DataBase("r", location, stats=stats)
+    reader.load(name="c5")
+    assert reader.refresh() == []
+
+    writer = DataBase("r", location)
+    writer.add(Cluster("new", [Atom("n", "1")]))
+    writer.add(Cluster("c5", [Atom("a5", "changed")]))
+    writer.export(incremental=True)
+    stats.reset()
+    assert reader.refresh() == ["new", "c5"]
+    assert reader["c5"]["a5"].value == b"changed"  # Loaded elements are replaced
+    assert "new" not in reader.elements
+    assert stats.bytes_read < 1000  # Only the appended blocks
+
+    writer.add(Jar("j", [1]))
+    writer.update_all()
+    assert reader.refresh(load=True) == ["j"]
+    assert reader["j"].obj == [1]
+
+
+@pytest.mark.parametrize("secure", [False, True])
+def test_rewritten_in_place(tmp_path, secure):
+    location = str(tmp_path / "r.db")
+    export(location, 3, secure=secure)
+    reader = DataBase("r", location, key=KEY)
+    reader.load(name="c0")
+    assert reader.refresh() == []
+
+    writer = DataBase("r", location, key=KEY)
+    writer.load(name="c0")["a0"] = Atom("a0", "y" * 100)  # Same size
+    writer.update("c0")
+    assert reader.refresh() == ["c0"]
+    assert reader["c0"]["a0"].value == b"y" * 100
+    assert reader.refresh() == []
+
+
+def test_replaced(tmp_path):
+    location = str(tmp_path / "r.db")
+    export(location)
+    reader = DataBase("r", location)
+    assert reader.refresh() == []
+    writer = DataBase("r", location)
+    writer.add(Cluster("only", []))
+    writer.export()
+    assert reader.refresh() == ["only"]
+
+    writer.export(compression=True)  # Compressed as a whole
+    assert DataBase("r", location).refresh() == ["only"]
+
+
+def test_concurrent(tmp_path):
+    location = str(tmp_path / "r.db")
+    export(location, 10)
+    reader = DataBase("r", location, concurrent=True)
+    writer = DataBase("r", location, concurrent=True)
+    writer.add(Cluster("cc", []))
+    writer.export(incremental=True)
+    assert reader.refresh() == ["cc"]
+
+
+def test_follow(tmp_path):
+    location = str(tmp_path / "r.db")
+    export(location, 10)
+    reader = DataBase("r", location)
+
+    def write():
+        time.sleep(0.2)
+        for i in range(3):
+            writer = DataBase("r", location)
+            writer.add(Cluster(f"f{i}", [Atom("q", str(i))]))
+            writer.export(incremental=True)
+            time.sleep(0.1)
+        writer = DataBase("r", location)
+        writer.load(name="c1")["a1"] = Atom("a1", "z" * 100)
+        writer.update("c1")
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    followed = [(element.title, list(element.particles.values())[0].value)
+                for element in reader.follow(interval=0.05, timeout=1)]
+    thread.join()
+    assert followed == [("f0", b"0"), ("f1", b"1"), ("f2", b"2"), ("c1", b"z" * 100)]
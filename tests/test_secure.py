@@ -0,0 +1,97 @@
+import pytest
+
+import tools
+from exceptions import Exceptions
+from secure import Sealer
+from structures import DataBase, Cluster, Atom, Pin, Jar
+
+LEVELS = [(False, "S"), (True, "X")]
+
+
+def export(location, key, compression):
+    database = DataBase("s", location, key=key)
+    atom = Atom("hello", "world")
+    database.add(Cluster("words", [atom, Atom("msg", atom.borrow()), Pin("pinv")]))
+    database.add(Jar("jar", [1, 2, 3]))
+    for i in range(20):
+        database.add(Cluster(f"c{i}", [Atom(f"a{i}", "secret" * 20)]))
+    database.export(secure=True, compression=compression)
+
+
+@pytest.mark.parametrize("compression,level", LEVELS)
+def test_round_trip(tmp_path, compression, level):
+    location = str(tmp_path / "s.db")
+    key = Sealer.generate_key()
+    export(location, key, compression)
+    with open(location, "rb") as file:
+        data = file.read()
+    assert data[:1] == level.encode()
+    assert b"secret" not in data and b"world" not in data
+
+    for workers in (None, 2):
+        tools.clean()
+        loaded = tools.load(location, key=key, workers=workers)
+        assert len(loaded.elements) == 22
+        assert loaded["c3"]["a3"].value == b"secret" * 20
+        assert loaded["jar"].obj == [1, 2, 3]
+    tools.clean()
+
+    database = DataBase("s", location, key=key)
+    assert database.load(name="c5")["a5"].value == b"secret" * 20
+    assert [jar.obj for jar in database.find("jar")] == [[1, 2, 3]]
+    database.load(name="jar").obj = list(range(50))
+    database.update("jar")
+    database.load(name="c6")["a6"] = Atom("a6", "changed")
+    database.add(Cluster("new", [Atom("n", "1")]))
+    database.update_all()
+    assert database.verify() == []
+    tools.clean()
+    loaded = tools.load(location, key=key)
+    assert loaded["jar"].obj == list(range(50))
+    assert loaded["c6"]["a6"].value == b"changed"
+    assert loaded["new"]["n"].value == b"1"
+
+
+@pytest.mark.parametrize("compression,level", LEVELS)
+def test_wrong_key(tmp_path, compression, level):
+    location = str(tmp_path / "s.db")
+    export(location, Sealer.generate_key(), compression)
+    with pytest.raises(Exceptions.CorruptionError):
+        tools.load(location, key=Sealer.generate_key())
+    with pytest.raises(Exceptions.CorruptionError):
+        DataBase("s", location, key=Sealer.generate_key()).load(name="c1")
+    with pytest.raises(Exceptions.UnsupportedError):
+        tools.load(location)
+
+
+@pytest.mark.parametrize("compression,level", LEVELS)
+def test_tampered(tmp_path, compression, level):
+    location = str(tmp_path / "s.db")
+    key = Sealer.generate_key()
+    export(location, key, compression)
+    with open(location, "rb") as file:
+        data = bytearray(file.read())
+    block = data.index(b"\n", data.index(b"=c5:")) + 20  # Inside the ciphertext of c5
+    data[block] ^= 1
+    with open(location, "wb") as file:
+        file.write(data)
+
+    database = DataBase("s", location, key=key)
+    assert database.load(name="c4")["a4"].value == b"secret" * 20  # The other elements are intact
+    with pytest.raises(Exceptions.CorruptionError):
+        database.load(name="c5")
+
+
+@pytest.mark.parametrize("compression,level", LEVELS)
+def test_swapped_names(tmp_path, compression, level):
+    location = str(tmp_path / "s.db")
+    key = Sealer.generate_key()
+    export(location, key, compression)
+    with open(location, "rb") as file:
+        data = file.read()
+    # The name is authenticated, a block can not be passed off as another element
+    data = data.replace(b"=c5:", b"=c#:").replace(b"=c6:", b"=c5:").replace(b"=c#:", b"=c6:")
+    with open(location, "wb") as file:
+        file.write(data)
+    with pytest.raises(Exceptions.CorruptionError):
+        DataBase("s", location, key=key).load(name="c5")
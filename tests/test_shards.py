@@ -0,0 +1,68 @@
+import pytest
+
+import structures
+import tools
+from structures import Cluster, Atom, Jar
+from shards import ShardedDataBase
+
+
+def fill(database, count=6):
+    for i in range(count):
+        atom = Atom(f"a{i}", f"v{i}")
+        database.add(Cluster(f"c{i}", [atom, Atom(f"b{i}", atom.borrow())]))
+    database.add(Jar("jar", [1, 2, 3]))
+
+
+def contents(elements):
+    return {name: sorted((title, particle.value) for title, particle in element.particles.items())
+            if isinstance(element, Cluster) else element.obj for name, element in elements.items()}
+
+
+@pytest.mark.parametrize("compression", [False, True])
+def test_export_keeps_unloaded_elements(tmp_path, compression):
+    location = str(tmp_path / "s.db")
+    database = ShardedDataBase("s", location, segments=2)
+    fill(database)
+    database.export(compression=compression)
+    tools.clean()
+
+    database = ShardedDataBase("s", location)
+    database.add(Cluster("new", [Atom("n", "x")]))
+    database.delete("c1")
+    database.export(compression=compression)
+    tools.clean()
+
+    database = ShardedDataBase("s", location)
+    elements = database.load_all(maintain_borrows=True)
+    assert sorted(elements) == ["c0", "c2", "c3", "c4", "c5", "jar", "new"]
+    assert sorted(elements["c2"].particles) == ["a2", "b2"]  # The borrow is kept within the segment
+    assert elements["c2"]["a2"].value == b"v2"
+    assert elements["jar"].obj == [1, 2, 3]
+
+
+def test_load_all_workers(tmp_path):
+    location = str(tmp_path / "s.db")
+    database = ShardedDataBase("s", location, segments=3)
+    fill(database, 30)
+    database.export()
+    tools.clean()
+
+    expected = contents(ShardedDataBase("s", location).load_all())
+    loaded = contents(ShardedDataBase("s", location).load_all(workers=2))
+    assert loaded == expected
+    assert len(loaded) == 31
+    assert tools.part == {} and structures.index == {}  # The index is cleaned after every segment
+
+
+def test_size_strategy(tmp_path):
+    database = ShardedDataBase("s", str(tmp_path / "s.db"), segments=4, strategy="size")
+    for i in range(400):
+        database.add(Cluster(f"x{i}", [Atom("a", "v" * 50)]))
+    sizes = [len(segment.elements) for segment in database.segments]
+    assert sum(sizes) == 400
+    assert max(sizes) - min(sizes) <= 1
+
+
+def test_unknown_strategy(tmp_path):
+    with pytest.raises(Exception):
+        ShardedDataBase("s", str(tmp_path / "s.db"), strategy="random")
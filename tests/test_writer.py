@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import tools
+from exceptions import Exceptions
+from secure import Sealer
+from structures import DataBase, Cluster, Atom, Pin, Jar
+from writer import DataBaseWriter
+
+KEY = Sealer.generate_key()
+LEVELS = {
+    "N": {},
+    "C": {"compression": True},
+    "S": {"secure": True},
+    "X": {"secure": True, "compression": True},
+    "v1": {"version": 1},
+}
+
+
+def rows(i):
+    return [(f"a{i}_{j}", "x" * j) for j in range(10)]
+
+
+def dump(location):
+    tools.clean()
+    loaded = tools.load(location, key=KEY)
+    tools.clean()
+    return {name: [(p.name, p.value) for p in element.particles.values()]
+            if isinstance(element, Cluster) else element.obj for name, element in loaded.elements.items()}
+
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_same_as_export(tmp_path, level):
+    kwargs = LEVELS[level]
+    location = str(tmp_path / "w.db")
+    with DataBaseWriter("w", location, key=KEY, **kwargs) as writer:
+        for i in range(50):
+            writer.write_cluster(f"c{i}", rows(i))
+        writer.write_cluster("p", [(None, "pin"), ("n", b"a\0b" if level != "v1" else b"ab")])
+        writer.write_jar("j", [1, 2])
+    assert writer.count == 52
+    with open(location, "rb") as file:
+        written = file.read()
+    streamed = dump(location)
+
+    database = DataBase("w", location, key=KEY)
+    for i in range(50):
+        database.add(Cluster(f"c{i}", [Atom(name, value) for name, value in rows(i)]))
+    database.add(Cluster("p", [Pin("pin"), Atom("n", b"a\0b" if level != "v1" else b"ab")]))
+    database.add(Jar("j", [1, 2]))
+    database.export(**kwargs)
+    with open(location, "rb") as file:
+        exported = file.read()
+
+    assert streamed == dump(location)
+    assert written[:1] == exported[:1]  # The level
+    if not kwargs.get("secure"):  # Without random nonces, the files are the same
+        assert written == exported
+    database = DataBase("w", location, key=KEY)
+    assert database.load(name="c49")["a49_9"].value == b"x" * 9
+    assert database.verify() == []
+
+
+def test_abort_keeps_old_file(tmp_path):
+    location = str(tmp_path / "w.db")
+    with DataBaseWriter("w", location, concurrent=True) as writer:
+        writer.write_cluster("old", [("a", "1")])
+    with pytest.raises(KeyError):
+        with DataBaseWriter("w", location, concurrent=True) as writer:
+            writer.write_cluster("new", [("a", "1")])
+            raise KeyError
+    assert list(dump(location)) == ["old"]
+    assert [name for name in os.listdir(tmp_path) if "tmp" in name] == []
+
+
+def test_closed(tmp_path):
+    writer = DataBaseWriter("w", str(tmp_path / "w.db"))
+    with pytest.raises(Exceptions.UnsupportedError):
+        writer.write_jar("j", 1)
+    with pytest.raises(Exceptions.UnsupportedError):
+        DataBaseWriter("w", str(tmp_path / "w.db"), secure=True)
@@ -1,13 +1,16 @@
-import regex
 from exceptions import Exceptions
+import io
 import os
+import sys
 import copy
 import pickle
-import zstandard as zst
 
-from remote import RemoteDataBaseAccessor
+from storage import Storage, LocalStorage
+from handles import pipelined_reader, PIPELINE_MAX_CHUNK
 from structures import Atom, Borrow, Jar, Pin, Cluster, DataBase
+from stats import Stats, stats_of, traced
 import structures
+from records import VERSION, decode_records, encode_records, encode_ref, deref
 
 part = {}
 
@@ -15,7 +18,9 @@ part = {}
 # This is modified from:
 # https://stackoverflow.com/a/43060761/16595859
 def stream_regex(pattern, file, chunksize=8192):
+    import regex
     window = pattern[:0]
+    offset = 0  # Position of the window in the stream
     sentinel = object()
 
     last_chunk = False
@@ -29,25 +34,28 @@ def stream_regex(pattern, file, chunksize=8192):
         match = sentinel
         for match in regex.finditer(pattern, window, partial=not last_chunk):
             if not match.partial:
-                pos = match.start(), match.end()
+                pos = offset + match.start(), offset + match.end()
                 yield pos
 
         if match is sentinel or not match.partial:
+            offset += len(window)
             window = window[:0]
         else:
+            offset += match.start()
             window = window[match.start():]
             if match.start() == 0:
                 chunksize *= 2
 
 
 def find_sub_header(file, name, size=None):
-    if size is None:
-        size = "*"
-    pat = '[\=|\?]{name}+:{size}'.format(name=name, size=size).encode()
+    import regex
+    size = "" if size is None else f'{size}[:\n]'
+    pat = '[=?]{name}:{size}'.format(name=regex.escape(name), size=size).encode()
     gen = stream_regex(pat, file)
     return gen
 
 
+@traced("get_db_header")
 def get_db_header(file, size):
     """
     Get database headers:
@@ -55,6 +63,8 @@ def get_db_header(file, size):
     - realname (filename)
     - name
     - size (in compressed databases, the size is contained in the header)
+    - params (compression parameters, in compressed databases,
+      ``enc`` in secured databases, ``v`` the format version)
     :param file:
     File `BufferReader` (rb)
     :param size:
@@ -65,6 +75,7 @@ def get_db_header(file, size):
     - name: str
     - index: int
     - size: int
+    - params: dict
     """
     val = b''
     name = None
@@ -88,41 +99,51 @@ def get_db_header(file, size):
         else:
             val += b
 
+    params = {}
     try:
-        if level == "N":
+        _raw_size = b""
+        while size > idx:
             idx += 1
-            file.read(1)
-        else:
-            _raw_size = b""
-            while size > idx:
-                idx += 1
-                b = file.read(1)
-                if b == b'\n':
-                    break
-                _raw_size += b
-            size = int(_raw_size.decode()) + idx
+            b = file.read(1)
+            if b == b'\n':
+                break
+            _raw_size += b
+        _raw_size, *_params = _raw_size.decode().split(";")
+        if _raw_size:  # Normal and secured databases have no size, the naive size is kept
+            size = int(_raw_size) + idx
+        if _params:  # See `structures.Compression`, `enc` and `v` (format version)
+            params = {key: int(value) for key, value in (p.split("=") for p in _params[0].split(","))}
     except ValueError:
         raise Exceptions.HeaderError(f"Invalid header", "get_db_header")
 
     if name is None or realname is None:
         raise Exceptions.BufferError(f"Too few bytes in headers", "get_db_header")
 
-    return level, realname.decode(), name.decode(), idx, size
+    return level, realname.decode(), name.decode(), idx, size, params
 
 
-def decompress(file, size):
-    zstd = zst.ZstdDecompressor()
-    stream = zstd.stream_reader(file, size)
-    return stream
+def decompress(file, size, params=None):
+    import zstandard as zst
+    window_log = (params or {}).get("window_log", 0)
+    if window_log:
+        zstd = zst.ZstdDecompressor(max_window_size=1 << window_log)
+    else:
+        zstd = zst.ZstdDecompressor()
+    stream = zstd.stream_reader(file, PIPELINE_MAX_CHUNK)  # Not all the compressed data at once
+    return pipelined_reader(stream)  # Decompressed by a thread, while the parsers read
 
 
-def compress(file, size):
-    zstd = zst.ZstdCompressor()
+def compress(file, size, compression=None):
+    import zstandard as zst
+    if compression is None or compression is True:
+        compression = structures.Compression()
+    zstd = zst.ZstdCompressor(compression_params=compression.params())
     stream = zstd.stream_writer(file, size)
     return stream
 
 
-def level_decompile(level, file, size):
+@traced("level_decompile")
+def level_decompile(level, file, size, params=None):
     """
     Make file compatible with the given
     level.
@@ -136,17 +157,23 @@ def level_decompile(level, file, size):
     Ordinary `BufferReader` (rb)
     :param size:
     Total file size
+    :param params:
+    Parameters from the header (see `get_db_header`)
     :return:
     Compatible file `BufferReader`
-        """
+    """
+    stats = stats_of((file,))
     match level:
         case "C":
-            return decompress(file, size)
-        case "S":
-            raise NotImplementedError("Not Implemented : Secured database")
-        case "X":
-            file = decompress(file, size)
+            file = decompress(file, size, params)
+            return stats.wrap(file, False) if stats else file
+        case "S":  # Elements are decrypted on their own (see `open_sealed`)
             return file
+        case "X":
+            if (params or {}).get("enc"):  # Like S, elements are compressed on their own
+                return file
+            file = decompress(file, size, params)
+            return stats.wrap(file, False) if stats else file
         case "N":
             return file
         case _:
@@ -173,10 +200,7 @@ def level_compile(level, file, size):
     match level:
         case "C":
             return compress(file, size)
-        case "S":
-            raise NotImplementedError("Not Implemented : Secured database")
-        case "X":
-            file = compress(file, size)
+        case "S" | "X":  # Elements are sealed on their own (see `secure.Sealer`)
             return file
         case "N":
             return file
@@ -185,48 +209,48 @@ def level_compile(level, file, size):
 
 
 def get_atom_value(file, idx, size):
-    value = ""
-    h = file.read(1).decode()
+    value = b""  # Decoded at the end, a character may span several bytes
+    h = file.read(1)
     idx += 1
-    if h == "@":
+    if h == b"@":
         borrow = True
     else:
         borrow = False
         value += h
     while size > idx:
         idx += 1
-        piece = file.read(1).decode()
+        piece = file.read(1)
         if ord(piece) == 0:
             break
         value += piece
 
-    return borrow, value, idx
+    return borrow, value.decode(), idx
 
 
 def get_pin_value(file, idx, size):
-    value = ""
-    h = file.read(1).decode()
+    value = b""  # Decoded at the end, a character may span several bytes
+    h = file.read(1)
     idx += 1
-    if h == "@":
+    if h == b"@":
         borrow = True
     else:
         borrow = False
         value += h
     while size > idx:
         idx += 1
-        piece = file.read(1).decode()
+        piece = file.read(1)
         if ord(piece) == 0:
             break
         value += piece
 
-    return borrow, value, idx
+    return borrow, value.decode(), idx
 
 
 def get_piece(file, idx, size):
-    name = ""
-    h = file.read(1).decode()
+    name = b""
+    h = file.read(1)
     idx += 1
-    if h == "!":  # Indicate PIN
+    if h == b"!":  # Indicate PIN
         t = 1
         borrow, value, idx = get_pin_value(file, idx, size)
         name = f'PIN{len(structures.index)}'
@@ -236,14 +260,14 @@ def get_piece(file, idx, size):
         name += h
     while size > idx:
         idx += 1
-        piece = file.read(1).decode()
-        if piece == ";":
+        piece = file.read(1)
+        if piece == b";":
             break
         name += piece
 
     borrow, value, idx = get_atom_value(file, idx, size)
 
-    return borrow, name, value, idx, t
+    return borrow, name.decode(), value, idx, t
 
 
 def get_sub_header(file, idx, size):
@@ -263,9 +287,12 @@ def get_sub_header(file, idx, size):
             break
         _size += piece
 
+    digest = None
+    if ":" in _size:  # Checksum (see `structures.block_digest`)
+        _size, digest = _size.split(":", 1)
     size = int(_size)
 
-    return idx, size, name
+    return idx, size, name, digest
 
 
 def make_atom(borrow, name, value, mt_br):
@@ -302,8 +329,35 @@ def make_pin(borrow, name, value, mt_br):
     return pin
 
 
-def load_cluster_B(cluster_name, mt_br, file, cluster_size, idx, size, __idx):
+def make_particles(records, mt_br, values=None):
+    """
+    Make decoded records (see `decode_cluster`) into Atoms and Pins
+    :param values:
+    Content of the value segment, for the values which refer to it
+    """
+    content = []
+    for borrow, name, value, t in records:
+        if type(value) is tuple:  # (offset, size) in the value segment
+            value = bytes(values[value[0]:value[0] + value[1]])
+        if t == 0:
+            content.append(make_atom(borrow, name, value, mt_br))
+        else:
+            content.append(make_pin(borrow, f'PIN{len(structures.index)}', value, mt_br))
+    return content
+
+
+@traced("load_cluster_B", decodes=True)
+def load_cluster_B(cluster_name, mt_br, file, cluster_size, idx, size, __idx, version=1, values=None):
+    if version >= 2:  # Length-prefixed, read at once (see `records`)
+        records = decode_records(file.read(cluster_size), values)
+        file.read(1)
+        cluster = Cluster(cluster_name, make_particles(records, mt_br))
+        cluster.dirty = False
+        return cluster, idx + cluster_size + 1
     cluster_content = []
+    if cluster_size == 0:  # Empty, only the trailing newline
+        file.read(1)
+        idx += 1
     while (cluster_size + __idx) > idx:
         borrow, name, value, idx, t = get_piece(file, idx, size)
         file.read(1)
@@ -317,56 +371,120 @@ def load_cluster_B(cluster_name, mt_br, file, cluster_size, idx, size, __idx):
         cluster_content.append(at)
 
     cluster = Cluster(cluster_name, cluster_content)
+    cluster.dirty = False
 
     return cluster, idx
 
 
-def load_cluster_A(file, idx, size, mt_br):
-    idx, cluster_size, cluster_name = get_sub_header(file, idx, size)
+def load_cluster_A(file, idx, size, mt_br, version=1, values=None):
+    idx, cluster_size, cluster_name, _ = get_sub_header(file, idx, size)
     __idx = copy.copy(idx)
 
-    return load_cluster_B(cluster_name, mt_br, file, cluster_size, idx, size, __idx)
+    return load_cluster_B(cluster_name, mt_br, file, cluster_size, idx, size, __idx, version, values)
 
 
-def open_jar_B(file, jar_name, jar_size, idx):
-    content = file.read(jar_size)
+@traced("open_jar_B", decodes=True)
+def open_jar_B(file, jar_name, jar_size, idx, values=None):
+    content = deref(file.read(jar_size), values)
     jar = Jar(jar_name, pickle.loads(content))
+    jar.dirty = False
     del content
     file.read(1)
     idx += 1
     return jar, idx
 
 
-def open_jar_A(file, idx, size, mt_br):
-    idx, jar_size, jar_name = get_sub_header(file, idx, size)
-    return open_jar_B(file, jar_name, jar_size, idx)
+def open_jar_A(file, idx, size, mt_br, values=None):
+    idx, jar_size, jar_name, _ = get_sub_header(file, idx, size)
+    return open_jar_B(file, jar_name, jar_size, idx, values)
 
 
-def local_prep_load(filename):
-    size = os.path.getsize(filename)
-    file = open(filename, 'rb')
-    return file, size
+@traced("open_sealed", decodes=True)
+def open_sealed(file, head, name, _size, idx, mt_br, sealer, version=1, values=None):
+    """
+    Read and decrypt a sealed element, then
+    decode it like an ordinary one
+    :param head:
+    Type of the element ("=" or "?")
+    :return:
+    Loaded `Cluster` or `Jar`, index after the element
+    """
+    if type(head) is bytes:
+        head = head.decode()
+    content = sealer.open(file.read(_size), head, name)
+    file.read(1)
+    return open_content(head, name, content, mt_br, version, values), idx + _size + 1
+
+
+def open_content(head, name, content, mt_br, version=1, values=None):
+    """
+    Decode the (plain) content of an element
+    :param values:
+    Content of the value segment (see `DataBase.export(dedup=True)`)
+    """
+    inner = io.BytesIO(content)
+    if head == "=":
+        return load_cluster_B(name, mt_br, inner, len(content), 0, len(content), 0, version, values)[0]
+    return open_jar_B(inner, name, len(content), 0, values)[0]
+
+
+def make_sealer(level, params, key):
+    """
+    `secure.Sealer` of a database, None if it is not secured
+    """
+    from secure import Sealer
+    if not params.get("enc"):
+        return None
+    if key is None:
+        raise Exceptions.UnsupportedError("The database is secured, a key is required", "load")
+    return Sealer(key, structures.Compression.from_header(params) if level == "X" else None)
 
 
-def remote_prep_load(db_acc: RemoteDataBaseAccessor):
-    return db_acc.open(), db_acc.size
+def prep_load(storage: Storage, stats=None):
+    """
+    Open the file of a database to load it
+    :return:
+    The file and its size
+    """
+    if stats is not None and storage.stats is None:
+        storage.stats = stats
+    return storage.open(), storage.size
 
 
-def __load(file, size, maintain_borrows, RDA):
+def __load(file, size, maintain_borrows, RDA, stats, key):
     with file:
-        level, realname, name, idx, size = get_db_header(file, size)
-        database = DataBase(name, realname, RDA)
-        file = level_decompile(level, file, size - idx)
+        level, realname, name, idx, size, params = get_db_header(file, size)
+        database = DataBase(name, realname, RDA, stats, key=key)
+        sealer = make_sealer(level, params, key)
+        version = params.get("v", 1)
+        values = None
+        file = level_decompile(level, file, size - idx, params)
         while size > idx:
             head = file.read(1)
             idx += 1
             match head:
+                case b"+":  # Value segment (the first block)
+                    idx, _size, _name, _ = get_sub_header(file, idx, size)
+                    values = file.read(_size)
+                    if sealer is not None:
+                        values = sealer.open(values, "+", _name)
+                    file.read(1)
+                    idx += _size + 1
+                case b"=" | b"?" if sealer is not None:  # Sealed element
+                    idx, _size, _name, _ = get_sub_header(file, idx, size)
+                    element, idx = open_sealed(file, head, _name, _size, idx, maintain_borrows, sealer, version,
+                                               values)
+                    database.add(element)
                 case b"=":  # Cluster
-                    cluster, idx = load_cluster_A(file, idx, size, maintain_borrows)
+                    cluster, idx = load_cluster_A(file, idx, size, maintain_borrows, version, values)
                     database.add(cluster)
                 case b"?":  # Jar (Pickle)
-                    jar, idx = open_jar_A(file, idx, size, maintain_borrows)
+                    jar, idx = open_jar_A(file, idx, size, maintain_borrows, values)
                     database.add(jar)
+                case b"-":  # Dead block
+                    idx, _size, _, _ = get_sub_header(file, idx, size)
+                    file.read(_size + 1)
+                    idx += _size + 1
                 case b"":  # EOF
                     break
                 case _:
@@ -375,6 +493,117 @@ def __load(file, size, maintain_borrows, RDA):
     return database
 
 
+def read_range(filename, offset, size):
+    with open(filename, 'rb') as file:
+        file.seek(offset)
+        return file.read(size)
+
+
+def decode_cluster(job, version=1, values=None):
+    """
+    Decode the content of a Cluster into raw records,
+    runs in a worker process (see `__parallel_load`)
+    :param job:
+    The content as bytes, or (filename, offset, size)
+    :param version:
+    Format version (see `records`)
+    :param values:
+    Content of the value segment, None to leave the references to it
+    :return:
+    List of (borrow, name, value, type), PINs are named
+    when their records are made into objects
+    """
+    if type(job) is tuple:
+        job = read_range(*job)
+    if version >= 2:
+        return decode_records(job, values)
+    file = io.BytesIO(job)
+    size = len(job)
+    records = []
+    idx = 0
+    while size > idx:
+        borrow, name, value, idx, t = get_piece(file, idx, size)
+        file.read(1)
+        idx += 1
+        records.append((borrow, None if t else name, value, t))
+
+    return records
+
+
+def scan_elements(file, size, idx, filename=None, ranged=b"="):
+    """
+    Collect the elements of a database (first pass of `__parallel_load`)
+    :param filename:
+    Filename of a local level N database, the content of the elements
+    of type `ranged` is then not read, but given as (filename, offset, size)
+    :return:
+    List of (type, name, content, checksum)
+    """
+    return list(iter_elements(file, size, idx, filename, ranged))
+
+
+def iter_elements(file, size, idx, filename=None, ranged=b"="):
+    """
+    Generator version of `scan_elements`,
+    the value segment is given as an element of type "+"
+    """
+    while size > idx:
+        head = file.read(1)
+        idx += 1
+        match head:
+            case b"=" | b"?" | b"+":
+                idx, _size, _name, digest = get_sub_header(file, idx, size)
+                if head in ranged and filename is not None:
+                    content = (filename, file.tell(), _size)
+                    file.seek(_size + 1, 1)
+                else:
+                    content = file.read(_size)
+                    file.read(1)
+                idx += _size + 1
+                yield head, _name, content, digest
+            case b"-":  # Dead block
+                idx, _size, _, _ = get_sub_header(file, idx, size)
+                file.read(_size + 1)
+                idx += _size + 1
+            case b"":  # EOF
+                break
+            case _:
+                raise Exceptions.SubHeadError(f"Invalid sub-header '{head.decode()}'", "scan_elements")
+
+
+def __parallel_load(filename, file, size, maintain_borrows, RDA, stats, workers, key):
+    with file:
+        level, realname, name, idx, size, params = get_db_header(file, size)
+        database = DataBase(name, realname, RDA, stats, key=key)
+        sealer = make_sealer(level, params, key)
+        version = params.get("v", 1)
+        file = level_decompile(level, file, size - idx, params)
+        local = (RDA is None or RDA.local) and level == "N"
+        elements = scan_elements(file, size, idx, filename if local else None)
+    if sealer is not None:  # Decrypted here, the key never leaves this process
+        elements = [(head, _name, sealer.open(content, head.decode(), _name), digest)
+                    for head, _name, content, digest in elements]
+    values = None
+    if elements and elements[0][0] == b"+":  # Value segment, references are resolved by `make_particles`
+        values = elements.pop(0)[2]
+
+    clusters = [content for head, _, content, _ in elements if head == b"="]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as executor:
+        decoded = executor.map(decode_cluster, clusters, [version] * len(clusters),
+                               chunksize=max(1, len(clusters) // (workers * 4)))
+        # Merge in file order, so borrows resolve like in a serial load
+        for head, _name, content, _ in elements:
+            if head == b"?":
+                element = Jar(_name, pickle.loads(deref(content, values)))
+            else:
+                element = Cluster(_name, make_particles(next(decoded), maintain_borrows, values))
+            element.dirty = False
+            database.add(element)
+
+    return database
+
+
 def clean():
     """
     Clean the `index`
@@ -384,7 +613,8 @@ def clean():
     structures.index = {}
 
 
-def load(filename, maintain_borrows=False, _clean=True, RDA: RemoteDataBaseAccessor = None):
+def load(filename, maintain_borrows=False, _clean=True, RDA: Storage = None, stats: Stats = None,
+         workers=None, key=None):
     """
     Load an entire database as a `DataBase` object.
     (Everything is loaded into memory, so not optimal)
@@ -396,19 +626,108 @@ def load(filename, maintain_borrows=False, _clean=True, RDA: RemoteDataBaseAcces
     :param _clean:
     Destroy object index (please enable)
     :param RDA:
-    RemoteDataBaseAccessor used for accessing a file on the remote server,
-    leave None if it is a local file
+    Storage backend of the file (see `storage`), like a
+    RemoteDataBaseAccessor, leave None if it is a local file
+    :param stats:
+    `Stats` to record the I/O and phase timings in,
+    it is kept by the returned `DataBase`
+    :param workers:
+    Decode the Clusters in this amount of processes,
+    leave None to load in this thread
+    :param key:
+    Key of a secured database (see `secure.Sealer`)
     :return:
     A fully loaded `DataBase`
     """
     try:
-        if not RDA:
-            file, size = local_prep_load(filename)
+        file, size = prep_load(LocalStorage(filename) if RDA is None else RDA, stats)
+        if workers is not None and workers > 1:
+            loaded = __parallel_load(filename, file, size, maintain_borrows, RDA, stats, workers, key)
         else:
-            file, size = remote_prep_load(RDA)
-        loaded = __load(file, size, maintain_borrows, RDA)
+            loaded = __load(file, size, maintain_borrows, RDA, stats, key)
         if _clean:
             clean()
         return loaded
-    except zst.ZstdError:
-        raise Exceptions.CorruptionError(f"Compressed-Database '{filename}' is not in ZST format", "load")
+    except Exception as ex:
+        zst = sys.modules.get("zstandard")  # Loaded already, if the database is compressed
+        if zst is not None and isinstance(ex, zst.ZstdError):
+            raise Exceptions.CorruptionError(f"Compressed-Database '{filename}' is not in ZST format", "load")
+        raise
+
+
+class RawCluster(Cluster):
+    """
+    Records of a Cluster, which are not made into objects (see `migrate`)
+    """
+    def __init__(self, title, records):
+        self.title = title
+        self.records = records
+        self.particles = {}
+        self.dirty = True
+
+    def eval(self, version=1, values=None):
+        return encode_records(self.records, version, values)
+
+
+class RawJar(Jar):
+    """
+    Pickled object of a Jar, which is not unpickled (see `migrate`)
+    """
+    def __init__(self, title, payload):
+        self.title = title
+        self.payload = payload
+        self.dirty = True
+
+    def eval(self, version=1, values=None):
+        ref = None if values is None else values.ref(self.payload)
+        return self.payload if ref is None else encode_ref(*ref)
+
+    def dump(self, file):
+        file.write(self.payload)
+
+
+def migrate(old_path, new_path, version=VERSION, key=None):
+    """
+    Convert a (local) database to another format version (see `records`).
+    The elements are converted one after another, so the database is
+    never in memory as a whole, and no Atoms or Pins are made.
+    The level is kept (an old "X" database, which is only compressed, becomes "C")
+    :param old_path:
+    Filename of the database
+    :param new_path:
+    Filename of the converted database (must be another file)
+    :param version:
+    Format version of the converted database
+    :param key:
+    Key of a secured database, the converted one is secured with the same key
+    :return:
+    The converted `DataBase` (nothing loaded)
+    """
+    if os.path.abspath(old_path) == os.path.abspath(new_path):
+        raise Exceptions.UnsupportedError("A database can not be migrated into itself", "migrate")
+    file, size = prep_load(LocalStorage(old_path))
+    with file:
+        level, realname, name, idx, size, params = get_db_header(file, size)
+        sealer = make_sealer(level, params, key)
+        old_version = params.get("v", 1)
+        file = level_decompile(level, file, size - idx, params)
+
+        def elements():
+            values = None
+            for head, _name, content, _ in iter_elements(file, size, idx):
+                if sealer is not None:
+                    content = sealer.open(content, head.decode(), _name)
+                if head == b"+":  # Value segment, the values are written into the records
+                    values = content
+                elif head == b"=":
+                    yield RawCluster(_name, decode_cluster(content, old_version, values))
+                else:
+                    yield RawJar(_name, deref(content, values))
+
+        secure = sealer is not None
+        compression = structures.Compression.from_header(params) if level in "CX" else False
+        database = DataBase(name, new_path, key=key)
+        with database._writer(copy=False) as location:
+            database._export(location, secure, compression, version, elements())
+    database.reload()
+    return database
@@ -0,0 +1,124 @@
+from exceptions import Exceptions
+from records import VERSION
+from structures import DataBase, Compression, Jar
+from storage import Storage
+from stats import Stats
+
+"""
+Bulk ingest. A `DataBaseWriter` encodes every element and
+writes it to the file as soon as it is given, no `Atom`s are
+made (and nothing lands in the `index`), so the memory used
+does not grow with the database.
+"""
+
+
+class DataBaseWriter:
+    """
+    Write a new database element by element
+    ````python
+    with DataBaseWriter("MyDB", "my_db.db") as writer:
+        writer.write_cluster("cluster", [("name", "value"), ...])
+        writer.write_jar("jar", obj)
+    ````
+    """
+    def __init__(self, name, location, secure=False, compression=False, RDA: Storage = None,
+                 stats: Stats = None, concurrent=False, key=None, version=VERSION):
+        """
+        :param secure:
+        See `DataBase.export`
+        :param compression:
+        See `DataBase.export`
+        :param RDA:
+        See `DataBase`
+        :param concurrent:
+        See `DataBase`, readers keep seeing the old file until the writer is closed
+        :param key:
+        Key of the (secured) database
+        :param version:
+        Format version (see `records`)
+        """
+        if secure and key is None:
+            raise Exceptions.UnsupportedError("A secured database requires a key", "DataBaseWriter")
+        self.database = DataBase(name, location, RDA, stats, concurrent, key)
+        self.secure = secure
+        self.compression = Compression() if compression is True else compression
+        self.version = version
+        self.size = 0  # Uncompressed size of the elements
+        self.count = 0
+        self._context = None
+        self._file = None
+        self._stream = None
+        self._sealer = None
+
+    def __enter__(self):
+        from secure import Sealer
+        if self.secure:
+            self._sealer = Sealer(self.database.key, self.compression or None)
+        self._context = self.database._writer(copy=False)
+        location = self._context.__enter__()
+        try:
+            self._file = self.database._open_export(location)
+            self._file.write(self._header())
+            if self.compression and not self.secure:  # Compressed as a whole
+                import zstandard as zst
+                zstd = zst.ZstdCompressor(compression_params=self.compression.params())
+                self._stream = zstd.stream_writer(self._file, closefd=False)
+            else:
+                self._stream = self._file
+        except BaseException as e:
+            self._abort(e)
+            raise
+        return self
+
+    def _header(self):
+        return self.database._get_header(self.secure, self.compression, self.size, self.version)
+
+    def write_cluster(self, title, particles):
+        """
+        Write a Cluster
+        :param particles:
+        Iterable of (name, value) pairs, value as str or bytes,
+        a pair with the name None is a Pin
+        """
+        from tools import RawCluster
+        records = ((False, name, value, 1 if name is None else 0) for name, value in particles)
+        self._write(RawCluster(title, records))
+
+    def write_jar(self, title, obj):
+        """
+        Write a Jar (pickled object)
+        """
+        self._write(Jar(title, obj))
+
+    def _write(self, element):
+        if self._stream is None:
+            raise Exceptions.UnsupportedError("The writer is not open", "DataBaseWriter")
+        self.size += self.database._write_element(self._stream, element, self._sealer, self.version,
+                                                  self._stream is self._file)
+        self.count += 1
+
+    def _abort(self, e):
+        if self._file is not None:
+            self._file.close()
+        self._stream = self._file = None
+        self._context.__exit__(type(e), e, e.__traceback__)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._abort(exc_val)
+            return False
+        try:
+            if self._stream is not self._file:
+                self._stream.close()
+                self._file.seek(0)  # The size is only known now
+                self._file.write(self._header())
+            self._file.close()
+        except BaseException as e:
+            self._stream = self._file = None
+            self._context.__exit__(type(e), e, e.__traceback__)
+            raise
+        self._stream = self._file = None
+        self._context.__exit__(None, None, None)
+        self.database.storage.reopen()
+        self.database.reload()
+        return False